@@ -1,10 +1,35 @@
 '''
 Library for interacting with NASA's Astronomy Picture of the Day API.
 '''
-#We need requests for sending queries to the API to get the URL for our images
-import requests
+#We need requests for sending queries to the API to get the URL for our images. They go through the shared session in http_lib.
+#requests itself is only imported by the functions that send a request, since it is slow to import
+import http_lib
+import apod_metrics     #Times the API calls
+import rate_limit       #Keeps each API key under its rate limit
+import os               #Extra API keys can be given in an environment variable
+import time             #Time is used to forget about missing dates after a while
+from datetime import date, timedelta    #Dates are needed to split long date ranges into chunks
 
 key = 'e5luxCvnXI0Ld5bH2IRJgqtgblFdPoyOtziLDo5K' #This is the key we need in order to interact with the API (API key)
+api_url = 'https://api.nasa.gov/planetary/apod'   #The APOD endpoint that every query goes to
+first_apod_date = date(1995, 6, 16)     #The very first APOD, nothing exists before this date
+range_chunk_days = 365      #How many days we ask for in a single start_date/end_date query
+
+#Every request goes through a pool of keys, each paced by a token bucket. More keys can be given as a comma separated
+#list in the APOD_API_KEYS environment variable (or with set_api_keys), and the requests are spread across them
+
+api_keys = [api_key.strip() for api_key in os.environ.get('APOD_API_KEYS', '').split(',') if api_key.strip()] or [key]
+key_pool = rate_limit.KeyPool(api_keys)
+api_max_wait = 15 * 60      #Most seconds a request waits for a free key before giving up
+api_attempts = 4            #How many times a request is sent before giving up, if it keeps getting 429 Too Many Requests
+default_retry_after = 60    #Seconds to rest a key after a 429 that didn't say how long to wait
+
+#Dates the API said have no APOD are remembered for a while, so we don't keep asking about them. Today's APOD may
+#just not be published yet, so recent dates are only remembered for a short time
+
+missing_dates = {}          #YYYY-MM-DD -> time to ask about it again
+missing_date_ttl = 24 * 60 * 60         #Seconds to remember an old date with no APOD
+recent_missing_date_ttl = 30 * 60       #Seconds to remember a recent (maybe not yet published) date with no APOD
 
 #The main function is used to test out parts of the script. For example I made a query to get the apod info for 2012-09-29
 
@@ -29,18 +54,36 @@ def get_apod_info(apod_date):
   header_params = {                                               
       'date': apod_date,
       'thumbs': 'True',
-      'api_key': key,
   }
 
-  #Now that we have the parameters, send the request to the APOD api with them
-  request = requests.get('https://api.nasa.gov/planetary/apod',
-                     params=header_params)
+  if is_known_missing(apod_date):   #We asked recently, and there was nothing
+    print(f'No APOD for {apod_date} (already asked)')
+    return None
+
+  #Now that we have the parameters, send the request to the APOD api with them. The stage times the request and records how it went
+  import requests
+  with apod_metrics.stage('api', date=str(apod_date)) as api_stage:
+    try:
+      request = send_api_request(header_params)
+    except requests.RequestException as error:   #The API couldn't be reached at all
+      api_stage.outcome = 'unreachable'
+      print('Failed!')
+      print(f'Error: {error}')
+      return None
+    if request is None:
+      api_stage.outcome = 'rate_limited'
+      print('Failed! Every API key is over its rate limit')
+      return None
+    api_stage.outcome = str(request.status_code)
+    api_stage.bytes = len(request.content)
+
+  if request.status_code in (400, 404):   #The API says there is no APOD for the date (or it is outside the range it has)
+    remember_missing(apod_date)
 
   #An 'ok' signal implies that the connection and request were valid so we can use the signal to determine if something went correctly. If so, we can convert the data into a list and use it
   if request.ok:
     body_dict = request.json()  #Put the data into a list
     print("Success!!")
-    print(body_dict)            #Print it (debugging only)
     return body_dict            #And return it so it can be used
 
   else:
@@ -50,6 +93,144 @@ def get_apod_info(apod_date):
   return None
 
 
+#The get_apod_info_range function uses the start_date/end_date mode of the API, which returns a whole list of APODs in one request.
+#Long ranges are split into chunks so a single query never gets too big, and the records are yielded one by one as each chunk arrives
+
+def get_apod_info_range(start_date, end_date, chunk_days=None):
+  """Gets information from the NASA API for every APOD between two dates
+    (inclusive), using as few requests as possible.
+    Args:
+        start_date (date): First APOD date of the range
+        end_date (date): Last APOD date of the range
+        chunk_days (int, optional): Number of days requested per query. Defaults to range_chunk_days.
+    Yields:
+        dict: Dictionary of APOD info for each date in the range, oldest first
+    """
+
+  if chunk_days is None:
+    chunk_days = range_chunk_days
+
+  import requests
+  start_date = max(start_date, first_apod_date)   #Nothing exists before the first APOD, so don't ask for it
+
+  #Walk through the range one chunk at a time. Each chunk is a single request to the API
+
+  chunk_start = start_date
+  while chunk_start <= end_date:
+    chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end_date)
+
+    header_params = {
+        'start_date': chunk_start.isoformat(),
+        'end_date': chunk_end.isoformat(),
+        'thumbs': 'True',
+    }
+
+    with apod_metrics.stage('api_range', start_date=chunk_start, end_date=chunk_end) as api_stage:
+      try:
+        request = send_api_request(header_params)
+      except requests.RequestException as error:
+        api_stage.outcome = 'unreachable'
+        print(f'Failed to get APODs from {chunk_start} to {chunk_end}!')
+        print(f'Error: {error}')
+        return
+      if request is None:
+        api_stage.outcome = 'rate_limited'
+        print(f'Failed to get APODs from {chunk_start} to {chunk_end}! Every API key is over its rate limit')
+        return
+      api_stage.outcome = str(request.status_code)
+      api_stage.bytes = len(request.content)
+
+    if request.ok:
+      returned_dates = set()
+      for apod_info in request.json():   #The range mode gives back a list of the same dictionaries get_apod_info returns
+        returned_dates.add(apod_info['date'])
+        yield apod_info
+
+      day = chunk_start     #Any day the API left out of the list has no APOD
+      while day <= chunk_end:
+        if day.isoformat() not in returned_dates:
+          remember_missing(day)
+        day += timedelta(days=1)
+    else:
+      print(f'Failed to get APODs from {chunk_start} to {chunk_end}!')
+      print(f'{request.status_code} ({request.reason})')
+      print(f'Error: {request.text}')
+
+    chunk_start = chunk_end + timedelta(days=1)   #Move on to the next chunk
+
+  return
+
+
+#Every request to the API goes through this function. It waits for a key that is under its rate limit, sends the
+#request with it, and tells the key pool what the X-RateLimit headers said. A 429 rests that key for as long as the
+#server asked, and the request is sent again (with whichever key is free first)
+
+def send_api_request(params):
+  """Sends a request to the APOD API, keeping every key under its rate limit.
+    Args:
+        params (dict): Query string parameters, without the api_key
+    Returns:
+        requests.Response: Response of the API. None, if no key was under its rate limit within api_max_wait.
+    Raises:
+        requests.RequestException: If the API could not be reached
+    """
+  request = None
+  for attempt in range(api_attempts):
+    api_key = key_pool.acquire(api_max_wait)
+    if api_key is None:
+      return None
+
+    request = http_lib.get(api_url, params=dict(params, api_key=api_key))
+    key_pool.update(api_key, request.headers)
+    if request.status_code != 429:
+      return request
+
+    retry_after = rate_limit.get_retry_after(request.headers, default_retry_after)
+    print(f'API key {api_key[:4]}... is over its rate limit, resting it for {retry_after:.0f} seconds')
+    key_pool.pause(api_key, retry_after)
+
+  return request
+
+
+#This function swaps the API keys for a new set, for scripts that get their keys from somewhere else
+
+def set_api_keys(new_keys):
+  """Changes the API keys used for every request.
+    Args:
+        new_keys (list): The API keys
+    """
+  global api_keys, key_pool
+  api_keys = list(new_keys)
+  key_pool = rate_limit.KeyPool(api_keys)
+  return
+
+
+#Small helpers for the dates we know have no APOD
+
+def is_known_missing(apod_date):
+  """Checks whether the API recently said there is no APOD for a date
+    Args:
+        apod_date (date): APOD date (Can also be a string formatted as YYYY-MM-DD)
+    Returns:
+        bool: True, if there is no point asking about the date yet
+    """
+  ask_again_time = missing_dates.get(str(apod_date))
+  return ask_again_time is not None and time.time() < ask_again_time
+
+
+def remember_missing(apod_date):
+  """Remembers that there is no APOD for a date, for a while
+    Args:
+        apod_date (date): APOD date (Can also be a string formatted as YYYY-MM-DD)
+    """
+  try:
+    recent = date.fromisoformat(str(apod_date)) >= date.today() - timedelta(days=1)
+  except ValueError:    #Not a date at all, so asking again will never help
+    recent = False
+  missing_dates[str(apod_date)] = time.time() + (recent_missing_date_ttl if recent else missing_date_ttl)
+  return
+
+
 #This function will get the actual URL associated with the dictionary we once got with the request to the API. It is passed as the parameter so any dictionary with it can be used
 
 def get_apod_image_url(apod_info_dict):
@@ -85,7 +266,7 @@ def get_apod_image_url(apod_info_dict):
         #print("bob")
         #return thumbnail
     
-    return apod_info_dict['thumbnail_url']
+    return apod_info_dict.get('thumbnail_url')   #Some older videos have no thumbnail at all, so don't crash on them
 
   return None
 
@@ -0,0 +1,542 @@
+'''
+Benchmarks for the hot paths of the APOD scripts.
+'''
+#Each scenario fills a new image cache with a number of made up APODs (10, 1,000 and 100,000 by default), then times:
+#  add_apod_to_cache         - Adding a new APOD end to end (API query, download, hashing, preview, DB), against
+#                              the fake server in fake_apod_server.py, so no real network is used
+#  get_apod_id_from_db       - Looking up an APOD by the SHA-256 of its image (half of them aren't in the cache)
+#  determine_apod_file_path  - Working out where a new image goes
+#  viewer_resize             - Opening and resizing an image the way the viewer does when an APOD is selected, for
+#                              the preview and for the original image
+#  migrate_from_v1           - Opening a cache DB with the original (version 1) schema and the same number of rows,
+#                              some of them duplicate images, so it is brought up to date by every migration
+#  migrate_up_to_date        - Checking for migrations when the DB is already up to date, as every run does
+#Every scenario runs in its own process so its peak memory use is its own. The results are printed (or saved) as
+#JSON, and two result files can be compared to spot regressions.
+#
+#It also times how long each entry point takes to start from nothing (a new Python process), and checks that against
+#startup_budgets:
+#  desktop_cached            - python apod_desktop.py for a date that is already in the cache, which shouldn't need
+#                              requests or Pillow at all
+#  viewer_first_paint        - python apod_viewer.py until its window is on the screen (Windows only, since the
+#                              viewer needs a desktop to draw on)
+#
+#Usage:
+#  python apod_bench.py [--rows 10,1000,100000] [--image-size bytes] [--latency seconds] [--output file]
+#  python apod_bench.py startup [--runs count]
+#  python apod_bench.py compare old_results new_results [--threshold fraction]
+
+import argparse     #argparse reads the command line options
+import contextlib   #Used to hide everything the APOD scripts print while they are being timed
+import json         #The results are saved as JSON
+import os
+import platform     #The results say what they were measured on
+import random       #The made up APODs come from a seeded generator, so every run uses the same ones
+import shutil       #The temporary cache is deleted after each scenario
+import sqlite3      #Only for the SQLite version in the results
+import subprocess   #Each scenario runs in its own process
+import sys
+import tempfile     #Each scenario gets a brand new cache in a temporary directory
+import time
+from datetime import date, timedelta
+
+scenario_rows = (10, 1000, 100000)     #Number of APODs in the cache for each scenario
+ingest_count = 20           #Number of APODs added end to end in each scenario
+lookup_count = 5000         #Number of SHA-256 lookups
+path_count = 5000           #Number of file paths worked out
+resize_count = 20           #Number of images resized like the viewer does
+migrate_runs = 3            #Number of version 1 DBs migrated
+migrate_check_count = 100   #Number of up-to-date migration checks
+duplicate_every = 100       #Every this many rows of the version 1 DB, one has the same image as the row before
+seed_batch_size = 10000     #Number of made up APODs written to the DB in each transaction
+random_seed = 593
+startup_runs = 10           #Number of times each entry point is started
+results_version = 2         #Changes if the layout of the results changes
+
+#Most seconds each entry point can take to start, at the p50 of startup_runs. Measured on the machines the scripts
+#run on, with some room to spare
+startup_budgets = {
+    'desktop_cached': 0.15,
+    'viewer_first_paint': 1.0,
+}
+
+#What the desktop_cached startup runs. It is the same as python apod_desktop.py YYYY-MM-DD, except the cache is in a
+#temporary directory and the desktop background isn't really changed. It prints which of the heavy modules got imported
+desktop_startup_code = '''
+import sys
+import apod_desktop, image_lib
+cache_dir, apod_date = sys.argv[1:3]
+apod_desktop.get_script_dir = lambda: cache_dir
+image_lib.set_desktop_background_image = lambda image_path: True
+sys.argv = ['apod_desktop.py', apod_date]
+apod_desktop.main()
+print('imported', ' '.join(name for name in ('requests', 'PIL') if name in sys.modules))
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the hot paths of the APOD scripts.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks (the default)')
+    add_run_options(run_parser)
+    add_run_options(parser)
+
+    scenario_parser = subparsers.add_parser('scenario', help='run one scenario in this process (used by run)')
+    add_run_options(scenario_parser)
+
+    startup_parser = subparsers.add_parser('startup', help='only time how long the entry points take to start')
+    startup_parser.add_argument('--runs', type=int, default=startup_runs, help=f'times to start each one (default: {startup_runs})')
+
+    compare_parser = subparsers.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('old_results', help='results of the earlier run')
+    compare_parser.add_argument('new_results', help='results of the later run')
+    compare_parser.add_argument('--threshold', type=float, default=0.10,
+                                help='fraction a result can get worse by before it is a regression (default: 0.10)')
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        with open(args.old_results) as old_file, open(args.new_results) as new_file:
+            regressions = compare_results(json.load(old_file), json.load(new_file), args.threshold)
+        sys.exit(1 if regressions else 0)
+    elif args.command == 'scenario':
+        print(json.dumps(run_scenario(args.rows[0], args.image_size, args.latency, args.seed)))
+    elif args.command == 'startup':
+        startup = run_startup_benchmarks(args.runs)
+        print(json.dumps(startup, indent=2))
+        sys.exit(1 if any(result['over_budget'] for result in startup.values()) else 0)
+    else:
+        results = run_benchmarks(args.rows, args.image_size, args.latency, args.seed)
+        output = json.dumps(results, indent=2)
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                output_file.write(output + '\n')
+            print("Results saved to " + args.output)
+        else:
+            print(output)
+    return
+
+
+def add_run_options(parser):
+    """Adds the options for running benchmarks to a parser"""
+    parser.add_argument('--rows', type=lambda text: [int(rows) for rows in text.split(',')], default=list(scenario_rows),
+                        help='comma separated number of APODs in the cache for each scenario (default: 10,1000,100000)')
+    parser.add_argument('--image-size', type=int, default=512 * 1024, help='size of each image in bytes (default: 512KB)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the fake server waits before answering (default: 0)')
+    parser.add_argument('--seed', type=int, default=random_seed, help='seed for the made up APODs')
+    parser.add_argument('--output', help='file to save the results to, instead of printing them')
+
+
+#This function runs every scenario, each in a new process, and puts their results together
+
+def run_benchmarks(rows_list, image_size, latency, seed):
+    """Runs a scenario for each cache size.
+    Args:
+        rows_list (list): Number of APODs in the cache for each scenario
+        image_size (int): Size of each image the fake server sends, in bytes
+        latency (float): Seconds the fake server waits before answering
+        seed (int): Seed for the made up APODs
+    Returns:
+        dict: The results, ready to be saved as JSON
+    """
+    results = {
+        'version': results_version,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sqlite': sqlite3.sqlite_version,
+        'config': {'image_size': image_size, 'latency': latency, 'seed': seed, 'ingest_count': ingest_count,
+                   'lookup_count': lookup_count, 'path_count': path_count, 'resize_count': resize_count,
+                   'migrate_runs': migrate_runs, 'migrate_check_count': migrate_check_count},
+        'scenarios': [],
+        'startup': run_startup_benchmarks(startup_runs),
+    }
+    for rows in rows_list:
+        print(f"Running scenario with {rows} APODs...", file=sys.stderr)
+        command = [sys.executable, os.path.abspath(__file__), 'scenario', '--rows', str(rows),
+                   '--image-size', str(image_size), '--latency', str(latency), '--seed', str(seed)]
+        scenario = subprocess.run(command, check=True, capture_output=True, text=True)
+        results['scenarios'].append(json.loads(scenario.stdout))
+    return results
+
+
+#This function runs one scenario in this process. The APOD scripts are only imported here, so the process that runs
+#the scenarios doesn't load them (and use up memory) itself
+
+def run_scenario(rows, image_size, latency, seed):
+    """Fills a new image cache with made up APODs and times the hot paths against it.
+    Args:
+        rows (int): Number of APODs in the cache
+        image_size (int): Size of each image the fake server sends, in bytes
+        latency (float): Seconds the fake server waits before answering
+        seed (int): Seed for the made up APODs
+    Returns:
+        dict: Results of the scenario
+    """
+    import apod_api
+    import apod_cache
+    import apod_desktop
+    import fake_apod_server
+
+    generator = random.Random(seed)
+    server = fake_apod_server.start_server(size=image_size, delay=latency)
+    apod_api.api_url = fake_apod_server.get_api_url(server)
+    cache_dir = tempfile.mkdtemp(prefix='apod_bench_')
+
+    scenario = {'rows': rows, 'benchmarks': {}}
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            apod_desktop.init_apod_cache(cache_dir)
+
+            start_time = time.perf_counter()
+            seeded_sha256s = seed_cache(apod_desktop, rows, generator)
+            scenario['seed_seconds'] = round(time.perf_counter() - start_time, 3)
+
+            benchmarks = scenario['benchmarks']
+            apod_ids = []
+            benchmarks['add_apod_to_cache'] = time_calls(
+                lambda apod_date: apod_ids.append(apod_desktop.add_apod_to_cache(apod_date)),
+                [date(2001, 1, 1) + timedelta(days=day) for day in range(ingest_count)])
+
+            lookups = [generator.choice(seeded_sha256s) if index % 2 == 0 else make_sha256(generator)
+                       for index in range(lookup_count)]
+            benchmarks['get_apod_id_from_db'] = time_calls(apod_desktop.get_apod_id_from_db, lookups)
+
+            titles = [make_title(generator) for index in range(path_count)]
+            benchmarks['determine_apod_file_path'] = time_calls(
+                lambda title: apod_desktop.determine_apod_file_path(title, 'https://apod.nasa.gov/apod/image/2205/image.jpg'),
+                titles)
+
+            display_ids = [apod_ids[index % len(apod_ids)] for index in range(resize_count)]
+            benchmarks['viewer_resize_preview'] = time_calls(
+                lambda apod_id: resize_for_viewer(apod_desktop.get_apod_preview_path(apod_id)), display_ids)
+            benchmarks['viewer_resize_original'] = time_calls(
+                lambda apod_id: resize_for_viewer(apod_desktop.get_apod_info(apod_id)['file_path']), display_ids)
+
+            apod_desktop.cache_store.close()
+
+            #Every run migrates its own copy of the same version 1 DB
+            v1_db_path = os.path.join(cache_dir, 'v1_cache.db')
+            build_v1_db(apod_cache, v1_db_path, rows, generator)
+            db_paths = []
+            for run in range(migrate_runs):
+                db_paths.append(os.path.join(cache_dir, f'migrated_{run}.db'))
+                shutil.copyfile(v1_db_path, db_paths[-1])
+            benchmarks['migrate_from_v1'] = time_calls(lambda db_path: apod_cache.ApodCacheStore(db_path).close(), db_paths)
+
+            cache_store = apod_cache.ApodCacheStore(db_paths[0])
+            benchmarks['migrate_up_to_date'] = time_calls(lambda run: cache_store.migrate(), range(migrate_check_count))
+            cache_store.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    scenario['peak_rss_bytes'] = get_peak_rss()
+    return scenario
+
+
+#These functions time how long the entry points take to start. Each run is a new Python process, timed from before
+#it starts until it exits (or, for the viewer, until it says its window is up). The first run of each is thrown
+#away, since it is also the one that gets the files into the OS's cache
+
+def run_startup_benchmarks(runs):
+    """Times how long each entry point takes to start.
+    Args:
+        runs (int): Number of times to start each one
+    Returns:
+        dict: p50 and max in seconds, the budget and whether the p50 is over it, by entry point
+    """
+    print("Timing startup...", file=sys.stderr)
+    startup = {'desktop_cached': time_desktop_startup(runs)}
+    if sys.platform == 'win32':
+        startup['viewer_first_paint'] = time_viewer_startup(runs)
+    for name, result in startup.items():
+        result['budget'] = startup_budgets[name]
+        result['over_budget'] = result['p50'] > result['budget']
+    return startup
+
+
+def time_desktop_startup(runs):
+    """Times python apod_desktop.py for a date that is already in the cache
+    Args:
+        runs (int): Number of times to run it
+    Returns:
+        dict: p50 and max in seconds, and the heavy modules it imported
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    cache_dir = tempfile.mkdtemp(prefix='apod_bench_')
+    apod_date = '2001-01-01'
+    seed_code = ('import sys, apod_desktop\n'
+                 'apod_desktop.init_apod_cache(sys.argv[1])\n'
+                 'apod_desktop.cache_store.add_apod("Startup", "", "", "0" * 64, sys.argv[2])\n')
+    try:
+        subprocess.run([sys.executable, '-c', seed_code, cache_dir, apod_date], cwd=script_dir, check=True, capture_output=True)
+        times = []
+        for run in range(runs + 1):
+            start_time = time.perf_counter()
+            desktop = subprocess.run([sys.executable, '-c', desktop_startup_code, cache_dir, apod_date], cwd=script_dir,
+                                     check=True, capture_output=True, text=True)
+            times.append(time.perf_counter() - start_time)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    imported = desktop.stdout.strip().splitlines()[-1].split()[1:]
+    return dict(summarize_startup(times[1:]), imported=imported)
+
+
+def time_viewer_startup(runs):
+    """Times python apod_viewer.py until its window is on the screen
+    Args:
+        runs (int): Number of times to start it
+    Returns:
+        dict: p50 and max in seconds, and the p50 until it was ready to use
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    paint_times = []
+    ready_times = []
+    for run in range(runs + 1):
+        start_time = time.perf_counter()
+        viewer = subprocess.Popen([sys.executable, os.path.join(script_dir, 'apod_viewer.py'), '--startup-check'],
+                                  cwd=script_dir, stdout=subprocess.PIPE, text=True)
+        for line in viewer.stdout:
+            name = line.split()[0] if line.strip() else ''
+            if name == 'first_paint':
+                paint_times.append(time.perf_counter() - start_time)
+            elif name == 'ready':
+                ready_times.append(time.perf_counter() - start_time)
+        viewer.wait()
+    result = summarize_startup(paint_times[1:])
+    result['ready_p50'] = round(get_percentile(sorted(ready_times[1:]), 50), 4)
+    return result
+
+
+def summarize_startup(times):
+    """Gets the p50 and max of some startup times"""
+    times = sorted(times)
+    return {'runs': len(times), 'p50': round(get_percentile(times, 50), 4), 'max': round(times[-1], 4)}
+
+
+#This function fills the cache with made up APODs. They have no image files, which is fine for everything except
+#displaying them, and the viewer benchmarks use the APODs that were really downloaded instead
+
+def seed_cache(apod_desktop, rows, generator):
+    """Adds made up APODs to the image cache
+    Args:
+        apod_desktop (module): The apod_desktop module, with the cache initialized
+        rows (int): Number of APODs to add
+        generator (random.Random): Random generator
+    Returns:
+        list: SHA-256 of every APOD added
+    """
+    sha256s = []
+    for batch_start in range(0, rows, seed_batch_size):
+        apods = []
+        for index in range(batch_start, min(batch_start + seed_batch_size, rows)):
+            sha256s.append(make_sha256(generator))
+            title = make_title(generator)
+            apods.append({
+                'title': title,
+                'explanation': f"{title}. " * 20,
+                'path': os.path.join(apod_desktop.image_cache_dir, f"seeded_{index}.jpg"),
+                'sha256': sha256s[-1],
+                'size': 1000,
+            })
+        apod_desktop.cache_store.add_apods(apods)
+    return sha256s
+
+
+#This function builds a cache DB the way the first version of the scripts did: only the apod_image table with its
+#four columns, at schema version 1. Every duplicate_every rows there is a duplicate image, which migration 3 removes
+
+def build_v1_db(apod_cache, db_path, rows, generator):
+    """Makes a cache DB with the original schema and made up APODs
+    Args:
+        apod_cache (module): The apod_cache module
+        db_path (str): Full path of the DB to make
+        rows (int): Number of APODs to add
+        generator (random.Random): Random generator
+    """
+    image_dir = os.path.dirname(db_path)
+    sha256 = None
+
+    def make_rows():
+        nonlocal sha256
+        for index in range(rows):
+            if sha256 is None or index % duplicate_every != duplicate_every - 1:
+                sha256 = make_sha256(generator)
+            title = make_title(generator)
+            yield title, f"{title}. " * 20, os.path.join(image_dir, f"seeded_{index}.jpg"), sha256
+
+    connection = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        connection.execute("BEGIN")
+        apod_cache.create_apod_table(connection.cursor())
+        connection.executemany("INSERT INTO apod_image (title, explanation, path, sha256) VALUES (?, ?, ?, ?)", make_rows())
+        connection.execute("PRAGMA user_version = 1")
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+
+def make_sha256(generator):
+    """Makes up a SHA-256 hash value"""
+    return f"{generator.getrandbits(256):064x}"
+
+
+def make_title(generator):
+    """Makes up an APOD title"""
+    words = ('Galaxy', 'Nebula', 'Comet', 'Moon', 'Aurora', 'Eclipse', 'Star', 'Cluster', 'Spiral', 'Dust',
+             'Jupiter', 'Saturn', 'Mars', 'Sun', 'Milky Way', 'NGC #' + str(generator.randint(1, 7000)))
+    return ' '.join(generator.choice(words) for word in range(4))
+
+
+#This is what the viewer does to an image when an APOD is selected (load_display_image in apod_viewer.py). The
+#viewer itself can't be imported here, since it opens its window as soon as it is imported
+
+def resize_for_viewer(image_path):
+    """Opens an image and scales it down to fit the viewer"""
+    from PIL import Image
+    import image_lib
+    unsized_image = Image.open(image_path)
+    return unsized_image.resize(image_lib.scale_image(image_size=(unsized_image.width, unsized_image.height)))
+
+
+#This function calls a function once for each argument and times every call
+
+def time_calls(func, args_list):
+    """Times the calls of a function.
+    Args:
+        func (callable): Function to time, called with one argument
+        args_list (list): Argument for each call
+    Returns:
+        dict: Number of calls, throughput (calls per second), and the mean, p50 and p99 latency in milliseconds
+    """
+    latencies = []
+    start_time = time.perf_counter()
+    for arg in args_list:
+        call_start = time.perf_counter()
+        func(arg)
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start_time
+
+    latencies.sort()
+    return {
+        'ops': len(latencies),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 4),
+        'p50_ms': round(get_percentile(latencies, 50) * 1000, 4),
+        'p99_ms': round(get_percentile(latencies, 99) * 1000, 4),
+    }
+
+
+def get_percentile(sorted_values, percent):
+    """Gets a percentile of some values (nearest rank)
+    Args:
+        sorted_values (list): Values, smallest first
+        percent (float): Percentile, from 0 to 100
+    Returns:
+        float: The value at that percentile
+    """
+    rank = max(int(round(percent / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+#The most memory this process has used at any one time. Windows and the others each have their own way of asking
+
+def get_peak_rss():
+    """Gets the peak resident memory of this process
+    Returns:
+        int: Peak resident memory in bytes. None, if it can't be found out.
+    """
+    try:
+        import resource
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_rss if sys.platform == 'darwin' else peak_rss * 1024     #Bytes on macOS, KB everywhere else
+    except ImportError:
+        pass
+
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    except (ImportError, AttributeError, OSError):
+        pass
+    return None
+
+
+#This function compares two runs. A benchmark has regressed if its p50 or p99 got slower, or its throughput dropped,
+#by more than the threshold. Only scenarios and benchmarks that are in both runs are compared
+
+def compare_results(old_results, new_results, threshold=0.10):
+    """Prints how each benchmark changed between two runs.
+    Args:
+        old_results (dict): Results of the earlier run
+        new_results (dict): Results of the later run
+        threshold (float, optional): Fraction a result can get worse by before it is a regression. Defaults to 0.10.
+    Returns:
+        list: (rows, benchmark, measure) of each regression
+    """
+    old_scenarios = {scenario['rows']: scenario for scenario in old_results['scenarios']}
+    regressions = []
+
+    print(f"{'rows':>8}  {'benchmark':<26}{'measure':<12}{'old':>12}{'new':>12}{'change':>9}")
+    for new_scenario in new_results['scenarios']:
+        old_scenario = old_scenarios.get(new_scenario['rows'])
+        if old_scenario is None:
+            continue
+
+        measures = []
+        for benchmark, new_stats in new_scenario['benchmarks'].items():
+            old_stats = old_scenario['benchmarks'].get(benchmark)
+            if old_stats is not None:
+                for measure, higher_is_better in (('p50_ms', False), ('p99_ms', False), ('throughput', True)):
+                    measures.append((benchmark, measure, old_stats.get(measure), new_stats.get(measure), higher_is_better))
+        measures.append(('process', 'peak_rss_mb', to_megabytes(old_scenario.get('peak_rss_bytes')),
+                         to_megabytes(new_scenario.get('peak_rss_bytes')), False))
+
+        for benchmark, measure, old_value, new_value, higher_is_better in measures:
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > threshold:
+                flag = '  REGRESSION'
+                regressions.append((new_scenario['rows'], benchmark, measure))
+            print(f"{new_scenario['rows']:>8}  {benchmark:<26}{measure:<12}{old_value:>12.3f}{new_value:>12.3f}{change:>+9.1%}{flag}")
+
+    for name, new_startup in new_results.get('startup', {}).items():
+        old_startup = old_results.get('startup', {}).get(name)
+        if old_startup is None or not old_startup['p50']:
+            continue
+        change = (new_startup['p50'] - old_startup['p50']) / old_startup['p50']
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(('startup', name, 'p50'))
+        print(f"{'startup':>8}  {name:<26}{'p50':<12}{old_startup['p50']:>12.3f}{new_startup['p50']:>12.3f}{change:>+9.1%}{flag}")
+
+    print(f"{len(regressions)} regressions (threshold {threshold:.0%})")
+    return regressions
+
+
+def to_megabytes(size):
+    """Converts a size in bytes to MB, keeping None as None"""
+    return None if size is None else size / (1024 * 1024)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,804 @@
+'''
+Library for storing APOD information in the image cache database.
+'''
+#The cache store keeps ONE connection to the image cache DB open for as long as the program runs, instead of
+#opening and closing a connection for every query. The DB runs in WAL mode, which lets the viewer read while
+#something else writes, and batches of APODs can be written in a single transaction.
+
+import sqlite3      #Sqlite3 is for interacting with our database
+import os           #Os finds the full path of a DB that is opened read-only
+import re           #re splits search queries into words
+import time         #Time stamps when each APOD was last used
+import threading    #The lock makes sure two threads never use the connection at the same time
+from contextlib import contextmanager   #Used to build the transaction() with-block
+from datetime import date   #Dates are stored in the DB as YYYY-MM-DD strings
+
+
+#The layout of the cache DB changes over time, so each change is written as a migration. The migrations are
+#numbered by their place in the schema_migrations list, and the DB remembers the last one it ran in its
+#user_version (a number SQLite keeps in the DB file for us). A new DB starts at version 0 and runs all of them.
+#A migration can give back a list of image files that no DB row uses any more, and they are deleted once it commits.
+#NEVER change a migration that has been released, add a new one to the end of the list instead
+
+def create_apod_table(cursor):
+    """Migration 1: Creates the apod_image table"""
+
+    #For our apod_table, we need to make sure we get the title, explanation (description), the ID (for identification)
+    #and the hash. The values must not be blank
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS apod_image
+    (
+        id INTEGER PRIMARY KEY,
+        title TEXT NOT NULL,
+        explanation TEXT NOT NULL,
+        path TEXT NOT NULL,
+        sha256 TEXT NOT NULL
+    );
+    """)
+
+
+def add_apod_date_column(cursor):
+    """Migration 2: Adds the APOD date, with a unique index so a date is a single index lookup"""
+
+    #Caches made before migrations existed may already have the column, so only add it when it's missing.
+    #The rows that were already there keep an empty date until they are downloaded again
+
+    if 'apod_date' not in get_column_names(cursor, 'apod_image'):
+        cursor.execute("ALTER TABLE apod_image ADD COLUMN apod_date TEXT")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS apod_image_apod_date ON apod_image (apod_date)")
+
+
+def add_sha256_index(cursor):
+    """Migration 3: Adds a unique index on the SHA-256 hash so get_apod_id_from_db doesn't scan the whole table"""
+
+    #The same image should never be in the cache twice, but in case an old cache has duplicates, keep the oldest row.
+    #The dates of the others become aliases of it (the alias table is made here, early, for them), and their files
+    #are deleted, unless the row that's kept uses the same file
+
+    create_alias_table(cursor)
+    cursor.execute("CREATE TEMP TABLE kept_sha256 AS SELECT sha256, MIN(id) AS id FROM apod_image GROUP BY sha256")
+    cursor.execute("""
+    INSERT OR IGNORE INTO apod_date_alias (apod_date, apod_id)
+    SELECT apod_image.apod_date, kept_sha256.id FROM apod_image JOIN kept_sha256 USING (sha256)
+    WHERE apod_image.id != kept_sha256.id AND apod_image.apod_date IS NOT NULL;
+    """)
+    cursor.execute("""
+    SELECT DISTINCT path FROM apod_image
+    WHERE id NOT IN (SELECT id FROM kept_sha256)
+    AND path NOT IN (SELECT path FROM apod_image WHERE id IN (SELECT id FROM kept_sha256));
+    """)
+    unused_paths = [path for (path,) in cursor.fetchall()]
+    cursor.execute("DELETE FROM apod_image WHERE id NOT IN (SELECT id FROM kept_sha256);")
+    cursor.execute("DROP TABLE kept_sha256")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS apod_image_sha256 ON apod_image (sha256)")
+    return unused_paths
+
+
+def add_download_columns(cursor):
+    """Migration 4: Adds the image URL and the ETag/Last-Modified the server sent, so an image can be re-checked cheaply"""
+    for column_name in ('image_url', 'etag', 'last_modified'):
+        if column_name not in get_column_names(cursor, 'apod_image'):
+            cursor.execute(f"ALTER TABLE apod_image ADD COLUMN {column_name} TEXT")
+
+
+def create_cache_meta_table(cursor):
+    """Migration 5: Creates the cache_meta table, which holds settings that belong to this cache (like its file layout)"""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS cache_meta
+    (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """)
+
+
+def create_search_index(cursor):
+    """Migration 6: Creates a full-text search index over the titles and explanations, and fills it from the APODs already there"""
+
+    #The index is an FTS5 table that doesn't keep its own copy of the text (content='apod_image'), it only keeps the
+    #index. The triggers keep it in step with apod_image, and 'rebuild' indexes every row that was already in the DB.
+    #The porter tokenizer lets "galaxies" find "galaxy", and the prefix indexes make search-as-you-type quick
+
+    cursor.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS apod_search USING fts5
+    (
+        title,
+        explanation,
+        content='apod_image',
+        content_rowid='id',
+        tokenize='porter unicode61 remove_diacritics 2',
+        prefix='2 3'
+    );
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS apod_image_search_insert AFTER INSERT ON apod_image BEGIN
+        INSERT INTO apod_search (rowid, title, explanation) VALUES (new.id, new.title, new.explanation);
+    END;
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS apod_image_search_delete AFTER DELETE ON apod_image BEGIN
+        INSERT INTO apod_search (apod_search, rowid, title, explanation) VALUES ('delete', old.id, old.title, old.explanation);
+    END;
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS apod_image_search_update AFTER UPDATE OF title, explanation ON apod_image BEGIN
+        INSERT INTO apod_search (apod_search, rowid, title, explanation) VALUES ('delete', old.id, old.title, old.explanation);
+        INSERT INTO apod_search (rowid, title, explanation) VALUES (new.id, new.title, new.explanation);
+    END;
+    """)
+    cursor.execute("INSERT INTO apod_search (apod_search) VALUES ('rebuild');")
+
+
+def add_usage_columns(cursor):
+    """Migration 7: Adds the image size, when and how often each APOD was used, and whether it is pinned, for evicting
+    APODs when the cache grows past its budget"""
+
+    #The sizes of the rows that were already there are filled in by the first eviction pass, since SQL can't look at files
+
+    columns = get_column_names(cursor, 'apod_image')
+    for column_name, column_type in (('size', 'INTEGER'),
+                                     ('last_access', 'REAL'),
+                                     ('access_count', 'INTEGER NOT NULL DEFAULT 0'),
+                                     ('pinned', 'INTEGER NOT NULL DEFAULT 0')):
+        if column_name not in columns:
+            cursor.execute(f"ALTER TABLE apod_image ADD COLUMN {column_name} {column_type}")
+    cursor.execute("CREATE INDEX IF NOT EXISTS apod_image_last_access ON apod_image (last_access)")
+
+
+def add_compaction_columns(cursor):
+    """Migration 8: Adds what the compact command needs to know about each image: the format it was re-encoded to,
+    how big it was as downloaded, and the hash of the re-encoded file (sha256 stays the hash of the download, which is
+    what new downloads are compared against)"""
+    columns = get_column_names(cursor, 'apod_image')
+    for column_name, column_type in (('compact_format', 'TEXT'),
+                                     ('original_size', 'INTEGER'),
+                                     ('file_sha256', 'TEXT')):
+        if column_name not in columns:
+            cursor.execute(f"ALTER TABLE apod_image ADD COLUMN {column_name} {column_type}")
+
+
+def add_perceptual_hash(cursor):
+    """Migration 9: Adds the perceptual hash of each image, for finding near-duplicates, and the table of dates whose
+    APOD wasn't stored because it was a near-duplicate of one that was"""
+    if 'phash' not in get_column_names(cursor, 'apod_image'):
+        cursor.execute("ALTER TABLE apod_image ADD COLUMN phash INTEGER")
+    create_alias_table(cursor)      #Already there if migration 3 found duplicates to alias
+
+
+schema_migrations = [
+    create_apod_table,
+    add_apod_date_column,
+    add_sha256_index,
+    add_download_columns,
+    create_cache_meta_table,
+    create_search_index,
+    add_usage_columns,
+    add_compaction_columns,
+    add_perceptual_hash,
+]
+
+
+#The sync command copies APODs from the cache of another computer, often on a network share. Its DB is only ever
+#read, so it is opened read-only and not brought up to date. A cache from an older version may not have every column
+#or the alias table, and the columns it doesn't have are left out
+
+def read_cache_records(db_path):
+    """Reads every APOD of another image cache DB, without changing the DB
+    Args:
+        db_path (str): Full path of the image cache DB
+    Returns:
+        list: Value of each column of each APOD, by column name, in ID order. The dates whose APOD was skipped as a
+        near-duplicate of it are under 'alias_dates'.
+    """
+    from urllib.request import pathname2url
+    connection = sqlite3.connect('file:' + pathname2url(os.path.abspath(db_path)) + '?mode=ro', uri=True)
+    try:
+        connection.row_factory = sqlite3.Row
+        records = {row['id']: dict(row, alias_dates=[]) for row in connection.execute("SELECT * FROM apod_image ORDER BY id;")}
+        if 'apod_date' in get_column_names(connection.cursor(), 'apod_date_alias'):
+            for apod_date, apod_id in connection.execute("SELECT apod_date, apod_id FROM apod_date_alias;"):
+                if apod_id in records:
+                    records[apod_id]['alias_dates'].append(apod_date)
+    finally:
+        connection.close()
+    for record in records.values():
+        record['phash'] = phash_from_db(record.get('phash'))
+    return list(records.values())
+
+
+#Small helpers for the migrations
+
+def create_alias_table(cursor):
+    """Creates the apod_date_alias table, which maps a date whose APOD wasn't stored to the cached APOD it is the same as"""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS apod_date_alias
+    (
+        apod_date TEXT PRIMARY KEY,
+        apod_id INTEGER NOT NULL
+    );
+    """)
+
+
+def get_column_names(cursor, table_name):
+    """Gets the names of the columns of a table
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the DB
+        table_name (str): Name of the table
+    Returns:
+        list: Column names
+    """
+    cursor.execute(f"PRAGMA table_info({table_name})")     #Each row describes a column, and the name is in index 1
+    return [column[1] for column in cursor.fetchall()]
+
+
+def remove_unused_files(file_paths):
+    """Deletes the image files a migration took the last rows of out of the DB
+    Args:
+        file_paths (list): Full path of each file
+    """
+    removed_count = 0
+    for file_path in file_paths:
+        try:
+            os.remove(file_path)
+            removed_count += 1
+        except FileNotFoundError:       #Already gone
+            pass
+        except OSError as error:
+            print(f"Could not remove {file_path}, which no APOD uses any more: {error}")
+    if removed_count:
+        print(f"Removed {removed_count} image files that no APOD uses any more")
+
+
+#SQLite integers are signed, so perceptual hashes with their top bit set are stored as negative numbers
+
+def phash_to_db(phash):
+    """Converts a 64-bit perceptual hash to the signed number stored in the DB"""
+    if phash is None:
+        return None
+    return phash - (1 << 64) if phash >= 1 << 63 else phash
+
+
+def phash_from_db(value):
+    """Converts a perceptual hash from the DB back to a 64-bit hash"""
+    if value is None:
+        return None
+    return value & ((1 << 64) - 1)
+
+
+#Dates can be passed around as date objects or as strings, but the DB only ever sees strings
+
+def date_to_text(apod_date):
+    """Converts an APOD date to the YYYY-MM-DD text stored in the DB
+    Args:
+        apod_date (date): APOD date (Can also be a string formatted as YYYY-MM-DD, or None)
+    Returns:
+        str: APOD date as YYYY-MM-DD
+    """
+    if isinstance(apod_date, date):
+        return apod_date.isoformat()
+    return apod_date
+
+
+#People type plain words into the search box, not FTS5 queries, so quotes, brackets and words like OR or NEAR must
+#not be treated as query syntax. Every word is quoted, and the last one matches as a prefix because it may still be
+#half typed
+
+def make_search_query(text):
+    """Turns the text typed by the user into an FTS5 query that finds APODs containing every word
+    Args:
+        text (str): Search text
+    Returns:
+        str: FTS5 query. None, if the text has no words in it.
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+class ApodCacheStore:
+    """The image cache DB, kept open on a single connection.
+    Every method can be called from any thread. Calls are made one at a time.
+    """
+
+    #The queries are kept as constants. sqlite3 keeps the prepared statement for each query text it has seen
+    #(up to cached_statements of them), so running the same text again skips parsing it again
+
+    apod_columns = ('title', 'explanation', 'path', 'sha256', 'apod_date', 'image_url', 'etag', 'last_modified',
+                    'size', 'last_access', 'phash', 'compact_format', 'original_size', 'file_sha256')
+    add_apod_query = f"""
+    INSERT INTO apod_image ({', '.join(apod_columns)})
+    VALUES ({', '.join('?' for column in apod_columns)});
+    """
+    find_sha256_query = "SELECT id FROM apod_image WHERE sha256 = ?;"
+    #A date counts as cached if an APOD has it, or it was skipped as a near-duplicate of an APOD that is cached
+    find_date_query = """
+    SELECT id FROM apod_image WHERE apod_date = ?1
+    UNION ALL SELECT apod_id FROM apod_date_alias WHERE apod_date = ?1;
+    """
+    find_date_range_query = """
+    SELECT apod_date FROM apod_image WHERE apod_date BETWEEN ?1 AND ?2
+    UNION ALL SELECT apod_date FROM apod_date_alias WHERE apod_date BETWEEN ?1 AND ?2;
+    """
+    set_date_query = """
+    UPDATE apod_image SET apod_date = ?
+    WHERE id = ? AND apod_date IS NULL
+    AND NOT EXISTS (SELECT 1 FROM apod_image WHERE apod_date = ?);
+    """
+    select_apod_query = "SELECT title, explanation, path FROM apod_image WHERE id = ?;"
+    select_record_query = "SELECT * FROM apod_image WHERE id = ?;"
+    select_titles_query = "SELECT title FROM apod_image;"
+    select_page_query = "SELECT id, apod_date, title FROM apod_image WHERE id > ? ORDER BY id LIMIT ?;"
+    search_query = """
+    SELECT apod_image.id, apod_image.apod_date, apod_image.title
+    FROM apod_search JOIN apod_image ON apod_image.id = apod_search.rowid
+    WHERE apod_search MATCH ?
+    ORDER BY bm25(apod_search, 10.0, 1.0)
+    LIMIT ?;
+    """
+    record_access_query = "UPDATE apod_image SET last_access = ?, access_count = access_count + 1 WHERE id = ?;"
+    set_pinned_query = "UPDATE apod_image SET pinned = ? WHERE id = ?;"
+    total_size_query = "SELECT COALESCE(SUM(size), 0), COUNT(*) FROM apod_image;"
+    unsized_query = "SELECT id, path FROM apod_image WHERE size IS NULL;"
+    delete_apod_query = "DELETE FROM apod_image WHERE id = ?;"
+    delete_aliases_query = "DELETE FROM apod_date_alias WHERE apod_id = ?;"
+    add_alias_query = "INSERT OR IGNORE INTO apod_date_alias (apod_date, apod_id) VALUES (?, ?);"
+    select_phashes_query = "SELECT id, phash FROM apod_image WHERE phash IS NOT NULL;"
+    unhashed_query = "SELECT id, path FROM apod_image WHERE phash IS NULL AND id > ? ORDER BY id LIMIT ?;"
+    set_phash_query = "UPDATE apod_image SET phash = ? WHERE id = ?;"
+    select_aliases_query = "SELECT apod_date, apod_id FROM apod_date_alias;"
+    uncompacted_query = "SELECT id, path FROM apod_image WHERE compact_format IS NULL AND id > ? ORDER BY id LIMIT ?;"
+    compaction_totals_query = """
+    SELECT COUNT(*), COALESCE(SUM(original_size), 0), COALESCE(SUM(size), 0) FROM apod_image
+    WHERE compact_format IS NOT NULL AND compact_format != 'original';
+    """
+
+    #The order APODs are evicted in for each eviction policy. APODs that were never used since the columns were
+    #added have no last_access, and go first
+
+    eviction_orders = {
+        'lru': "COALESCE(last_access, 0), id",                     #Least recently used first
+        'lfu': "access_count, COALESCE(last_access, 0), id",       #Least often used first, and the oldest of those
+    }
+    get_setting_query = "SELECT value FROM cache_meta WHERE key = ?;"
+    set_setting_query = "INSERT OR REPLACE INTO cache_meta (key, value) VALUES (?, ?);"
+
+    def __init__(self, db_path, synchronous='NORMAL'):
+        """Opens (and creates, if needed) the image cache DB and brings it up to the latest schema.
+        Args:
+            db_path (str): Full path of the image cache DB
+            synchronous (str, optional): SQLite synchronous setting. NORMAL is safe in WAL mode and
+            only syncs to disk at checkpoints. Defaults to 'NORMAL'.
+        """
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.transaction_depth = 0      #How many transaction() blocks we are inside of
+
+        #isolation_level=None means sqlite3 won't start transactions behind our back, transaction() does it instead.
+        #check_same_thread=False lets the viewer's worker threads use the connection, the lock keeps them in line
+
+        self.connection = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False, cached_statements=256)
+        self.connection.execute("PRAGMA journal_mode = WAL")     #Readers don't block the writer and the writer doesn't block readers
+        self.connection.execute(f"PRAGMA synchronous = {synchronous}")
+        self.connection.execute("PRAGMA busy_timeout = 5000")    #Wait for another process's write instead of failing straight away
+        self.migrate()
+
+    def close(self):
+        """Closes the connection to the DB"""
+        with self.lock:
+            self.connection.close()
+
+    #A with-block that runs everything inside it as a single transaction. If anything goes wrong, all of it is
+    #rolled back. Blocks can be nested, and only the outermost one commits
+
+    @contextmanager
+    def transaction(self):
+        """Runs the queries inside the with-block in one transaction.
+        Yields:
+            sqlite3.Cursor: Cursor to run the queries with
+        """
+        with self.lock:
+            cursor = self.connection.cursor()
+            if self.transaction_depth == 0:
+                cursor.execute("BEGIN IMMEDIATE")       #Take the write lock now so we never have to upgrade to it halfway
+            self.transaction_depth += 1
+            try:
+                yield cursor
+            except:
+                self.transaction_depth -= 1
+                if self.transaction_depth == 0:
+                    cursor.execute("ROLLBACK")
+                raise
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                cursor.execute("COMMIT")
+
+    #This method runs every migration the DB hasn't had yet, in order. Each migration runs in its own transaction
+    #together with the update to user_version, so a migration that fails leaves the DB exactly as it was
+
+    def migrate(self):
+        """Upgrades the DB to the latest schema.
+        Returns:
+            int: Schema version of the DB after upgrading
+        """
+        with self.lock:
+            version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+            is_new_db = self.connection.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE name = 'apod_image'").fetchone()[0] == 0
+
+            for new_version in range(version + 1, len(schema_migrations) + 1):
+                migration = schema_migrations[new_version - 1]
+                with self.transaction() as cursor:
+                    unused_paths = migration(cursor) or []
+                    cursor.execute(f"PRAGMA user_version = {new_version}")
+                if not is_new_db:       #Only upgrades are worth mentioning, not a brand new DB being built
+                    print(f"Image cache DB upgraded to version {new_version} ({migration.__name__})")
+                remove_unused_files(unused_paths)       #Only once the rows are gone for good, so a rollback never loses a file
+                version = new_version
+
+            return version
+
+    def add_apod(self, title, explanation, file_path, sha256, apod_date=None, image_url=None, etag=None, last_modified=None,
+                 size=None, phash=None):
+        """Adds APOD information to the DB, unless an APOD with the same SHA-256 is already there.
+        Args:
+            title (str): Title of the APOD image
+            explanation (str): Explanation of the APOD image
+            file_path (str): Full path of the APOD image file
+            sha256 (str): SHA-256 hash value of APOD image
+            apod_date (date, optional): Date of the APOD image (Can also be a string formatted as YYYY-MM-DD)
+            image_url (str, optional): URL the image was downloaded from
+            etag (str, optional): ETag the server sent with the image
+            last_modified (str, optional): Last-Modified the server sent with the image
+            size (int, optional): Size of the image file in bytes
+            phash (int, optional): Perceptual hash of the image
+        Returns:
+            int: The ID of the APOD record
+        """
+        apod = {
+            'title': title,
+            'explanation': explanation,
+            'path': file_path,
+            'sha256': sha256,
+            'apod_date': apod_date,
+            'image_url': image_url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'size': size,
+            'phash': phash,
+        }
+        return self.add_apods([apod])[0]
+
+    def add_apods(self, apods):
+        """Adds many APODs to the DB in a single transaction.
+        APODs whose SHA-256 is already in the DB are not added again.
+        Args:
+            apods (iterable[dict]): Column values of each APOD. 'title', 'explanation', 'path' and
+            'sha256' are required, the other columns in apod_columns are optional. last_access defaults to now.
+        Returns:
+            list: The ID of each APOD record, in the same order
+        """
+        apod_ids = []
+        with self.transaction() as cursor:
+            for apod in apods:
+                cursor.execute(self.find_sha256_query, (apod['sha256'],))
+                result = cursor.fetchone()
+                if result is not None:      #Already there (maybe earlier in this very batch)
+                    apod_ids.append(result[0])
+                    continue
+                values = [apod.get(column) for column in self.apod_columns]
+                values[self.apod_columns.index('apod_date')] = date_to_text(apod.get('apod_date'))
+                values[self.apod_columns.index('phash')] = phash_to_db(apod.get('phash'))
+                if apod.get('last_access') is None:     #A new APOD counts as just used, so it isn't the first thing evicted
+                    values[self.apod_columns.index('last_access')] = time.time()
+                cursor.execute(self.add_apod_query, values)
+                apod_ids.append(cursor.lastrowid)
+        return apod_ids
+
+    def update_apod(self, apod_id, values):
+        """Changes some of the columns of an APOD
+        Args:
+            apod_id (int): ID of APOD in the DB
+            values (dict): New value of each column to change
+        """
+        assignments = ', '.join(f'{column} = ?' for column in values)    #Only ever built from our own column names
+        with self.transaction() as cursor:
+            cursor.execute(f"UPDATE apod_image SET {assignments} WHERE id = ?;", list(values.values()) + [apod_id])
+
+    def get_apod_record(self, apod_id):
+        """Gets every column of an APOD
+        Args:
+            apod_id (int): ID of APOD in the DB
+        Returns:
+            dict: Value of each column, by column name. None, if there is no such APOD.
+        """
+        with self.lock:
+            cursor = self.connection.execute(self.select_record_query, (apod_id,))
+            result = cursor.fetchone()
+        if result is None:
+            return None
+        return {column[0]: value for column, value in zip(cursor.description, result)}
+
+    def get_apod_id_from_sha256(self, image_sha256):
+        """Gets the record ID of the APOD having a specified SHA-256 hash value
+        Args:
+            image_sha256 (str): SHA-256 hash value of APOD image
+        Returns:
+            int: Record ID of the APOD, if it exists. Zero, if it does not.
+        """
+        return self.get_id(self.find_sha256_query, image_sha256)
+
+    def get_apod_id_from_date(self, apod_date):
+        """Gets the record ID of the APOD for a specified date
+        Args:
+            apod_date (date): APOD date (Can also be a string formatted as YYYY-MM-DD)
+        Returns:
+            int: Record ID of the APOD, if it exists. Zero, if it does not.
+        """
+        return self.get_id(self.find_date_query, date_to_text(apod_date))
+
+    def get_id(self, query, value):
+        """Runs a query that finds a single record ID
+        Args:
+            query (str): Query with a single parameter, selecting the id column
+            value: Value of the parameter
+        Returns:
+            int: Record ID, if one was found. Zero, if not.
+        """
+        with self.lock:
+            result = self.connection.execute(query, (value,)).fetchone()
+        if result is not None:
+            return result[0]
+        return 0
+
+    def get_cached_dates(self, start_date, end_date):
+        """Gets the dates between two dates (inclusive) that are in the DB
+        Args:
+            start_date (date): First date of the range
+            end_date (date): Last date of the range
+        Returns:
+            set: Cached dates, as date objects
+        """
+        with self.lock:
+            result = self.connection.execute(self.find_date_range_query,
+                                             (date_to_text(start_date), date_to_text(end_date))).fetchall()
+        return {date.fromisoformat(row[0]) for row in result}
+
+    def set_apod_date(self, apod_id, apod_date):
+        """Records the date of an APOD that does not have one yet.
+        Does nothing if the APOD already has a date, or another APOD has that date.
+        Args:
+            apod_id (int): ID of APOD in the DB
+            apod_date (date): APOD date (Can also be a string formatted as YYYY-MM-DD)
+        """
+        apod_date = date_to_text(apod_date)
+        with self.transaction() as cursor:
+            cursor.execute(self.set_date_query, (apod_date, apod_id, apod_date))
+
+    def get_apod_info(self, apod_id):
+        """Gets the title, explanation, and full path of an APOD
+        Args:
+            apod_id (int): ID of APOD in the DB
+        Returns:
+            dict: Dictionary of APOD information. None, if there is no such APOD.
+        """
+        with self.lock:
+            result = self.connection.execute(self.select_apod_query, (apod_id,)).fetchone()
+        if result is None:
+            return None
+        return {
+            'title': result[0],
+            'explanation': result[1],
+            'file_path': result[2],
+        }
+
+    def get_all_titles(self):
+        """Gets the titles of all APODs in the DB
+        Returns:
+            list: Titles of all APODs, each in a tuple of one
+        """
+        with self.lock:
+            return self.connection.execute(self.select_titles_query).fetchall()
+
+    def get_page(self, after_id=0, page_size=100):
+        """Gets one page of APODs, in ID order.
+        Pages are found by the last ID of the previous page (keyset pagination) rather than by counting rows,
+        so every page is a quick search of the primary key no matter how deep into the cache it is.
+        Args:
+            after_id (int, optional): Last ID of the previous page. Defaults to 0 (the first page).
+            page_size (int, optional): Most APODs on the page. Defaults to 100.
+        Returns:
+            list: (id, apod_date, title) of each APOD on the page. Fewer than page_size means it is the last page.
+        """
+        with self.lock:
+            return self.connection.execute(self.select_page_query, (after_id, page_size)).fetchall()
+
+    def search(self, text, limit=50):
+        """Finds the APODs whose title or explanation contain every word of a search.
+        The best matches come first. A word found in the title counts for more than one in the explanation.
+        Args:
+            text (str): Search text. The last word also matches words that start with it.
+            limit (int, optional): Most APODs to return. Defaults to 50.
+        Returns:
+            list: (id, apod_date, title) of each APOD found, best match first
+        """
+        query = make_search_query(text)
+        if query is None:
+            return []
+        with self.lock:
+            return self.connection.execute(self.search_query, (query, limit)).fetchall()
+
+    def get_existing_ids(self, apod_ids):
+        """Gets which of some APOD IDs are still in the DB, in one query
+        Args:
+            apod_ids (iterable[int]): IDs of APODs
+        Returns:
+            set: The IDs that are still in the DB
+        """
+        apod_ids = list(apod_ids)
+        if not apod_ids:
+            return set()
+        query = f"SELECT id FROM apod_image WHERE id IN ({', '.join('?' * len(apod_ids))});"
+        with self.lock:
+            return {apod_id for (apod_id,) in self.connection.execute(query, apod_ids)}
+
+    def get_all_records(self, columns=('id', 'path', 'sha256')):
+        """Gets some of the columns of every APOD, for jobs that have to go through the whole cache
+        Args:
+            columns (tuple, optional): Names of the columns to get. Defaults to id, path and sha256.
+        Returns:
+            list: The values of the columns for each APOD, as a tuple, in ID order
+        """
+        with self.lock:
+            return self.connection.execute(f"SELECT {', '.join(columns)} FROM apod_image ORDER BY id;").fetchall()
+
+    def record_access(self, apod_id):
+        """Records that an APOD was just used (viewed, or set as the desktop background)
+        Args:
+            apod_id (int): ID of APOD in the DB
+        """
+        with self.transaction() as cursor:
+            cursor.execute(self.record_access_query, (time.time(), apod_id))
+
+    def set_pinned(self, apod_id, pinned=True):
+        """Pins an APOD so it is never evicted, or unpins it
+        Args:
+            apod_id (int): ID of APOD in the DB
+            pinned (bool, optional): True to pin, False to unpin. Defaults to True.
+        """
+        with self.transaction() as cursor:
+            cursor.execute(self.set_pinned_query, (int(pinned), apod_id))
+
+    def get_total_size(self):
+        """Gets how much room the APOD images take up
+        Returns:
+            tuple[int, int]: Total size of the images in bytes, and the number of APODs
+        """
+        with self.lock:
+            return self.connection.execute(self.total_size_query).fetchone()
+
+    def get_unsized_records(self):
+        """Gets the APODs whose image size isn't known yet (they were cached before sizes were kept)
+        Returns:
+            list: (id, path) of each APOD
+        """
+        with self.lock:
+            return self.connection.execute(self.unsized_query).fetchall()
+
+    def get_eviction_candidates(self, policy='lru', keep_ids=()):
+        """Gets the APODs that are allowed to be evicted, in the order they should go
+        Args:
+            policy (str, optional): 'lru' (least recently used first) or 'lfu' (least often used first). Defaults to 'lru'.
+            keep_ids (iterable, optional): IDs of APODs that must not be evicted, on top of the pinned ones
+        Returns:
+            list: (id, path, sha256, size) of each APOD, first to be evicted first
+        """
+        if policy not in self.eviction_orders:
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        keep_ids = list(keep_ids)
+        exclude = f"AND id NOT IN ({', '.join('?' for apod_id in keep_ids)})" if keep_ids else ""
+        query = f"""
+        SELECT id, path, sha256, COALESCE(size, 0) FROM apod_image
+        WHERE pinned = 0 {exclude}
+        ORDER BY {self.eviction_orders[policy]};
+        """
+        with self.lock:
+            return self.connection.execute(query, keep_ids).fetchall()
+
+    def get_uncompacted_records(self, after_id=0, limit=1000):
+        """Gets the next APODs the compact command hasn't been through yet
+        Args:
+            after_id (int, optional): Only APODs with a higher ID than this. Defaults to 0.
+            limit (int, optional): Most APODs to get. Defaults to 1000.
+        Returns:
+            list: (id, path) of each APOD, in ID order
+        """
+        with self.lock:
+            return self.connection.execute(self.uncompacted_query, (after_id, limit)).fetchall()
+
+    def get_compaction_totals(self):
+        """Gets how much room the compact command has saved
+        Returns:
+            tuple[int, int, int]: Number of re-encoded images, their size as downloaded, and their size now, in bytes
+        """
+        with self.lock:
+            return self.connection.execute(self.compaction_totals_query).fetchone()
+
+    def delete_apod(self, apod_id):
+        """Removes an APOD from the DB (but not its image file), along with the dates that were skipped in its favour
+        Args:
+            apod_id (int): ID of APOD in the DB
+        """
+        with self.transaction() as cursor:
+            cursor.execute(self.delete_apod_query, (apod_id,))
+            cursor.execute(self.delete_aliases_query, (apod_id,))
+
+    def add_date_alias(self, apod_date, apod_id):
+        """Records that the APOD of a date is a near-duplicate of a cached APOD, so the date counts as cached
+        Args:
+            apod_date (date): APOD date (Can also be a string formatted as YYYY-MM-DD)
+            apod_id (int): ID of the cached APOD it looks like
+        """
+        with self.transaction() as cursor:
+            cursor.execute(self.add_alias_query, (date_to_text(apod_date), apod_id))
+
+    def get_phashes(self):
+        """Gets the perceptual hash of every APOD that has one
+        Returns:
+            list: (id, phash) of each APOD
+        """
+        with self.lock:
+            rows = self.connection.execute(self.select_phashes_query).fetchall()
+        return [(apod_id, phash_from_db(phash)) for apod_id, phash in rows]
+
+    def get_unhashed_records(self, after_id=0, limit=1000):
+        """Gets the next APODs that don't have a perceptual hash yet
+        Args:
+            after_id (int, optional): Only APODs with a higher ID than this. Defaults to 0.
+            limit (int, optional): Most APODs to get. Defaults to 1000.
+        Returns:
+            list: (id, path) of each APOD, in ID order
+        """
+        with self.lock:
+            return self.connection.execute(self.unhashed_query, (after_id, limit)).fetchall()
+
+    def set_phash(self, apod_id, phash):
+        """Records the perceptual hash of an APOD
+        Args:
+            apod_id (int): ID of APOD in the DB
+            phash (int): Perceptual hash of its image
+        """
+        with self.transaction() as cursor:
+            cursor.execute(self.set_phash_query, (phash_to_db(phash), apod_id))
+
+    def get_date_aliases(self):
+        """Gets the dates whose APOD wasn't stored because it was a near-duplicate of a cached one
+        Returns:
+            list: (apod_date, id of the cached APOD it looks like) of each date
+        """
+        with self.lock:
+            return self.connection.execute(self.select_aliases_query).fetchall()
+
+    def get_setting(self, key, default=None):
+        """Gets a setting of the cache from the cache_meta table
+        Args:
+            key (str): Name of the setting
+            default (str, optional): Value to use if the setting was never set. Defaults to None.
+        Returns:
+            str: Value of the setting
+        """
+        with self.lock:
+            result = self.connection.execute(self.get_setting_query, (key,)).fetchone()
+        if result is None:
+            return default
+        return result[0]
+
+    def set_setting(self, key, value):
+        """Changes a setting of the cache in the cache_meta table
+        Args:
+            key (str): Name of the setting
+            value (str): New value of the setting
+        """
+        with self.transaction() as cursor:
+            cursor.execute(self.set_setting_query, (key, value))
@@ -0,0 +1,402 @@
+'''
+Long-running mode of apod_desktop that keeps everything warm and fetches each new APOD as soon as it is published.
+'''
+#Running apod_desktop.py once a day means paying for starting Python, the imports, opening the cache and a cold
+#connection to NASA every time, all before the wallpaper changes. The daemon does all of that once and then stays
+#running. It checks for the new APOD shortly after it is published (midnight, US Eastern time), with some random
+#jitter so every copy of the daemon doesn't ask at the same second, and downloads it in the background. When the
+#wallpaper is due to switch, the image is already in the cache and switching is instant.
+#
+#While it runs, it listens on a local port for commands, one per line:
+#  status              - What the daemon is up to
+#  ingest YYYY-MM-DD   - Add the APOD of a date to the cache
+#  wallpaper YYYY-MM-DD - Set the APOD of a date as the wallpaper (adding it to the cache first if needed)
+#  stop                - Stop the daemon
+#Each command gets one line of JSON back. The port is only opened on 127.0.0.1, so only this computer can use it. Even
+#then, any program on this computer (a web page in a browser, say) could connect to it, so each connection has to
+#start with the line "token <key>". The daemon makes up a new key every time it starts and writes it to a file in the
+#image cache, which only the user running it can read. A connection that sends the wrong key, a line that's too long,
+#or a line that isn't a command is dropped.
+#
+#Usage:
+#  python apod_desktop.py daemon [--port port] [--switch-at HH:MM]
+#  python apod_desktop.py daemon-command command [date] [--port port]
+
+import argparse     #argparse reads the command line options
+import hmac         #The key is compared in constant time
+import json         #Commands are answered in JSON
+import os
+import random       #For the jitter
+import secrets      #Makes up the key commands have to start with
+import socket       #Sends commands to a daemon that's already running
+import socketserver #The daemon listens for commands with a small TCP server
+import sys
+import threading    #The command server runs on its own thread, and stop_event stops everything
+import time
+from datetime import date, datetime, time as day_time, timedelta, timezone
+import apod_api
+import apod_desktop
+from job_queue import JobQueue   #The downloads run in the background
+
+command_port = 59593            #Port the daemon listens for commands on
+command_names = ('status', 'ingest', 'wallpaper', 'stop')     #Commands the daemon answers
+publish_hour = 0                #Hour of the day (in publish_timezone) when the new APOD comes out
+poll_delay = 5 * 60             #Seconds after publish_hour to start looking for the new APOD
+poll_interval = 10 * 60         #Seconds between looks until it shows up
+poll_jitter = 3 * 60            #Most seconds added to (or taken from) each wait, so every daemon doesn't ask at once
+tick = 15                       #Seconds between checks of the schedule and the finished downloads
+max_line_length = 1024          #Most bytes in a line sent to the daemon
+command_timeout = 60            #Seconds a connection can sit idle before it is dropped
+
+stop_event = threading.Event()  #Set to stop the daemon
+ingest_jobs = None              #Downloads running in the background (JobQueue)
+switch_time = None              #Time of day (local) to switch the wallpaper. None switches as soon as the new APOD is in
+next_poll_time = 0.0            #When to next look for the new APOD (time.time())
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='apod_desktop.py daemon', description='Keep running and fetch each new APOD as it comes out.')
+    parser.add_argument('--port', type=int, default=command_port, help=f'local port to listen for commands on (default: {command_port})')
+    parser.add_argument('--switch-at', type=lambda text: day_time.fromisoformat(text), metavar='HH:MM',
+                        help='time of day to switch the wallpaper (default: as soon as the new APOD is in)')
+    args = parser.parse_args(sys.argv[2:])
+    run_daemon(args.port, args.switch_at)
+    return
+
+
+#Entrypoint of the daemon-command command, which sends a command to a daemon that's already running
+
+def command_main():
+    parser = argparse.ArgumentParser(prog='apod_desktop.py daemon-command', description='Send a command to a running daemon.')
+    parser.add_argument('command', choices=command_names)
+    parser.add_argument('date', nargs='?', help='APOD date for ingest and wallpaper (YYYY-MM-DD)')
+    parser.add_argument('--port', type=int, default=command_port, help=f'port the daemon listens on (default: {command_port})')
+    args = parser.parse_args(sys.argv[2:])
+
+    try:
+        reply = send_command(' '.join(word for word in (args.command, args.date) if word), args.port)
+    except OSError as error:
+        print(f"Error: Could not reach the daemon on port {args.port}: {error}")
+        sys.exit(1)
+    except ValueError as error:     #The daemon closed the connection without a whole answer
+        print(f"Error: The daemon on port {args.port} didn't answer properly: {error}")
+        sys.exit(1)
+    print(json.dumps(reply, indent=2))
+    if not reply.get('ok'):         #A rejected command (like a wrong key) fails, so scripts can tell
+        sys.exit(1)
+    return
+
+
+def run_daemon(port=None, switch_at=None):
+    """Runs the daemon until it is stopped (with the stop command or Ctrl+C).
+    Args:
+        port (int, optional): Port to listen for commands on. Defaults to command_port.
+        switch_at (datetime.time, optional): Time of day to switch the wallpaper. Defaults to as soon as the new APOD is in.
+    """
+    global ingest_jobs, switch_time, next_poll_time
+
+    apod_desktop.init_apod_cache(apod_desktop.get_script_dir())     #Opened once, and kept open
+    ingest_jobs = JobQueue(1)
+    switch_time = switch_at
+    next_poll_time = time.time()
+    stop_event.clear()
+
+    token = write_token()
+    server = start_command_server(command_port if port is None else port, token)
+    print(f"APOD daemon running, listening for commands on 127.0.0.1:{server.server_address[1]}")
+    try:
+        while not stop_event.is_set():
+            run_schedule()
+            stop_event.wait(tick)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        ingest_jobs.cancel_all()
+        try:
+            os.remove(get_token_path())     #The key is no good to anyone once the daemon stops
+        except OSError:
+            pass
+    print("APOD daemon stopped")
+    return
+
+
+#This function is one tick of the schedule: deal with finished downloads, look for the new APOD if it's time to, and
+#switch the wallpaper if it's due
+
+def run_schedule():
+    global next_poll_time
+
+    for job, event in ingest_jobs.get_events():
+        if event == 'done':
+            print(f"Finished {job.description} (APOD ID {job.result})")
+        elif event == 'failed':
+            print(f"Error! {job.description} failed: {job.error}")
+
+    if time.time() >= next_poll_time:
+        next_poll_time = time.time() + poll_for_new_apod()
+
+    switch_wallpaper_if_due()
+    return
+
+
+#This function looks for today's APOD. If it isn't in the cache yet, it starts downloading it and looks again in
+#poll_interval. Once it is in, the next look is just after the next one comes out
+
+def poll_for_new_apod():
+    """Starts downloading today's APOD, if it isn't in the cache yet.
+    Returns:
+        float: Seconds until the next look
+    """
+    apod_today = get_apod_today()
+    if apod_desktop.get_apod_id_from_date(apod_today) != 0:
+        return get_seconds_until_publish() + poll_delay + random.uniform(0, poll_jitter)
+
+    if not any(job.description == f"ingest {apod_today}" for job in ingest_jobs.get_active_jobs()):
+        apod_api.missing_dates.pop(apod_today.isoformat(), None)      #It may have been published since we last asked
+        ingest_jobs.submit(ingest_job, apod_today, False, description=f"ingest {apod_today}")
+    return max(poll_interval + random.uniform(-poll_jitter, poll_jitter), tick)
+
+
+#This function switches the wallpaper to today's APOD once it's in the cache (and, if there is a switch time, once
+#that time has come). It only switches once a day, so a wallpaper picked with the wallpaper command stays until the
+#next APOD. The cache remembers the last day it switched, so a restart doesn't switch again
+
+def switch_wallpaper_if_due():
+    if switch_time is not None and datetime.now().time() < switch_time:
+        return
+    apod_today = get_apod_today()
+    if apod_desktop.cache_store.get_setting('daemon_switch_date') == apod_today.isoformat():
+        return
+    apod_id = apod_desktop.get_apod_id_from_date(apod_today)
+    if apod_id == 0:
+        return
+    if apod_desktop.set_apod_as_desktop_background(apod_id):
+        print(f"Wallpaper switched to APOD ID {apod_id}")
+    apod_desktop.cache_store.set_setting('daemon_switch_date', apod_today.isoformat())     #Even if it failed, so it isn't tried every tick
+    return
+
+
+#The job the download queue runs to add an APOD, and maybe make it the wallpaper straight after
+
+def ingest_job(job, apod_date, set_wallpaper):
+    apod_id = apod_desktop.add_apod_to_cache(apod_date, cancel_event=job.cancel_event)
+    if apod_id != 0 and set_wallpaper:
+        apod_desktop.set_apod_as_desktop_background(apod_id)
+    return apod_id
+
+
+#The date of the newest APOD. NASA publishes on US Eastern time, so around midnight here it can still be yesterday
+#there (or already tomorrow)
+
+def get_publish_timezone():
+    """Gets the timezone NASA publishes the APOD in
+    Returns:
+        tzinfo: US Eastern time (or a fixed UTC-5 if the timezone database isn't installed)
+    """
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo('America/New_York')
+    except Exception:       #Windows doesn't come with the timezone database
+        return timezone(timedelta(hours=-5))
+
+
+def get_apod_today():
+    """Gets the date of the newest APOD
+    Returns:
+        date: Today's date in the publish timezone
+    """
+    return datetime.now(get_publish_timezone()).date()
+
+
+def get_seconds_until_publish():
+    """Gets how long until the next APOD comes out
+    Returns:
+        float: Seconds until the next publish_hour in the publish timezone
+    """
+    now = datetime.now(get_publish_timezone())
+    publish_time = now.replace(hour=publish_hour, minute=0, second=0, microsecond=0)
+    if publish_time <= now:
+        publish_time += timedelta(days=1)
+    return (publish_time - now).total_seconds()
+
+
+#The key commands have to start with. It lives in the image cache, so the daemon-command command (run by the same
+#user, from the same folder) can find it
+
+def get_token_path():
+    """Gets the full path of the file the daemon's key is in
+    Returns:
+        str: Full path of the key file
+    """
+    cache_dir = apod_desktop.image_cache_dir or apod_desktop.get_image_cache_dir(apod_desktop.get_script_dir())
+    return os.path.join(cache_dir, apod_desktop.daemon_token_name)
+
+
+def write_token():
+    """Makes up a new key and writes it to the key file, so that only the user running the daemon can read it
+    Returns:
+        str: The key
+    """
+    token = secrets.token_hex(32)
+    token_path = get_token_path()
+    try:
+        os.remove(token_path)       #So the file is made again with the permissions below, not an old file's
+    except OSError:
+        pass
+    with os.fdopen(os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as token_file:
+        token_file.write(token)
+    return token
+
+
+def read_token():
+    """Reads the key of the running daemon
+    Returns:
+        str: The key
+    Raises:
+        OSError: If there is no key file (the daemon isn't running)
+    """
+    with open(get_token_path()) as token_file:
+        return token_file.read().strip()
+
+
+#The command server. Each connection starts with the key, then sends one command per line and gets a line of JSON
+#back for each. Anything else gets one line of JSON with the error, and the connection is dropped
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    """Answers the commands sent to the daemon"""
+
+    timeout = command_timeout
+
+    def handle(self):
+        try:
+            words = self.read_words()
+            if words is None:
+                return
+            if len(words) != 2 or words[0] != 'token' or not hmac.compare_digest(words[1], self.server.token):
+                self.send_reply({'ok': False, 'error': 'wrong or missing token'})
+                return
+
+            while True:
+                words = self.read_words()
+                if words is None:
+                    return
+                self.send_reply(run_command(words))
+                if not words or words[0].lower() not in command_names:     #Probably not one of our clients, so don't read what else it sent
+                    return
+        except OSError:         #Timed out, or the other end went away
+            return
+
+    def read_words(self):
+        """Reads the next line
+        Returns:
+            list: The words in the line. None, if the connection is closed or the line was too long.
+        """
+        line = self.rfile.readline(max_line_length + 1)
+        if not line:
+            return None
+        if len(line) > max_line_length:
+            self.send_reply({'ok': False, 'error': f'line longer than {max_line_length} bytes'})
+            return None
+        return line.decode('utf-8', 'replace').split()
+
+    def send_reply(self, reply):
+        self.wfile.write((json.dumps(reply, default=str) + '\n').encode())
+
+
+class CommandServer(socketserver.ThreadingTCPServer):
+    """The TCP server the commands come in on"""
+
+    allow_reuse_address = sys.platform != 'win32'   #A restart can listen again straight away. On Windows this would let another program take over the port
+    daemon_threads = True
+
+    def __init__(self, address, token):
+        self.token = token      #The key each connection has to start with
+        super().__init__(address, CommandHandler)
+
+
+def start_command_server(port, token):
+    """Starts listening for commands on a background thread.
+    Args:
+        port (int): Port to listen on (0 for any free port)
+        token (str): The key each connection has to start with
+    Returns:
+        CommandServer: The server
+    """
+    server = CommandServer(('127.0.0.1', port), token)
+    threading.Thread(target=server.serve_forever, name='apod-daemon-commands', daemon=True).start()
+    return server
+
+
+def run_command(words):
+    """Runs a command sent to the daemon.
+    Args:
+        words (list): The command and its arguments
+    Returns:
+        dict: The answer
+    """
+    if not words:
+        return {'ok': False, 'error': 'empty command'}
+    command = words[0].lower()
+
+    if command == 'status':
+        return {
+            'ok': True,
+            'apod_today': get_apod_today(),
+            'today_cached': apod_desktop.get_apod_id_from_date(get_apod_today()) != 0,
+            'wallpaper_id': apod_desktop.cache_store.get_setting('wallpaper_id'),
+            'next_poll_in': round(max(next_poll_time - time.time(), 0)),
+            'jobs': [job.description for job in ingest_jobs.get_active_jobs()],
+        }
+
+    if command == 'stop':
+        stop_event.set()
+        return {'ok': True}
+
+    if command in ('ingest', 'wallpaper'):
+        try:
+            apod_date = date.fromisoformat(words[1])
+        except (IndexError, ValueError):
+            return {'ok': False, 'error': f'{command} needs a date (YYYY-MM-DD)'}
+        if not apod_api.first_apod_date <= apod_date <= get_apod_today():
+            return {'ok': False, 'error': f'there is no APOD for {apod_date}'}
+
+        apod_id = apod_desktop.get_apod_id_from_date(apod_date)
+        if command == 'wallpaper' and apod_id != 0:     #Already cached, so it's switched right away
+            return {'ok': apod_desktop.set_apod_as_desktop_background(apod_id), 'apod_id': apod_id}
+        if command == 'ingest' and apod_id != 0:
+            return {'ok': True, 'apod_id': apod_id}
+        job = ingest_jobs.submit(ingest_job, apod_date, command == 'wallpaper', description=f"{command} {apod_date}")
+        return {'ok': True, 'queued': job.id}
+
+    return {'ok': False, 'error': f'unknown command: {command}'}
+
+
+#This function sends a command to a running daemon and waits for the answer
+
+def send_command(command, port=None, timeout=10, token=None):
+    """Sends a command to a running daemon.
+    Args:
+        command (str): The command, e.g. 'ingest 2023-04-09'
+        port (int, optional): Port the daemon listens on. Defaults to command_port.
+        timeout (float, optional): Seconds to wait for the answer. Defaults to 10.
+        token (str, optional): The daemon's key. Read from the key file if not provided.
+    Returns:
+        dict: The answer
+    Raises:
+        OSError: If the daemon could not be reached (or there is no key file)
+        ValueError: If the answer was empty or cut short
+    """
+    if token is None:
+        token = read_token()
+    with socket.create_connection(('127.0.0.1', command_port if port is None else port), timeout=timeout) as connection:
+        connection.sendall(f'token {token}\n{command}\n'.encode())
+        connection.shutdown(socket.SHUT_WR)
+        reply = connection.makefile('rb').readline()
+    if not reply:
+        raise ValueError('the connection was closed without an answer')
+    reply = json.loads(reply)       #A JSONDecodeError is a ValueError
+    if not isinstance(reply, dict):
+        raise ValueError('the answer is not a JSON object')
+    return reply
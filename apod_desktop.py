@@ -5,25 +5,70 @@ Description:
   and sets it as the desktop background image.
 Usage:
   python apod_desktop.py [apod_date]
+  python apod_desktop.py --from start_date [--to end_date]
+  python apod_desktop.py migrate-layout
+  python apod_desktop.py search words...
+  python apod_desktop.py gc [--budget size] [--policy lru|lfu] [--pin id] [--unpin id] [--dry-run]
+  python apod_desktop.py compact [--format webp|jpeg] [--quality quality] [--min-quality quality] [--workers count] [--limit count]
+  python apod_desktop.py dedup [--policy keep|skip] [--distance bits] [--workers count] [--limit count] [--list]
+  python apod_desktop.py revalidate [apod_date...]
+  python apod_desktop.py fsck [--quick] [--repair] [--prune] [--workers count]
+  python apod_desktop.py export bundle_path
+  python apod_desktop.py import bundle_path [--workers count] [--limit count]
+  python apod_desktop.py sync source_path [--workers count] [--limit count]
+  python apod_desktop.py daemon [--port port] [--switch-at HH:MM]
+  python apod_desktop.py daemon-command status|ingest|wallpaper|stop [apod_date] [--port port]
+  Set APOD_METRICS_LOG (JSON log) and/or APOD_METRICS_PROM (Prometheus textfile) to the path of a file to record
+  how long each stage of adding APODs to the cache takes.
+  Set APOD_WALLPAPER_BACKEND to windows, gsettings, feh, sway or fake to choose how the wallpaper is set, instead of
+  the one that suits the desktop.
 Parameters:
   apod_date = APOD date (format: YYYY-MM-DD)
+  start_date = First APOD date to add to the cache (format: YYYY-MM-DD)
+  end_date = Last APOD date to add to the cache (format: YYYY-MM-DD). Defaults to today.
+  words = Words to search the titles and explanations of the cached APODs for
+  size = Most room the cached images can take up, in bytes (or with KB, MB or GB). It is saved with the cache.
+  bundle_path = Zip file the cached APODs are exported to, or imported from
+  source_path = Image cache of another computer (e.g. on a network share), or a bundle, to copy the APODs this cache is missing from
 """
 
-from datetime import date       #We need datetime for selecting APOD dates
-import hashlib                  #Hashlib generates hashes for comparison and for our database tables
+from datetime import date, timedelta       #We need datetime for selecting APOD dates
+import argparse                 #argparse reads the --from/--to options for backfilling
+import itertools                #itertools lets us take APODs a batch at a time
 import os        
+import time                     #Time tells us how old leftover downloads are
+import threading                #The near-duplicate index is shared by the viewer's and the daemon's worker threads
 import re               #We only use re for a small regex for seperating a name from the file extension
 from apod_api import get_apod_image_url         #We need this function to get the URL specifically
 from apod_api import get_apod_info as get_apod_info_api     #Need this for apod info gathering
+from apod_api import get_apod_info_range        #Need this for getting many APODs at once when backfilling
+from apod_api import is_known_missing           #Dates the API recently said have no APOD aren't asked for again
 import image_lib                #Image library is needed for all of our image needs
 import inspect                  #inspect is only used a few times to get the full path of the script
 import sys
-import sqlite3                  #Sqlite3 is for interacting with our database
+import apod_cache               #The cache store keeps our database open and does all the queries
+import apod_metrics             #Times each stage of adding an APOD to the cache
+import phash_lib                #Perceptual hashes find images we already have at another size or quality
 
 
 # Global variables
 image_cache_dir = None  # Full path of image cache directory
 image_cache_db = None   # Full path of image cache database
+cache_store = None      # Open image cache database (apod_cache.ApodCacheStore)
+image_cache_layout = 'title'    # How image files are named: 'title' (after the APOD title) or 'sha256' (content-addressed)
+preview_cache = None    # Viewer-sized previews of the cached images (image_lib.PreviewCache)
+preview_cache_budget = 200 * 1024 * 1024    # Most bytes the previews can take up on disk
+image_cache_budget = 0         # Most bytes the cached images can take up before the least used are evicted (0 for no limit, until gc --budget sets one)
+image_cache_eviction = 'lru'    # Which APODs are evicted first: 'lru' (least recently used) or 'lfu' (least often used)
+image_compact_format = 'webp'   # Format the compact command re-encodes the cached images to: 'webp' or 'jpeg'
+image_compact_quality = 80      # Quality the compact command encodes at
+image_compact_quality_floor = 70    # Lowest quality the compact command ever encodes at
+near_duplicate_distance = 6     # Most bits two perceptual hashes can differ in for the images to be near-duplicates
+near_duplicate_policy = 'keep'  # What to do with a new APOD that is a near-duplicate: 'keep' it anyway, or 'skip' storing it
+phash_index = None      # Perceptual hashes of the cached images (phash_lib.HashIndex). Loaded the first time it's needed
+phash_index_lock = threading.Lock()     # Held while the index is loaded or changed, so no thread loads a second one or misses an update
+fsck_batch_size = 256   # Number of images each process of the fsck command checks at a time
+daemon_token_name = 'daemon_token'  # File in the image cache directory with the key every command sent to the daemon must start with
 
 def main():
     ## DO NOT CHANGE THIS FUNCTION ##
@@ -47,6 +92,63 @@ def main():
         image_lib.set_desktop_background_image(apod_info['file_path'])
 
 
+#This is the other entrypoint, used when --from (and optionally --to) is given. Instead of one date per run,
+#it fills the cache with every APOD in the range in a single run of the script
+
+def backfill_main():
+    """Adds every APOD between the dates given with --from and --to to the cache"""
+    start_date, end_date = get_backfill_dates()
+    script_dir = get_script_dir()
+    init_apod_cache(script_dir)
+    backfill_apod_cache(start_date, end_date)
+
+
+#This function reads the --from and --to options. It follows the same rules as get_apod_date, where the dates
+#must be valid and cannot be in the future
+
+def get_backfill_dates():
+    """Gets the range of APOD dates to backfill from the command line
+    Prints an error message and exits script if a date is invalid.
+    Uses today's date as the end of the range if --to is not provided.
+    Returns:
+        tuple[date, date]: First and last APOD dates of the range
+    """
+    parser = argparse.ArgumentParser(description='Adds a range of APODs to the image cache')
+    parser.add_argument('--from', dest='start_date', type=date.fromisoformat, required=True, help='First APOD date (YYYY-MM-DD)')
+    parser.add_argument('--to', dest='end_date', type=date.fromisoformat, default=date.today(), help='Last APOD date (YYYY-MM-DD)')
+    args = parser.parse_args()      #argparse prints the error and exits by itself if a date can't be read
+
+    if args.end_date > date.today():        #Same rule as a single date, the range can't go past today
+        print("Error: The date must be in the past or today: " + args.end_date.isoformat())
+        sys.exit()
+
+    if args.start_date > args.end_date:     #And the range must actually go forwards
+        print("Error: The start date must be before the end date: " + args.start_date.isoformat())
+        sys.exit()
+
+    return args.start_date, args.end_date
+
+
+#The backfill gets the APOD information in big chunks using the start_date/end_date mode of the API, and
+#sends the records through add_apods_to_cache so we don't need to ask the API again for each day
+
+def backfill_apod_cache(start_date, end_date):
+    """Adds every APOD between two dates (inclusive) to the image cache.
+    Args:
+        start_date (date): First APOD date of the range
+        end_date (date): Last APOD date of the range
+    Returns:
+        list: Record IDs of the APODs that were added to (or already in) the cache
+    """
+    apod_ids = []
+    for apod_info, apod_id in add_apods_to_cache(get_missing_apod_infos(start_date, end_date)):   #The images download side by side as the records stream in
+        if apod_id != 0:
+            apod_ids.append(apod_id)
+
+    print(f"Backfill complete: {len(apod_ids)} APODs in cache from {start_date.isoformat()} to {end_date.isoformat()}")
+    return apod_ids
+
+
 #This function gets the APOD date. It is then tossed to other python functions in order
 #to get more data as to where to download it and the info it contains. It queries the API
 #for the selective date given in argv1 in which it will later be stored into the Database
@@ -103,7 +205,8 @@ def init_apod_cache(parent_dir):
     """Initializes the image cache by:
     - Determining the paths of the image cache directory and database,
     - Creating the image cache directory if it does not already exist,
-    - Creating the image cache database if it does not already exist.
+    - Creating the image cache database if it does not already exist,
+    - Upgrading the image cache database to the latest schema.
     
     The image cache directory is a subdirectory of the specified parent directory.
     The image cache database is a sqlite database located in the image cache directory.
@@ -112,8 +215,13 @@ def init_apod_cache(parent_dir):
     """
     global image_cache_dir  #Since the cache dir might be modified in the future, let's global it
     global image_cache_db       #Same with the database
+    global cache_store          #And the open connection to it
+    global image_cache_layout   #And the way this cache names its image files
+    global preview_cache        #And the previews the viewer shows
+    global image_cache_budget, image_cache_eviction     #And how big the cache is allowed to get
+    global near_duplicate_policy, near_duplicate_distance, phash_index     #And what counts as a near-duplicate
 
-    image_cache_dir = os.path.join(parent_dir, "imgcache\\") #Get the full path of the cache directory
+    image_cache_dir = get_image_cache_dir(parent_dir) #Get the full path of the cache directory
     
     #If the cache folder does not exist, create it
 
@@ -123,46 +231,68 @@ def init_apod_cache(parent_dir):
     else:
         print("Image cache directory already exists: " + image_cache_dir)
         
+    remove_stale_downloads()        #Clean up after any run that crashed part way through a download
+
     image_cache_db = os.path.join(image_cache_dir, "image_cache.db")  #Get the full path of the cache directory
     
     
-    #If the cache DB does not exist, create it
+    #If the cache DB does not exist, create it. Either way, the cache store brings its tables up to date when it opens it
 
-    if os.path.exists(image_cache_db) == False:
-        connectus = sqlite3.connect(image_cache_db)     #Set up our connection using sqlite3
-        cursor = connectus.cursor()         #initalize our cursor
-        
+    db_exists = os.path.exists(image_cache_db)
+    if cache_store is not None:         #Initializing again (maybe somewhere else) closes the old DB first
+        cache_store.close()
+    cache_store = apod_cache.ApodCacheStore(image_cache_db)
+    image_cache_layout = cache_store.get_setting('layout', 'title')    #Each cache remembers its own layout
+    image_cache_budget = int(cache_store.get_setting('budget', image_cache_budget))     #And its own budget, if gc was given one
+    image_cache_eviction = cache_store.get_setting('eviction', image_cache_eviction)
+    near_duplicate_policy = cache_store.get_setting('near_duplicate_policy', near_duplicate_policy)
+    near_duplicate_distance = int(cache_store.get_setting('near_duplicate_distance', near_duplicate_distance))
+    phash_index = None      #The hashes of the old cache don't belong to this one
 
-        #For our apod_table, we need to make sure we get the title, explanation (description), the ID (for identification)
-        #and the hash. The values must not be blank
-
-        create_apod_table_sql = """
-        CREATE TABLE IF NOT EXISTS apod_image
-        (
-            id INTEGER PRIMARY KEY,
-            title TEXT NOT NULL,
-            explanation TEXT NOT NULL,
-            path TEXT NOT NULL,
-            sha256 TEXT NOT NULL
-        );
-        """
-        
-        cursor.execute(create_apod_table_sql)           #Execute our query
-        
-        connectus.commit()                      #Commit the changes and exit
-        connectus.close()
+    preview_cache = image_lib.PreviewCache(os.path.join(image_cache_dir, "previews"), preview_cache_budget)
+    image_lib.wallpaper_dir = os.path.join(image_cache_dir, "wallpapers")     #The wallpaper is rendered to the size of the screen in here
+    if db_exists == False:
         print("Image cache DB created: " + image_cache_db) 
     else:
         print("Image cache DB already exists: " + image_cache_db)
     return
-        
+
+
+def get_image_cache_dir(parent_dir):
+    """Gets the full path of the image cache directory in a parent directory, without opening the cache
+    Args:
+        parent_dir (str): Full path of parent directory
+    Returns:
+        str: Full path of the image cache directory
+    """
+    return os.path.join(parent_dir, "imgcache\\")
+
+
+#Downloads go into temporary .part files in the cache directory until they are finished. If a run crashes (or the
+#computer turns off) halfway through, the .part file is left behind so the next run can resume it. This function
+#deletes the ones that have sat untouched long enough that nobody is going to finish them
+
+def remove_stale_downloads(max_age=24 * 60 * 60):
+    """Deletes temporary download files left in the image cache directory by runs that never finished.
+    Args:
+        max_age (float, optional): Age in seconds after which a temporary file is stale. Defaults to one day.
+    """
+    for file_name in os.listdir(image_cache_dir):
+        if file_name.endswith(('.part', '.part.json', '.part.lock')):      #A lock this old belongs to a run that crashed
+            file_path = os.path.join(image_cache_dir, file_name)
+            try:
+                if time.time() - os.path.getmtime(file_path) > max_age:
+                    os.remove(file_path)
+            except OSError:         #Someone else got to it first
+                pass
+    return
 
 
 #Here is where we take the selected APOD_date from earlier and add it to the cache
 #We download using the apod_api and image_lib. The hashes are compared to check if the
 #file is already in the cache. After that, it is added to the cache
 
-def add_apod_to_cache(apod_date):
+def add_apod_to_cache(apod_date, apod_info=None, progress=None, cancel_event=None):
     """Adds the APOD image from a specified date to the image cache.
      
     The APOD information and image file is downloaded from the NASA API.
@@ -170,6 +300,9 @@ def add_apod_to_cache(apod_date):
     image cache and the APOD information is added to the image cache DB.
     Args:
         apod_date (date): Date of the APOD image
+        apod_info (dict, optional): APOD info already fetched from the API. Fetched if not provided.
+        progress (callable, optional): Called as progress(bytes_done, bytes_total) while the image downloads
+        cancel_event (threading.Event, optional): Stops the download when set
     Returns:
         int: Record ID of the APOD in the image cache DB, if a new APOD is added to the
         cache successfully or if the APOD already exists in the cache. Zero, if unsuccessful.
@@ -178,52 +311,305 @@ def add_apod_to_cache(apod_date):
     
     print("APOD date:", apod_date.isoformat())  #Print the date from argv 1 (for debugging)
 
-    apod_info = get_apod_info_api(apod_date)            #Get info about it
-    
-    apod_image_url = get_apod_image_url(apod_info)       #Use the image_url function to download the image
-    image_data = image_lib.download_image(apod_image_url)       #Download the image using image_lib with the url
+    apod_id = get_apod_id_from_date(apod_date)     #If we already have this date, there is no need to touch the network at all
+    if apod_id != 0:
+        print("APOD already exists in cache")
+        return apod_id
+
+    if apod_info is None:       #Only ask the API if we weren't already given the info (backfills get it in bulk)
+        apod_info = get_apod_info_api(apod_date)            #Get info about it
+        if apod_info is None:
+            return 0
+
+    apod_image_url = resolve_apod_image_url(apod_info)       #Use the image_url function to download the image
+    if apod_image_url is None:          #Some APODs are neither an image or a video with a thumbnail, so there is nothing to download
+        print("APOD has no image to download")
+        return 0
+
+    if cancel_event is not None and cancel_event.is_set():     #Cancelled while we were asking the API
+        return 0
+
+    image_download = image_lib.download_image_to_file(apod_image_url, image_cache_dir,       #Stream the image into a temporary file in the cache
+                                                      progress=progress, cancel_event=cancel_event)
+    apod_id = save_apod_to_cache(apod_info, apod_image_url, image_download)
+    if apod_id != 0:
+        evict_apod_cache(keep_ids=[apod_id])        #Make room for it, without throwing out the APOD we just got
+    return apod_id
+
+
+#This is the many-at-once version of add_apod_to_cache. The images are handed to the download engine in image_lib
+#so several download at the same time, and each one is saved to the cache as soon as it finishes
+
+def add_apods_to_cache(apod_infos, batch_size=100):
+    """Adds the APOD images for many APODs to the image cache, downloading
+    several images at the same time.
+    Args:
+        apod_infos (iterable[dict]): APOD info from the API for each APOD to add
+        batch_size (int, optional): Number of APODs handed to the download engine at once. Defaults to 100.
+    Yields:
+        tuple[dict, int]: APOD info and record ID (zero, if unsuccessful) of each APOD, a batch at a time
+    """
+    apod_infos = iter(apod_infos)
+    while True:
+        batch = list(itertools.islice(apod_infos, batch_size))     #Only take a batch at a time so a huge range isn't all in memory
+        if not batch:
+            return
+
+        #Group the APODs by image URL. Anything already cached or without an image is done straight away
+
+        infos_by_url = {}
+        for apod_info in batch:
+            apod_id = get_apod_id_from_date(apod_info['date'])     #Dates we already have are done without downloading anything
+            if apod_id != 0:
+                yield apod_info, apod_id
+                continue
+
+            apod_image_url = resolve_apod_image_url(apod_info)
+            if apod_image_url is None:
+                print("APOD has no image to download: " + apod_info['date'])
+                yield apod_info, 0
+            else:
+                infos_by_url.setdefault(apod_image_url, []).append(apod_info)
+
+        #Each APOD is saved (in its own short transaction) as soon as its download finishes. The DB is never held
+        #while the network is waited on, so the viewer and the daemon can still write to it, and a row is never
+        #rolled back after its image was moved into place. When several dates share an image URL, there is only
+        #one downloaded file: it is saved for the first date, and the other dates become aliases of that APOD
+
+        results = []
+        for apod_image_url, image_download in image_lib.download_images(infos_by_url, download_dir=image_cache_dir):
+            first_info, *other_infos = infos_by_url[apod_image_url]
+            print("APOD date:", first_info['date'])
+            apod_id = save_apod_to_cache(first_info, apod_image_url, image_download)
+            results.append((first_info, apod_id))
+            for apod_info in other_infos:
+                print("APOD date:", apod_info['date'])
+                if apod_id != 0:
+                    cache_store.add_date_alias(apod_info['date'], apod_id)
+                    print("APOD has the same image as " + first_info['date'])
+                results.append((apod_info, apod_id))
+        evict_apod_cache(keep_ids=[apod_id for apod_info, apod_id in results if apod_id != 0])
+        yield from results
+
+
+#Working out the image URL is its own stage of adding an APOD, so it is timed here
+
+def resolve_apod_image_url(apod_info):
+    """Gets the URL of the image of an APOD. See apod_api.get_apod_image_url.
+    Args:
+        apod_info (dict): Dictionary of APOD info from the API
+    Returns:
+        str: APOD image URL. None, if the APOD has no image.
+    """
+    with apod_metrics.stage('resolve_url', date=apod_info.get('date')) as resolve_stage:
+        apod_image_url = get_apod_image_url(apod_info)
+        if apod_image_url is None:
+            resolve_stage.outcome = 'no_image'
+    return apod_image_url
+
+
+#This function does the second half of adding an APOD to the cache. Once the image is downloaded, the hashes are
+#compared and the image is only moved to its real path (and added to the DB) if it isn't already in the cache
+
+def save_apod_to_cache(apod_info, apod_image_url, image_download):
+    """Saves a downloaded APOD image to the image cache, unless it is already there.
+    Args:
+        apod_info (dict): Dictionary of APOD info from the API
+        apod_image_url (str): URL the image was downloaded from
+        image_download (dict): Temporary file from image_lib.download_image_to_file (None, if the download failed)
+    Returns:
+        int: Record ID of the APOD in the image cache DB. Zero, if unsuccessful.
+    """
+    if image_download is None:
+        print("Failed to download image from " + apod_image_url)
+        return 0
     print("Downloaded image from " + apod_image_url) 
     
     
 
-    #Now we must compare the hashes to ensure we actually have the file and it doesn't match something already in the cache
+    #Now we must compare the hashes to ensure we actually have the file and it doesn't match something already in the cache.
+    #The hash was worked out while the image downloaded, so there is nothing more to read
     
-    image_hash = hashlib.sha256(image_data).hexdigest()         #To do, we generate a hash for the data from the image
+    image_hash = image_download['sha256']
     print("APOD SHA-256: " + str(image_hash))       #Print it for debugging
     
 
 
-    apod_id = get_apod_id_from_db(image_hash)  #Search the database for a matching hash to what was generated
+    with apod_metrics.stage('dedup_lookup', date=apod_info['date']) as dedup_stage:
+        apod_id = get_apod_id_from_db(image_hash)  #Search the database for a matching hash to what was generated
+        dedup_stage.outcome = 'new' if apod_id == 0 else 'duplicate'
     if  apod_id == 0:                               #If it doesn't exist, create it
-        
+
+        #The bytes are new, but the picture might not be. If it looks like one we already have, say so, and with the
+        #'skip' policy don't store it at all (its date then counts as cached, as the APOD it looks like)
+
+        with apod_metrics.stage('phash', date=apod_info['date']) as phash_stage:
+            image_phash = phash_lib.get_image_dhash(image_download['path'])
+            near_duplicates = find_near_duplicates(image_phash) if image_phash is not None else []
+            phash_stage.outcome = 'failed' if image_phash is None else 'near_duplicate' if near_duplicates else 'new'
+        if near_duplicates:
+            distance, duplicate_id = near_duplicates[0]
+            print(f"APOD looks like cached APOD {duplicate_id} ({distance} bits different)")
+            if near_duplicate_policy == 'skip':
+                os.remove(image_download['path'])
+                cache_store.add_date_alias(apod_info['date'], duplicate_id)
+                return duplicate_id
+
         apod_image_path = determine_apod_file_path(     #Get the file path of the downloaded file using the title from gathered info, as well as the url
                 apod_info['title'],
-                apod_image_url
+                apod_image_url,
+                image_hash
                 )
-        # Save the APOD file to the image cache directory
+        # Move the APOD file into place in the image cache directory
         print("APOD does not exist in cache")
-        image_lib.save_image_file(image_data, apod_image_path)  #Save the image using image.lib
+        with apod_metrics.stage('file_move', date=apod_info['date']) as move_stage:
+            move_stage.bytes = image_download['size']
+            if not image_lib.move_image_file(image_download['path'], apod_image_path):
+                move_stage.outcome = 'failed'
+                os.remove(image_download['path'])
+                return 0
         
         #For the APOD ID, we combine everything we have found into an entry for the DB
-        apod_id = add_apod_to_db(
-            apod_info['title'],
-            apod_info['explanation'],
-            apod_image_path,
-            image_hash
-        )
+        with apod_metrics.stage('db_insert', date=apod_info['date']):
+            apod_id = add_apod_to_db(
+                apod_info['title'],
+                apod_info['explanation'],
+                apod_image_path,
+                image_hash,
+                apod_info['date'],
+                apod_image_url,
+                image_download['etag'],
+                image_download['last_modified'],
+                image_download['size'],
+                image_phash
+            )
+        update_phash_index(apod_id, image_phash)
+
+        with apod_metrics.stage('preview', date=apod_info['date']) as preview_stage:
+            if preview_cache.add(image_hash, apod_image_path) is None:     #Make the viewer's preview now, while the image is fresh in the disk cache
+                preview_stage.outcome = 'failed'
         
         return apod_id  #Return the ID we created
         
         
     else:
         print("APOD already exists in cache")
+        os.remove(image_download['path'])      #We already have these exact bytes, so the download isn't needed
+        set_apod_date_in_db(apod_id, apod_info['date'])    #Rows from older caches don't know their date yet
+        if get_apod_id_from_date(apod_info['date']) == 0:  #The APOD has another date already, so this one becomes an alias of it
+            cache_store.add_date_alias(apod_info['date'], apod_id)
         return apod_id
 
 
+#This function checks whether the image of a cached APOD has changed on the server. The ETag and Last-Modified we
+#saved when it was downloaded go along with the request, so if nothing has changed the server only answers
+#304 Not Modified instead of sending the whole image again
+
+def revalidate_apod_image(apod_id):
+    """Re-downloads the image of a cached APOD, but only if it changed on the server.
+    Args:
+        apod_id (int): ID of APOD in the DB
+    Returns:
+        bool: True, if the cached image is current (or was updated). False, if it could not be checked (or updated).
+    """
+    apod_record = cache_store.get_apod_record(apod_id)
+    if apod_record is None or apod_record['image_url'] is None:     #Cached before we kept the URL, so there is nothing to check against
+        return False
+
+    image_download = image_lib.download_image_to_file(apod_record['image_url'], image_cache_dir,
+                                                      etag=apod_record['etag'], last_modified=apod_record['last_modified'])
+    if image_download is None:
+        return False
+
+    if image_download.get('not_modified'):
+        print("APOD image is up to date: " + apod_record['title'])
+        return True
+
+    #The server sent the image again. If the bytes are the same, only the validators changed. If they are different,
+    #the new image replaces the old file. But if the new image is one another APOD already has, it isn't kept, and
+    #neither are its validators, or the next check would be told 304 for an image this APOD doesn't have
+
+    if image_download['sha256'] == apod_record['sha256']:
+        os.remove(image_download['path'])
+        cache_store.update_apod(apod_id, {'etag': image_download['etag'], 'last_modified': image_download['last_modified']})
+        print("APOD image is up to date: " + apod_record['title'])
+    elif get_apod_id_from_db(image_download['sha256']) == 0:
+        if not replace_apod_image(apod_record, image_download):
+            return False
+        print("APOD image updated: " + apod_record['title'])
+    else:
+        os.remove(image_download['path'])
+        print("APOD image changed to the image of another cached APOD, not updated: " + apod_record['title'])
+        return False
+    return True
+
+
+#This function puts a freshly downloaded image in place of the one an APOD had, for revalidate_apod_image and the
+#fsck command. A compacted image is replaced by the image as it was downloaded, under its own extension
+
+def replace_apod_image(apod_record, image_download):
+    """Moves a downloaded image into the cache as the image of an APOD, and updates its row to match.
+    Args:
+        apod_record (dict): Every column of the APOD, from cache_store.get_apod_record
+        image_download (dict): What image_lib.download_image_to_file gave back
+    Returns:
+        bool: True, if successful. False, if unsuccessful (the download is deleted).
+    """
+    image_path = apod_record['path']
+    if apod_record['compact_format'] not in (None, 'original'):    #The old image was re-encoded, the new one goes back under its own extension
+        image_path = os.path.splitext(image_path)[0] + '.' + apod_record['image_url'].split('.')[-1]
+    if not image_lib.move_image_file(image_download['path'], image_path):
+        os.remove(image_download['path'])
+        return False
+    if image_path != apod_record['path'] and os.path.exists(apod_record['path']):
+        os.remove(apod_record['path'])
+
+    cache_store.update_apod(apod_record['id'], {
+        'path': image_path, 'sha256': image_download['sha256'], 'size': image_download['size'],
+        'etag': image_download['etag'], 'last_modified': image_download['last_modified'],
+        'compact_format': None, 'original_size': None, 'file_sha256': None})
+    image_phash = phash_lib.get_image_dhash(image_path)
+    cache_store.set_phash(apod_record['id'], image_phash)
+    update_phash_index(apod_record['id'], image_phash)      #The old hash would still find the old image
+    preview_cache.remove(apod_record['sha256'])         #The old preview may be of another image
+    return True
+
+
+#A backfill only needs to ask the API about the days that aren't cached yet. This function splits the range into
+#runs of missing days and gets each run with the start_date/end_date mode
+
+def get_missing_apod_infos(start_date, end_date):
+    """Gets the APOD information from the API for the dates between two dates
+    (inclusive) that are not in the image cache yet (or known to have no APOD).
+    Args:
+        start_date (date): First APOD date of the range
+        end_date (date): Last APOD date of the range
+    Yields:
+        dict: Dictionary of APOD info for each missing date, oldest first
+    """
+    cached_dates = get_cached_apod_dates(start_date, end_date)
+
+    run_start = None            #First day of the current run of missing days
+    day = start_date
+    while day <= end_date:
+        if day in cached_dates or is_known_missing(day):
+            if run_start is not None:       #The run ended yesterday
+                yield from get_apod_info_range(run_start, day - timedelta(days=1))
+                run_start = None
+        elif run_start is None:
+            run_start = day
+        day += timedelta(days=1)
+
+    if run_start is not None:
+        yield from get_apod_info_range(run_start, end_date)
+    return
+
+
 #This function will add apod data to the database using other functions to gather each of the parameter data
 #It gets the information from the apod_date which is found on the URL, and is saved to cover for the file_path
 
-def add_apod_to_db(title, explanation, file_path, sha256):
+def add_apod_to_db(title, explanation, file_path, sha256, apod_date=None, image_url=None, etag=None, last_modified=None,
+                   size=None, phash=None):
     """Adds specified APOD information to the image cache DB.
      
     Args:
@@ -231,36 +617,17 @@ def add_apod_to_db(title, explanation, file_path, sha256):
         explanation (str): Explanation of the APOD image
         file_path (str): Full path of the APOD image file
         sha256 (str): SHA-256 hash value of APOD image
+        apod_date (date, optional): Date of the APOD image (Can also be a string formatted as YYYY-MM-DD)
+        image_url (str, optional): URL the image was downloaded from
+        etag (str, optional): ETag the server sent with the image
+        last_modified (str, optional): Last-Modified the server sent with the image
+        size (int, optional): Size of the image file in bytes
+        phash (int, optional): Perceptual hash of the image
     Returns:
         int: The ID of the newly inserted APOD record, if successful.  Zero, if unsuccessful       
     """
-    
-    apod_id = get_apod_id_from_db(sha256)   #Get the apod ID from the function
-    if apod_id != 0:        #If it is not empty
-        return apod_id      #Just return the id
-    
-    connectus = sqlite3.connect(image_cache_db)     #Initalize our connection
-    cursor = connectus.cursor()                     #Initalize our cursor
-    
-    
-    #For the APOD query, we just fill in the title, explanation, etc.
-    #The wildcards (?) mean any data suited for the type can be inputted as the value
+    return cache_store.add_apod(title, explanation, file_path, sha256, apod_date, image_url, etag, last_modified, size, phash)   #The store checks the hash first, so nothing is added twice
 
-    add_apod_query = """
-    INSERT INTO apod_image (title, explanation, path, sha256)
-    VALUES (?, ?, ?, ?);
-    """
-    
-    apod = (title, explanation, file_path, sha256)  #We use this data to get the apod data
-    
-    cursor.execute(add_apod_query, apod)        #Execute the query and add our apod to the cache
-    
-    connectus.commit()      #commit and exit
-    connectus.close() 
-    
-    
-    return cursor.lastrowid #Return the ID
-    
 
 #Since we gather information to add to the cache, we need to get the id
 #from the database when needed. This function is an easily method of this
@@ -274,37 +641,108 @@ def get_apod_id_from_db(image_sha256):
     Returns:
         int: Record ID of the APOD in the image cache DB, if it exists. Zero, if it does not.
     """
-    connectus = sqlite3.connect(image_cache_db) #Initiate our connection
-    cursor = connectus.cursor()         #Initialize our cursor
-    
-    #To find the ID, we find at least one that matches a hash. This
-    #is to make sure there are no malformed or duplicates (there shouldn't be)
-    
-    find_apod_query = """
-    SELECT id FROM apod_image WHERE sha256 = ?;
+    return cache_store.get_apod_id_from_sha256(image_sha256)
+
+
+#This function is the near-duplicate version of get_apod_id_from_db. The hashes are loaded into an index the first
+#time it is used, new APODs are added to the index as they are cached, and evicted ones are taken out
+
+def find_near_duplicates(image_phash, max_distance=None):
+    """Finds the cached APODs whose images look like an image
+    Args:
+        image_phash (int): Perceptual hash of the image
+        max_distance (int, optional): Most bits the hashes can differ in. Defaults to near_duplicate_distance.
+    Returns:
+        list: (distance, APOD ID) of each cached APOD that looks like it, closest first
     """
+    global phash_index
+    if max_distance is None:
+        max_distance = near_duplicate_distance
+    with phash_index_lock:
+        if phash_index is None:         #Only made public once it is full, and anyone updating it waits until then
+            new_index = phash_lib.HashIndex()
+            for apod_id, apod_phash in cache_store.get_phashes():
+                new_index.add(apod_phash, apod_id)
+            phash_index = new_index
+        index = phash_index
 
-    cursor.execute(find_apod_query, (image_sha256,)) #Execute our query using the hash passed to it as a search term
-    result = cursor.fetchone()  #Get the results
-    connectus.close()       #And close connection
-    
-    
-    if result is not None:      #If there is something in the result (it isn't null)
-        return result[0]        #Return the result for further use
-    
-    return 0
+    #Another process (the daemon, say) can remove APODs without this one's index knowing, so only the ones still
+    #in the DB count
+    near_duplicates = index.find(image_phash, max_distance)      #The index has its own lock for finding
+    cached_ids = cache_store.get_existing_ids({apod_id for distance, apod_id in near_duplicates})
+    return [(distance, apod_id) for distance, apod_id in near_duplicates if apod_id in cached_ids]
+
+
+#Every change to the perceptual hashes in the DB goes through this function too, so the index (if it's loaded) never
+#finds an image by a hash it doesn't have any more
+
+def update_phash_index(apod_id, image_phash):
+    """Puts the perceptual hash of an APOD in the near-duplicate index, if the index is loaded
+    Args:
+        apod_id (int): ID of APOD in the DB
+        image_phash (int): Perceptual hash of its image. None takes the APOD out of the index.
+    """
+    with phash_index_lock:
+        if phash_index is None:         #Loaded from the DB when it's needed, with this change in it
+            return
+        if image_phash is None:
+            phash_index.remove(apod_id)
+        else:
+            phash_index.add(image_phash, apod_id)
+
+
+#This function is the date version of get_apod_id_from_db. It is what lets add_apod_to_cache skip the API and
+#the download entirely for a date we already have. Thanks to the unique index it is a single index lookup
+
+def get_apod_id_from_date(apod_date):
+    """Gets the record ID of the APOD in the cache for a specified date
+    Args:
+        apod_date (date): APOD date (Can also be a string formatted as YYYY-MM-DD)
+    Returns:
+        int: Record ID of the APOD in the image cache DB, if it exists. Zero, if it does not.
+    """
+    return cache_store.get_apod_id_from_date(apod_date)
+
+
+#This function gets every date in a range that is already in the cache, so a backfill only has to ask the
+#API about the dates that are missing
+
+def get_cached_apod_dates(start_date, end_date):
+    """Gets the dates between two dates (inclusive) that are already in the image cache
+    Args:
+        start_date (date): First date of the range
+        end_date (date): Last date of the range
+    Returns:
+        set: Cached dates, as date objects
+    """
+    return cache_store.get_cached_dates(start_date, end_date)
+
+
+#When an image is already in the cache under a row that has no date (it was cached by an older version), this
+#function fills the date in so the next run can find it without the network
+
+def set_apod_date_in_db(apod_id, apod_date):
+    """Records the APOD date of a cached APOD that does not have one yet.
+    Does nothing if the APOD already has a date, or another APOD has that date.
+    Args:
+        apod_id (int): ID of APOD in the DB
+        apod_date (date): APOD date (Can also be a string formatted as YYYY-MM-DD)
+    """
+    cache_store.set_apod_date(apod_id, apod_date)
+    return
 
 
 #This function determines the APOD file path, using the title of the image and url passed to it
 #To get the title of the file, we strip it of the extension, whitespace, etc and store it in a variable
 #It is then returned to use for the cache. It determines where the image in question is saed
+#In the content-addressed layout the file is named after its SHA-256 hash instead, see determine_sharded_file_path
 
-def determine_apod_file_path(image_title, image_url):
+def determine_apod_file_path(image_title, image_url, image_sha256=None, extension=None):
     """Determines the path at which a newly downloaded APOD image must be 
     saved in the image cache. 
     
     The image file name is constructed as follows:
-    - The file extension is taken from the image URL
+    - The file extension is taken from the image URL (unless it is given)
     - The file name is taken from the image title, where:
         - Leading and trailing spaces are removed
         - Inner spaces are replaced with underscores
@@ -314,14 +752,24 @@ def determine_apod_file_path(image_title, image_url):
     - The image URL is 'https://apod.nasa.gov/apod/image/2205/NGC3521LRGBHaAPOD-20.jpg'
     - The image title is ' NGC #3521: Galaxy in a Bubble '
     The image path will be 'C:\\temp\\APOD\\NGC_3521_Galaxy_in_a_Bubble.jpg'
+
+    If the cache uses the 'sha256' layout and the hash is given, the path from
+    determine_sharded_file_path is used instead.
     Args:
         image_title (str): APOD title
-        image_url (str): APOD image URL
+        image_url (str): APOD image URL (None, if extension is given)
+        image_sha256 (str, optional): SHA-256 hash value of APOD image
+        extension (str, optional): File extension, including the dot. Defaults to the one in the image URL.
     
     Returns:
         str: Full path at which the APOD image file must be saved in the image cache directory
     """
     
+    if extension is None:
+        extension = '.' + image_url.split('.')[-1]
+    if image_cache_layout == 'sha256' and image_sha256 is not None:
+        return determine_sharded_file_path(image_sha256, extension)
+
     #Regex isn't my best subject so there were a lot of failed attempts.
     #Decided to remove them to conserve space, but this one works AND its self-explanatory
     #We look for anything in the title that represents any letter or number at the start
@@ -329,7 +777,7 @@ def determine_apod_file_path(image_title, image_url):
 
     image_title = image_title.strip().replace(' ', '_') #Replace all blank spaces with underscores
     image_title = re.sub('[^A-Za-z0-9_]+', '', image_title) #Look for the name by finding any letter or numbers at the start of the file name
-    image_title = image_title + '.' + image_url.split('.')[-1] #Next, we split the name and extension by the '.'   
+    image_title = image_title + extension #Next, we put the extension on the end
     image_title =  os.path.join(image_cache_dir, image_title)       #And then, we join the cache irectory and the image title together
     
     #This determines where the file will be saved and with what name
@@ -337,8 +785,26 @@ def determine_apod_file_path(image_title, image_url):
     return image_title #Return the results
 
 
+#In the content-addressed layout every image is named after its SHA-256 hash, so two different images can never
+#get the same name and the same bytes always get the same name. The files are spread over two levels of folders
+#named after the first four characters of the hash (256 x 256 folders), so no folder gets too big even with
+#hundreds of thousands of images
+
+def determine_sharded_file_path(image_sha256, extension):
+    """Determines the path of an image in the content-addressed layout.
+    For example, an image with the hash 'ab12...' is saved as 'imgcache/ab/12/ab12....jpg'
+    Args:
+        image_sha256 (str): SHA-256 hash value of APOD image
+        extension (str): File extension, including the dot
+    Returns:
+        str: Full path of the image file in the image cache directory
+    """
+    return os.path.join(image_cache_dir, image_sha256[0:2], image_sha256[2:4], image_sha256 + extension)
+
+
 #This function is the entrypoint for gaining information, as it gets the title, explanation and the path of an ID in the database
-#The format of return will be through a dictionary, similar to the apod_api
+#The format of return will be through a dictionary, similar to the apod_api. Getting the info counts as using the
+#APOD, so it is recorded for deciding what to evict
 
 def get_apod_info(image_id):
     """Gets the title, explanation, and full path of the APOD having a specified
@@ -346,29 +812,73 @@ def get_apod_info(image_id):
     Args:
         image_id (int): ID of APOD in the DB
     Returns:
-        dict: Dictionary of APOD information
+        dict: Dictionary of APOD information. None, if there is no such APOD.
     """
-    connectus = sqlite3.connect(image_cache_db)     #Initialize our connection and cursor
-    cursor = connectus.cursor()
-    
-    #Start a query to match a potential APOD ID in the database
-    select_apod_query = """ SELECT title, explanation, path FROM apod_image WHERE id = ? """
-    
-    cursor.execute(select_apod_query, (image_id,))      #Execute our search with the image id in hand
-    result = cursor.fetchone()          #Get the results (in a dictionary)
-    connectus.close()                                   #And close connection
-    
-    #For the APOD info, it is the tile locating in index 0 and the explanation in index 1 with the file path in index 2. It matches the format of our
-    #query
-
-    apod_info = {
-        'title': result[0], 
-        'explanation': result[1],
-        'file_path': result[2],
-    }
+    apod_info = cache_store.get_apod_info(image_id)
+    if apod_info is not None:
+        cache_store.record_access(image_id)
     return apod_info        #Return the info
 
 
+#The viewer's prefetching needs the path of an image without it counting as a use of the APOD, or every neighbour it
+#opens would look recently used to the eviction. This function only reads the DB
+
+def get_apod_file_path(image_id):
+    """Gets the full path of the image of a cached APOD, without recording an access
+    Args:
+        image_id (int): ID of APOD in the DB
+    Returns:
+        str: Full path of the image file. None, if there is no such APOD.
+    """
+    apod_info = cache_store.get_apod_info(image_id)
+    return None if apod_info is None else apod_info['file_path']
+
+
+#The viewer shows a small preview of an APOD rather than decoding the full size image every time. This function
+#finds the preview, and makes it again if it was evicted from the preview cache (or the APOD was cached before
+#previews existed)
+
+def get_apod_preview_path(image_id):
+    """Gets the path of the viewer-sized preview of a cached APOD image
+    Args:
+        image_id (int): ID of APOD in the DB
+    Returns:
+        str: Full path of the preview file. None, if there is no such APOD or its image can't be read.
+    """
+    apod_record = cache_store.get_apod_record(image_id)
+    if apod_record is None:
+        return None
+    return preview_cache.get(apod_record['sha256'], apod_record['path'])
+
+
+#Loading every title in the cache at once gets slow as the cache grows, so the viewer asks for them a page at a time.
+#To get the next page, pass the ID of the last APOD on the page before
+
+def get_apod_page(after_id=0, page_size=100):
+    """Gets one page of the APODs in the image cache, in ID order
+    Args:
+        after_id (int, optional): ID of the last APOD on the previous page. Defaults to 0 (the first page).
+        page_size (int, optional): Most APODs on the page. Defaults to 100.
+    Returns:
+        list: (id, date, title) of each APOD on the page. Fewer than page_size means there are no more pages.
+    """
+    return cache_store.get_page(after_id, page_size)
+
+
+#This function searches the titles and explanations of the cached APODs. The best matches come first, and the last
+#word also matches the start of a word so it can be used while the search is still being typed
+
+def search_apods(search_text, limit=50):
+    """Searches the titles and explanations of the APODs in the image cache
+    Args:
+        search_text (str): Words to search for. An APOD must contain all of them.
+        limit (int, optional): Most APODs to return. Defaults to 50.
+    Returns:
+        list: (id, date, title) of each APOD found, best match first
+    """
+    return cache_store.search(search_text, limit)
+
+
 #This function gets all of the titles for APOD data in the cache.
 
 def get_all_apod_titles():
@@ -376,20 +886,702 @@ def get_all_apod_titles():
     Returns:
         list: Titles of all images in the cache
     """
-    connectus = sqlite3.connect(image_cache_db)         #Initialize our connection and cursor
-    cursor = connectus.cursor()
-    
-    select_apod_query = """ SELECT title FROM apod_image"""                 #Get each title in the cache
-    
+    return cache_store.get_all_titles()
+
+
+#This function sets a cached APOD as the desktop background. The cache remembers which APOD it is, so it is never
+#evicted while it is on the desktop
+
+def set_apod_as_desktop_background(image_id):
+    """Sets the image of a cached APOD as the desktop background image
+    Args:
+        image_id (int): ID of APOD in the DB
+    Returns:
+        bool: True, if successful. False, if unsuccessful.
+    """
+    apod_info = get_apod_info(image_id)
+    if apod_info is None:
+        return False
+    cache_store.set_setting('wallpaper_id', str(image_id))
+    return image_lib.set_desktop_background_image(apod_info['file_path'])
+
+
+#When the images in the cache take up more than the budget, this function evicts APODs until they fit again. There
+#is no budget until one is given to the gc command, so nothing is ever evicted from a cache that didn't ask for it. The
+#least recently (or least often) used go first. Pinned APODs, the APOD set as the desktop background, and whatever
+#image is on the desktop right now are never evicted.
+#Each image file is deleted in the same transaction as its row. If a file can't be deleted, its row is kept so the
+#DB never loses track of a file. If we crash before the commit, the rows come back without their files, and the
+#next pass finds the files already gone and finishes the job
+
+def evict_apod_cache(budget=None, policy=None, keep_ids=(), dry_run=False):
+    """Evicts APODs from the image cache until their images fit in the budget.
+    Args:
+        budget (int, optional): Most bytes the images can take up. Defaults to image_cache_budget. 0 means no limit.
+        policy (str, optional): 'lru' or 'lfu'. Defaults to image_cache_eviction.
+        keep_ids (iterable, optional): IDs of APODs that must not be evicted this time
+        dry_run (bool, optional): Only work out what would be evicted. Defaults to False.
+    Returns:
+        list: IDs of the APODs that were evicted (or would be, for a dry run)
+    """
+    if budget is None:
+        budget = image_cache_budget
+    if policy is None:
+        policy = image_cache_eviction
+
+    #APODs cached before sizes were kept get theirs filled in first
+
+    unsized_records = cache_store.get_unsized_records()
+    if unsized_records:
+        with cache_store.transaction():
+            for apod_id, image_path in unsized_records:
+                cache_store.update_apod(apod_id, {'size': image_lib.get_file_size(image_path)})
+
+    total_size, apod_count = cache_store.get_total_size()
+    if budget <= 0 or total_size <= budget:
+        return []
+
+    keep_ids = set(keep_ids)
+    keep_ids.add(int(cache_store.get_setting('wallpaper_id', 0)))
+    desktop_image = image_lib.get_desktop_background_image()
+    if desktop_image is not None:
+        desktop_image = os.path.normcase(os.path.abspath(desktop_image))
+
+    evicted_ids = []
+    with cache_store.transaction():
+        for apod_id, image_path, image_sha256, image_size in cache_store.get_eviction_candidates(policy, keep_ids):
+            if total_size <= budget:
+                break
+            if os.path.normcase(os.path.abspath(image_path)) == desktop_image:
+                continue
+
+            if not dry_run:
+                try:
+                    os.remove(image_path)
+                except FileNotFoundError:       #Already gone, so only the row is left to remove
+                    pass
+                except OSError as error:
+                    print(f"Could not evict {image_path}: {error}")
+                    continue
+                cache_store.delete_apod(apod_id)
+                preview_cache.remove(image_sha256)
+                update_phash_index(apod_id, None)
+
+            total_size -= image_size
+            evicted_ids.append(apod_id)
+
+    if evicted_ids and not dry_run:
+        print(f"Evicted {len(evicted_ids)} APODs from the image cache ({total_size} bytes in use)")
+    return evicted_ids
+
+
+#This command moves a cache that names its images after their titles into the content-addressed layout. Every file
+#is hashed on the way, so a file that was overwritten by another APOD with the same title ends up with the row it
+#really belongs to. The path column is updated as each file moves, so the command can be stopped and run again
+
+def migrate_cache_layout():
+    """Moves every image in the cache into the content-addressed layout and updates its path in the DB.
+    Returns:
+        list: IDs of the APODs whose image file could not be found
+    """
+    global image_cache_layout
+
+    cache_store.set_setting('layout', 'sha256')     #From now on new images go straight into the new layout
+    image_cache_layout = 'sha256'
+
+    missing_ids = []
+    moved = 0
+    for apod_id, image_path, image_sha256, stored_file_sha256 in cache_store.get_all_records(('id', 'path', 'sha256', 'file_sha256')):
+        expected_sha256 = stored_file_sha256 or image_sha256       #A compacted image no longer has the hash of the download
+        new_path = determine_sharded_file_path(image_sha256, os.path.splitext(image_path)[1])
+        if image_path == new_path:      #Already moved on an earlier run
+            continue
+
+        #If the old file is gone, a run that was stopped may have already moved it without updating the DB
+
+        if not os.path.exists(image_path):
+            if os.path.exists(new_path) and image_lib.hash_file(new_path) == expected_sha256:
+                cache_store.update_apod(apod_id, {'path': new_path})
+            else:
+                missing_ids.append(apod_id)
+            continue
+
+        #The file might really hold the image of a different APOD that had the same title. Whoever it belongs to,
+        #it goes to the path for its real hash
+
+        file_sha256 = image_lib.hash_file(image_path)
+        owner_id = apod_id if file_sha256 == expected_sha256 else get_apod_id_from_db(file_sha256)
+        owner_sha256 = image_sha256 if owner_id == apod_id else file_sha256
+        owner_path = determine_sharded_file_path(owner_sha256, os.path.splitext(image_path)[1])
+
+        if owner_id == 0:       #Nobody's image, so it has no business being in the cache
+            print("Image does not belong to any APOD: " + image_path)
+            continue
+        if os.path.exists(owner_path):      #The same bytes are already in place, so only one copy is kept
+            os.remove(image_path)
+        elif not image_lib.move_image_file(image_path, owner_path):
+            print("Could not move image: " + image_path)
+            continue
+        cache_store.update_apod(owner_id, {'path': owner_path})
+        moved += 1
+
+        if owner_id != apod_id:         #This APOD's own image was overwritten, so it is lost
+            missing_ids.append(apod_id)
+
+    print(f"Moved {moved} images to the content-addressed layout")
+    if missing_ids:
+        print(f"{len(missing_ids)} APODs have no image file: {missing_ids}")
+    return missing_ids
+
+
+#Entrypoint of the migrate-layout command
+
+def migrate_layout_main():
+    """Moves the cache next to this script into the content-addressed layout"""
+    init_apod_cache(get_script_dir())
+    migrate_cache_layout()
+
+
+#Entrypoint of the search command
+
+def search_main():
+    """Prints the cached APODs that match the words on the command line"""
+    parser = argparse.ArgumentParser(prog='apod_desktop.py search', description='Search the cached APODs.')
+    parser.add_argument('words', nargs='+', help='words to search the titles and explanations for')
+    parser.add_argument('--limit', type=int, default=20, help='most APODs to show (default: 20)')
+    args = parser.parse_args(sys.argv[2:])
+
+    init_apod_cache(get_script_dir())
+    results = search_apods(' '.join(args.words), args.limit)
+    for apod_id, apod_date, title in results:
+        print(f"{apod_id:>6}  {apod_date or '':<10}  {title}")
+    if not results:
+        print("No cached APODs match the search")
+
+
+#Sizes on the command line can be given in bytes, or with KB, MB or GB on the end
+
+def parse_size(text):
+    """Reads a size like 500MB or 2GB
+    Args:
+        text (str): Size in bytes, or with KB, MB or GB on the end
+    Returns:
+        int: Size in bytes
+    """
+    match = re.fullmatch(r'(\d+)\s*([KMG]?)B?', text.strip(), re.IGNORECASE)
+    if match is None:
+        raise argparse.ArgumentTypeError("not a size: " + text)
+    return int(match.group(1)) * 1024 ** ' KMG'.index(match.group(2).upper() or ' ')
+
+
+#Entrypoint of the gc command. It evicts APODs until the cache fits in its budget. A new budget or policy given
+#here is saved with the cache, and used by the automatic eviction after every download from then on
+
+def gc_main():
+    """Evicts APODs from the cache next to this script until it fits in its budget"""
+    parser = argparse.ArgumentParser(prog='apod_desktop.py gc', description='Evict APODs until the image cache fits in its budget.')
+    parser.add_argument('--budget', type=parse_size, help='most room the images can take up, e.g. 500MB (0 for no limit)')
+    parser.add_argument('--policy', choices=sorted(apod_cache.ApodCacheStore.eviction_orders), help='which APODs go first')
+    parser.add_argument('--pin', type=int, action='append', default=[], metavar='ID', help='never evict this APOD')
+    parser.add_argument('--unpin', type=int, action='append', default=[], metavar='ID', help='let this APOD be evicted again')
+    parser.add_argument('--dry-run', action='store_true', help='only show what would be evicted')
+    args = parser.parse_args(sys.argv[2:])
+
+    init_apod_cache(get_script_dir())
+    global image_cache_budget, image_cache_eviction
+    if args.budget is not None:
+        image_cache_budget = args.budget
+        cache_store.set_setting('budget', str(args.budget))
+    if args.policy is not None:
+        image_cache_eviction = args.policy
+        cache_store.set_setting('eviction', args.policy)
+    for apod_id in args.pin:
+        cache_store.set_pinned(apod_id, True)
+    for apod_id in args.unpin:
+        cache_store.set_pinned(apod_id, False)
+
+    evicted_ids = evict_apod_cache(dry_run=args.dry_run)
+    if args.dry_run:
+        print(f"Would evict {len(evicted_ids)} APODs: {evicted_ids}")
+    total_size, apod_count = cache_store.get_total_size()
+    print(f"{apod_count} APODs in the image cache, using {total_size} of {image_cache_budget or 'unlimited'} bytes ({image_cache_eviction})")
+
+
+#The compact command re-encodes the cached images into a smaller format, using a process for every core. Each image
+#is recorded as soon as it's done: the new file is moved into place, its row gets the new path and both sizes, and
+#then the old file is deleted. Images that were looked at are marked even when they were left as they are, so a run
+#that is stopped (or limited) carries on where it left off the next time. A crash between moving the new file and
+#updating the row only leaves the new file to be made again
+
+def compact_apod_cache(image_format=None, quality=None, quality_floor=None, workers=None, limit=None):
+    """Re-encodes the cached images that haven't been compacted yet.
+    Args:
+        image_format (str, optional): 'webp' or 'jpeg'. Defaults to image_compact_format.
+        quality (int, optional): Quality to encode at. Defaults to image_compact_quality.
+        quality_floor (int, optional): Lowest quality to ever encode at. Defaults to image_compact_quality_floor.
+        workers (int, optional): Number of processes. Defaults to the number of cores.
+        limit (int, optional): Most images to look at in this run. Defaults to all of them.
+    Returns:
+        tuple[int, int, int]: Number of images compacted, left as they were, and that couldn't be read
+    """
+    image_format = image_format or image_compact_format
+    quality = quality or image_compact_quality
+    quality_floor = min(quality_floor or image_compact_quality_floor, quality)
+    extension = image_lib.compact_extensions[image_format]
+
+    #In the title layout, Foo.png and Foo.jpg would both be re-encoded to Foo.webp. So the new file only gets the
+    #old name with the new extension if no other APOD's image has it (or is about to), otherwise the start of the
+    #hash is added to the name
+
+    taken_paths = {os.path.normcase(image_path) for (image_path,) in cache_store.get_all_records(('path',))}
+
+    def get_compact_path(apod_id, image_path):
+        compact_path = os.path.splitext(image_path)[0] + extension
+        if compact_path != image_path and (os.path.normcase(compact_path) in taken_paths or os.path.exists(compact_path)):
+            compact_path = os.path.splitext(image_path)[0] + '-' + cache_store.get_apod_record(apod_id)['sha256'][:8] + extension
+        taken_paths.add(os.path.normcase(compact_path))
+        return compact_path
+
+    counts = run_on_cached_images(
+        cache_store.get_uncompacted_records, image_lib.compact_image,
+        lambda apod_id, image_path: (image_path, get_compact_path(apod_id, image_path), image_format, quality, quality_floor),
+        lambda apod_id, image_path, result: finish_compacting(apod_id, image_path, image_format, result),
+        workers, limit)
+    counts = {outcome: counts.get(outcome, 0) for outcome in ('compacted', 'skipped', 'failed')}
+
+    compacted_count, original_size, compacted_size = cache_store.get_compaction_totals()
+    print(f"Compacted {counts['compacted']} images, left {counts['skipped']} as they were, {counts['failed']} could not be read")
+    if compacted_count:
+        print(f"{compacted_count} compacted images take up {compacted_size} bytes, down from {original_size} ({1 - compacted_size / original_size:.0%} smaller)")
+    return counts['compacted'], counts['skipped'], counts['failed']
+
+
+#This function runs a function on the image of every APOD a query gives, using a process for every core. The APODs
+#are taken from the DB a page at a time (by ID, so each one is only given once even if the query still matches it
+#afterwards), and a few are kept queued for every process. The results are handled here as they come in
+
+def run_on_cached_images(get_records, func, make_args, finish, workers=None, limit=None):
+    """Runs a function on a process pool for the images of the APODs a query gives
+    Args:
+        get_records (callable): Called as get_records(after_id, limit), gives the next (id, path) records in ID order
+        func (callable): Function to run in the processes. It must be a function at the top of a module.
+        make_args (callable): Called as make_args(apod_id, image_path), gives the arguments for func
+        finish (callable): Called as finish(apod_id, image_path, result) with what func gave back. Gives back what happened.
+        workers (int, optional): Number of processes. Defaults to the number of cores.
+        limit (int, optional): Most APODs to run it for. Defaults to all of them.
+    Returns:
+        dict: Number of APODs for each thing finish said happened
+    """
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    workers = workers or os.cpu_count() or 1
+    counts = {}
+    after_id = 0
+    remaining = limit
+    pending = {}            #Future -> (APOD ID, image path)
+    with ProcessPoolExecutor(workers) as pool:
+        while True:
+            if len(pending) < workers * 4 and remaining != 0:
+                page_size = workers * 8 if remaining is None else min(workers * 8, remaining)
+                records = get_records(after_id, page_size)
+                for apod_id, image_path in records:
+                    pending[pool.submit(func, *make_args(apod_id, image_path))] = (apod_id, image_path)
+                if records:
+                    after_id = records[-1][0]
+                if remaining is not None:
+                    remaining -= len(records)
+                if len(records) < page_size:
+                    remaining = 0       #Nothing left to queue
+            if not pending:
+                break
+
+            done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                apod_id, image_path = pending.pop(future)
+                outcome = finish(apod_id, image_path, future.result())
+                counts[outcome] = counts.get(outcome, 0) + 1
+    return counts
+
+
+def finish_compacting(apod_id, image_path, image_format, result):
+    """Records the result of image_lib.compact_image for an APOD
+    Args:
+        apod_id (int): ID of APOD in the DB
+        image_path (str): Full path of its image as it was
+        image_format (str): Format it was compacted to
+        result (dict): What compact_image gave back
+    Returns:
+        str: 'compacted', 'skipped' or 'failed'
+    """
+    if result.get('error'):         #Left unmarked, so it is tried again next time
+        print(f"Could not compact {image_path}: {result['skipped']}")
+        return 'failed'
+    if 'skipped' in result:
+        cache_store.update_apod(apod_id, {'compact_format': 'original'})
+        return 'skipped'
+
+    new_path = result['temp_path'][:-len('.part')]
+    if new_path != image_path and os.path.exists(new_path):       #Never replace a file that isn't this APOD's image
+        print(f"Could not compact {image_path}: {new_path} already exists")
+        image_lib.remove_partial_download(result['temp_path'])
+        return 'failed'
+    if not image_lib.move_image_file(result['temp_path'], new_path):
+        image_lib.remove_partial_download(result['temp_path'])
+        return 'failed'
+    cache_store.update_apod(apod_id, {'path': new_path, 'size': result['size'], 'original_size': result['original_size'],
+                                      'file_sha256': result['file_sha256'], 'compact_format': image_format})
+    if new_path != image_path:
+        try:
+            os.remove(image_path)
+        except OSError:
+            pass
+    return 'compacted'
+
+
+#Entrypoint of the compact command
+
+def compact_main():
+    """Re-encodes the images in the cache next to this script into a smaller format"""
+    parser = argparse.ArgumentParser(prog='apod_desktop.py compact', description='Re-encode the cached images to take up less room.')
+    parser.add_argument('--format', choices=sorted(image_lib.compact_extensions), default=image_compact_format,
+                        help=f'format to re-encode to (default: {image_compact_format})')
+    parser.add_argument('--quality', type=int, default=image_compact_quality, help=f'quality to encode at (default: {image_compact_quality})')
+    parser.add_argument('--min-quality', type=int, default=image_compact_quality_floor,
+                        help=f'never encode below this quality, and leave JPEGs saved below it alone (default: {image_compact_quality_floor})')
+    parser.add_argument('--workers', type=int, help='number of processes (default: one for every core)')
+    parser.add_argument('--limit', type=int, help='most images to look at in this run (run again to carry on)')
+    args = parser.parse_args(sys.argv[2:])
+
+    init_apod_cache(get_script_dir())
+    compact_apod_cache(args.format, args.quality, args.min_quality, args.workers, args.limit)
+
+
+#The dedup command works out the perceptual hash of every cached image that doesn't have one yet (they were cached
+#before the hashes were kept), using a process for every core. It can also set the near-duplicate policy, which is
+#saved with the cache, and list the cached APODs that look like each other
+
+def hash_apod_cache(workers=None, limit=None):
+    """Works out the perceptual hashes of the cached images that don't have one yet.
+    Args:
+        workers (int, optional): Number of processes. Defaults to the number of cores.
+        limit (int, optional): Most images to hash in this run. Defaults to all of them.
+    Returns:
+        tuple[int, int]: Number of images hashed, and that couldn't be read
+    """
+    def finish_hashing(apod_id, image_path, image_phash):
+        if image_phash is None:
+            print("Could not hash " + image_path)
+            return 'failed'
+        cache_store.set_phash(apod_id, image_phash)
+        update_phash_index(apod_id, image_phash)
+        return 'hashed'
+
+    counts = run_on_cached_images(cache_store.get_unhashed_records, phash_lib.get_image_dhash,
+                                  lambda apod_id, image_path: (image_path,), finish_hashing, workers, limit)
+    print(f"Hashed {counts.get('hashed', 0)} images, {counts.get('failed', 0)} could not be read")
+    return counts.get('hashed', 0), counts.get('failed', 0)
+
+
+def get_near_duplicate_pairs(max_distance=None):
+    """Gets every pair of cached APODs whose images look like each other
+    Args:
+        max_distance (int, optional): Most bits the hashes can differ in. Defaults to near_duplicate_distance.
+    Returns:
+        list: (APOD ID, APOD ID, distance) of each pair, the lower ID first
+    """
+    pairs = []
+    for apod_id, apod_phash in cache_store.get_phashes():
+        for distance, other_id in find_near_duplicates(apod_phash, max_distance):
+            if other_id > apod_id:
+                pairs.append((apod_id, other_id, distance))
+    return pairs
+
+
+#Entrypoint of the dedup command
+
+def dedup_main():
+    """Hashes the images in the cache next to this script, and sets what happens to near-duplicates"""
+    parser = argparse.ArgumentParser(prog='apod_desktop.py dedup', description='Find cached APODs that look like each other.')
+    parser.add_argument('--policy', choices=['keep', 'skip'], help='what to do with new APODs that look like a cached one')
+    parser.add_argument('--distance', type=int, help='most bits the hashes of near-duplicates differ in')
+    parser.add_argument('--workers', type=int, help='number of processes (default: one for every core)')
+    parser.add_argument('--limit', type=int, help='most images to hash in this run (run again to carry on)')
+    parser.add_argument('--list', action='store_true', help='list the cached APODs that look like each other')
+    args = parser.parse_args(sys.argv[2:])
+
+    init_apod_cache(get_script_dir())
+    global near_duplicate_policy, near_duplicate_distance
+    if args.policy is not None:
+        near_duplicate_policy = args.policy
+        cache_store.set_setting('near_duplicate_policy', args.policy)
+    if args.distance is not None:
+        near_duplicate_distance = args.distance
+        cache_store.set_setting('near_duplicate_distance', str(args.distance))
+
+    hash_apod_cache(args.workers, args.limit)
+    if args.list:
+        for apod_id, other_id, distance in get_near_duplicate_pairs():
+            print(f"{apod_id:>6}  {other_id:>6}  {distance} bits different")
+    print(f"Near-duplicates are within {near_duplicate_distance} bits, and new ones are {'kept' if near_duplicate_policy == 'keep' else 'skipped'}")
+
+
+#The fsck command checks that every APOD in the DB still has its image file, and that the file holds the bytes it
+#should (the image as it was downloaded, or as it was re-encoded if it was compacted). The files are hashed on a
+#process for every core, a batch of fsck_batch_size at a time, while this process looks through the cache folder for
+#orphaned files: images that no APOD points at. What it finds can be repaired by downloading the images again, and
+#what can't be repaired can be pruned
+
+def check_apod_cache(workers=None, quick=False):
+    """Checks the image of every cached APOD, and looks for image files that don't belong to any.
+    Args:
+        workers (int, optional): Number of processes. Defaults to the number of cores.
+        quick (bool, optional): Only check that each image is there and the right size, without hashing it. Defaults to False.
+    Returns:
+        dict: Number of APODs 'checked', (APOD ID, image path) of each image that is 'missing' or 'corrupt', and the
+        paths of the 'orphaned' files
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    records = [(apod_id, image_path, file_sha256 or image_sha256, image_size)      #A compacted image no longer has the hash of the download
+               for apod_id, image_path, image_sha256, file_sha256, image_size
+               in cache_store.get_all_records(('id', 'path', 'sha256', 'file_sha256', 'size'))]
+    image_paths = {apod_id: image_path for apod_id, image_path, image_sha256, image_size in records}
+    batches = [records[start:start + fsck_batch_size] for start in range(0, len(records), fsck_batch_size)]
+
+    report = {'checked': len(records), 'missing': [], 'corrupt': []}
+    with ProcessPoolExecutor(workers or os.cpu_count() or 1) as pool:
+        results = pool.map(image_lib.check_image_files, batches, itertools.repeat(quick))
+        report['orphaned'] = find_orphaned_files(image_paths.values())      #While the processes do the hashing
+        for problems in results:
+            for apod_id, problem in problems:
+                report[problem].append((apod_id, image_paths[apod_id]))
+    return report
+
+
+def find_orphaned_files(image_paths):
+    """Gets the files in the image cache directory that aren't the image of any APOD.
+    The DB, the previews, the wallpapers, unfinished downloads and the daemon's key are left out.
+    Args:
+        image_paths (iterable[str]): Full path of the image of every APOD
+    Returns:
+        list: Full path of each orphaned file
+    """
+    image_paths = {os.path.normcase(os.path.abspath(image_path)) for image_path in image_paths}
+    db_name = os.path.basename(image_cache_db)
+    orphaned_paths = []
+    for folder, subfolders, file_names in os.walk(image_cache_dir):
+        if folder == image_cache_dir:
+            subfolders[:] = [subfolder for subfolder in subfolders if subfolder not in ('previews', 'wallpapers')]
+        for file_name in file_names:
+            if file_name.startswith(db_name) or file_name.endswith(('.part', '.part.json', '.part.lock')):      #The DB's journal too
+                continue
+            if folder == image_cache_dir and file_name == daemon_token_name:
+                continue
+            file_path = os.path.join(folder, file_name)
+            if os.path.normcase(os.path.abspath(file_path)) not in image_paths:
+                orphaned_paths.append(file_path)
+    return orphaned_paths
+
+
+#This function fixes what check_apod_cache found. An orphaned file that holds exactly the image a broken APOD should
+#have (say, a file that was renamed) is moved back into place. The rest are downloaded again, all at once with the
+#download engine. Whatever still isn't fixed is pruned, if asked to: the APOD is removed and the orphans deleted
+
+def repair_apod_cache(report, redownload=True, prune=False):
+    """Repairs the problems check_apod_cache found.
+    Args:
+        report (dict): What check_apod_cache gave back. The problems that are fixed are taken out of it.
+        redownload (bool, optional): Download the images of missing and corrupt APODs again. Defaults to True.
+        prune (bool, optional): Remove the APODs whose images couldn't be fixed, and delete the orphaned files. Defaults to False.
+    Returns:
+        dict: Number of images 'restored' from orphaned files, 'downloaded' again, and APODs and files 'pruned'
+    """
+    counts = {'restored': 0, 'downloaded': 0, 'pruned': 0}
+    broken = {apod_id: cache_store.get_apod_record(apod_id) for apod_id, image_path in report['missing'] + report['corrupt']}
+
+    if broken and report['orphaned']:
+        expected_ids = {apod_record['file_sha256'] or apod_record['sha256']: apod_id for apod_id, apod_record in broken.items()}
+        for orphaned_path in list(report['orphaned']):
+            try:
+                apod_id = expected_ids.get(image_lib.hash_file_mmap(orphaned_path))
+            except OSError:
+                continue
+            if apod_id in broken and image_lib.move_image_file(orphaned_path, broken[apod_id]['path']):
+                print("Image restored: " + broken.pop(apod_id)['path'])
+                report['orphaned'].remove(orphaned_path)
+                counts['restored'] += 1
+
+    #More than one APOD can have the same image URL, so each URL is downloaded once for all of them
+    records_by_url = {}
+    for apod_record in broken.values():
+        if apod_record['image_url']:
+            records_by_url.setdefault(apod_record['image_url'], []).append(apod_record)
+
+    if redownload and records_by_url:
+        for image_url, image_download in image_lib.download_images(records_by_url, download_dir=image_cache_dir):
+            if image_download is None:
+                print("Could not download " + image_url)
+                continue
+
+            #No two APODs can have the same image, so only one of them gets the download. The one that had this image
+            #before goes first. Another one only gets it if no APOD has the image now
+            apod_records = sorted(records_by_url[image_url], key=lambda apod_record: apod_record['sha256'] != image_download['sha256'])
+            owner_id = get_apod_id_from_db(image_download['sha256'])
+            new_record = next((apod_record for apod_record in apod_records if owner_id in (0, apod_record['id'])), None)
+            if new_record is None:
+                os.remove(image_download['path'])       #The server sends an image another APOD already has now
+            elif replace_apod_image(new_record, image_download):
+                print("Image downloaded again: " + new_record['path'])
+                del broken[new_record['id']]
+                counts['downloaded'] += 1
+
+            for apod_record in apod_records:
+                if apod_record is not new_record:
+                    print(f"Could not repair {apod_record['path']}: the image at {image_url} is another APOD's")
+
+    if prune:
+        with cache_store.transaction():
+            for apod_id, apod_record in list(broken.items()):
+                try:
+                    os.remove(apod_record['path'])
+                except FileNotFoundError:
+                    pass
+                except OSError as error:
+                    print(f"Could not prune {apod_record['path']}: {error}")
+                    continue
+                cache_store.delete_apod(apod_id)
+                preview_cache.remove(apod_record['sha256'])
+                update_phash_index(apod_id, None)
+                del broken[apod_id]
+                counts['pruned'] += 1
+        for orphaned_path in list(report['orphaned']):
+            try:
+                os.remove(orphaned_path)
+            except OSError as error:
+                print(f"Could not prune {orphaned_path}: {error}")
+                continue
+            report['orphaned'].remove(orphaned_path)
+            counts['pruned'] += 1
+
+    for problem in ('missing', 'corrupt'):
+        report[problem] = [(apod_id, image_path) for apod_id, image_path in report[problem] if apod_id in broken]
+    return counts
+
+
+#Entrypoint of the revalidate command. It asks the server whether the images of cached APODs have changed, sending
+#the ETag and Last-Modified they were downloaded with, and downloads the ones that have
+
+def revalidate_main():
+    """Checks the images in the cache next to this script against the server"""
+    parser = argparse.ArgumentParser(prog='apod_desktop.py revalidate', description='Download the cached images that changed on the server.')
+    parser.add_argument('dates', nargs='*', type=date.fromisoformat, metavar='apod_date',
+                        help='APOD dates to check, as YYYY-MM-DD (default: every cached APOD)')
+    args = parser.parse_args(sys.argv[2:])
+
+    init_apod_cache(get_script_dir())
+    if args.dates:
+        apod_ids = [get_apod_id_from_date(apod_date) for apod_date in args.dates]
+        for apod_date, apod_id in zip(args.dates, apod_ids):
+            if apod_id == 0:
+                print(f"APOD for {apod_date} is not cached")
+        apod_ids = [apod_id for apod_id in apod_ids if apod_id != 0]
+    else:
+        apod_ids = [apod_id for (apod_id,) in cache_store.get_all_records(('id',))]
+
+    unchecked_ids = [apod_id for apod_id in apod_ids if not revalidate_apod_image(apod_id)]
+    print(f"Checked {len(apod_ids) - len(unchecked_ids)} APODs against the server")
+    if unchecked_ids:
+        print(f"{len(unchecked_ids)} APODs could not be checked: {unchecked_ids}")
+
+
+#Entrypoint of the fsck command. It exits with 1 if there are problems left when it's done, so scripts can tell
+
+def fsck_main():
+    """Checks the images in the cache next to this script, and repairs them if asked to"""
+    parser = argparse.ArgumentParser(prog='apod_desktop.py fsck', description='Check that the cached images are all there and intact.')
+    parser.add_argument('--quick', action='store_true', help='only check that each image is there and the right size, without hashing it')
+    parser.add_argument('--repair', action='store_true', help='download missing and corrupt images again')
+    parser.add_argument('--prune', action='store_true', help='remove APODs whose images could not be repaired, and delete orphaned files')
+    parser.add_argument('--workers', type=int, help='number of processes (default: one for every core)')
+    args = parser.parse_args(sys.argv[2:])
+
+    init_apod_cache(get_script_dir())
+    start_time = time.perf_counter()
+    report = check_apod_cache(args.workers, args.quick)
+    for problem in ('missing', 'corrupt'):
+        for apod_id, image_path in report[problem]:
+            print(f"{problem:<8}  {apod_id:>6}  {image_path}")
+    for orphaned_path in report['orphaned']:
+        print(f"{'orphaned':<8}  {'':>6}  {orphaned_path}")
+    print(f"Checked {report['checked']} APODs in {time.perf_counter() - start_time:.1f} seconds: {len(report['missing'])} missing, "
+          f"{len(report['corrupt'])} corrupt, {len(report['orphaned'])} orphaned files")
+
+    if args.repair or args.prune:
+        counts = repair_apod_cache(report, args.repair, args.prune)
+        print(f"Restored {counts['restored']} images, downloaded {counts['downloaded']} again, pruned {counts['pruned']}. "
+              f"{len(report['missing']) + len(report['corrupt']) + len(report['orphaned'])} problems left")
+    if report['missing'] or report['corrupt'] or report['orphaned']:
+        sys.exit(1)
+
+
+#Entrypoints of the daemon commands. The daemon lives in its own module, which imports this one, so it is only
+#imported when it's needed
+
+def daemon_main():
+    """Runs this script as a daemon that fetches each new APOD as it comes out"""
+    import apod_daemon
+    apod_daemon.main()
+
+
+def daemon_command_main():
+    """Sends a command to a running daemon"""
+    import apod_daemon
+    apod_daemon.command_main()
+
+
+#Entrypoints of the commands that copy APODs between caches. They live in apod_sync, which is only imported when
+#it's needed
+
+def export_main():
+    """Exports the cache next to this script to a bundle"""
+    import apod_sync
+    apod_sync.export_main()
+
+
+def import_main():
+    """Adds the APODs in a bundle to the cache next to this script"""
+    import apod_sync
+    apod_sync.import_main()
+
+
+def sync_main():
+    """Copies the APODs the cache next to this script is missing from another cache"""
+    import apod_sync
+    apod_sync.sync_main()
+
+
+#The commands that can be given as the first command line parameter, instead of a date
+
+commands = {
+    'migrate-layout': migrate_layout_main,
+    'search': search_main,
+    'gc': gc_main,
+    'compact': compact_main,
+    'dedup': dedup_main,
+    'revalidate': revalidate_main,
+    'fsck': fsck_main,
+    'export': export_main,
+    'import': import_main,
+    'sync': sync_main,
+    'daemon': daemon_main,
+    'daemon-command': daemon_command_main,
+}
 
-    cursor.execute(select_apod_query)       #Execute our query
-    result = cursor.fetchall()              #Store it in a dictionary
-    connectus.close()               #And close connection
-    
-    if result is not None:              #If there is actual content in the result variable, return it
-        return result
-    
-    return None
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        commands[sys.argv[1]]()
+    elif '--from' in sys.argv:        #Backfilling a range has its own entrypoint so main stays the same
+        backfill_main()
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,244 @@
+'''
+Library for timing each stage of adding APODs to the cache.
+'''
+#The ingest code wraps each stage (the API call, working out the image URL, the download, hashing, writing the file,
+#the duplicate check, the DB insert...) in stage(). Each stage records how long it took, how many bytes it handled
+#and how it turned out. The numbers can go to two places:
+#  - A JSON log, with one line for each stage as it finishes
+#  - A Prometheus textfile (for node_exporter's textfile collector), with the totals for the whole run
+#Both are off unless configure() is called, or the APOD_METRICS_LOG / APOD_METRICS_PROM environment variables name
+#the files to write. While they are off, stage() hands back the same do-nothing object every time, so the ingest
+#code pays nothing more than a function call.
+
+import atexit       #The Prometheus file is written one last time when the program ends
+import json         #The log lines are JSON
+import os
+import threading    #Downloads run on many threads, so the totals have a lock
+import time
+
+enabled = False             #True when there is anywhere to send the numbers
+log_path = None             #Full path of the JSON log (None for no log)
+prometheus_path = None      #Full path of the Prometheus textfile (None for no textfile)
+duration_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)    #Upper bounds of the histogram buckets, in seconds
+
+stage_totals = {}           #Stage name -> {'count', 'seconds', 'bytes', 'buckets', 'outcomes'}
+metrics_lock = threading.Lock()
+log_file = None
+
+
+#This function turns the metrics on (or off). Whatever isn't given is left off
+
+def configure(log=None, prometheus=None):
+    """Chooses where the metrics go. With neither, metrics are turned off.
+    Args:
+        log (str, optional): Full path of the JSON log. Lines are added to the end of it.
+        prometheus (str, optional): Full path of the Prometheus textfile. It is rewritten each time.
+    """
+    global enabled, log_path, prometheus_path, log_file
+
+    with metrics_lock:
+        if log_file is not None:
+            log_file.close()
+            log_file = None
+        log_path = log
+        prometheus_path = prometheus
+        if log_path is not None:
+            log_file = open(log_path, 'a', buffering=1)     #Line buffered, so every line is in the file as soon as it's logged
+        enabled = log_path is not None or prometheus_path is not None
+    return
+
+
+#This is what the ingest code uses. With metrics off, the shared null_stage is handed back and nothing is timed
+
+def stage(name, **fields):
+    """Times a stage of the ingest as a with-block. The block can set .outcome and .bytes on the stage it is given.
+    Args:
+        name (str): Name of the stage
+        **fields: Extra information for the log line, such as the APOD date or URL
+    Returns:
+        Stage: The stage, to use as a with-block
+    """
+    if not enabled:
+        return null_stage
+    return Stage(name, fields)
+
+
+#Some stages (like hashing) happen in many small pieces spread through a loop. For those, an accumulator adds up the
+#time of each piece and records the stage once at the end
+
+def accumulator(name):
+    """Adds up the time spent in many with-blocks, to record as one stage with record()
+    Args:
+        name (str): Name of the stage
+    Returns:
+        Accumulator: The accumulator
+    """
+    if not enabled:
+        return null_stage
+    return Accumulator(name)
+
+
+class Stage:
+    """One timed stage"""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.outcome = 'ok'
+        self.bytes = 0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        if error_type is not None and self.outcome == 'ok':
+            self.outcome = 'error'
+        record(self.name, time.perf_counter() - self.start_time, self.outcome, self.bytes, self.fields)
+        return False        #Never swallow the error
+
+
+class Accumulator:
+    """A stage timed in many pieces"""
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.seconds += time.perf_counter() - self.start_time
+        return False
+
+    def record(self, outcome='ok', size=0, **fields):
+        """Records the total time as one stage"""
+        record(self.name, self.seconds, outcome, size, fields)
+
+
+class NullStage:
+    """Stands in for Stage and Accumulator while metrics are off, and does nothing"""
+
+    outcome = 'ok'
+    bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        return False
+
+    def record(self, outcome='ok', size=0, **fields):
+        pass
+
+    def __setattr__(self, name, value):
+        pass        #The shared null stage must not remember anything a with-block sets on it
+
+
+null_stage = NullStage()
+
+
+#This function adds a finished stage to the totals and the log
+
+def record(name, seconds, outcome='ok', size=0, fields=None):
+    """Records a finished stage.
+    Args:
+        name (str): Name of the stage
+        seconds (float): How long it took
+        outcome (str, optional): How it turned out. Defaults to 'ok'.
+        size (int, optional): Bytes it handled. Defaults to 0.
+        fields (dict, optional): Extra information for the log line
+    """
+    if not enabled:
+        return
+
+    with metrics_lock:
+        totals = stage_totals.get(name)
+        if totals is None:
+            totals = stage_totals[name] = {'count': 0, 'seconds': 0.0, 'bytes': 0,
+                                           'buckets': [0] * len(duration_buckets), 'outcomes': {}}
+        totals['count'] += 1
+        totals['seconds'] += seconds
+        totals['bytes'] += size
+        totals['outcomes'][outcome] = totals['outcomes'].get(outcome, 0) + 1
+        for index, upper_bound in enumerate(duration_buckets):
+            if seconds <= upper_bound:
+                totals['buckets'][index] += 1
+
+        if log_file is not None:
+            line = {'time': round(time.time(), 3), 'stage': name, 'seconds': round(seconds, 6), 'outcome': outcome,
+                    'bytes': size}
+            line.update(fields or {})
+            log_file.write(json.dumps(line, default=str) + '\n')
+    return
+
+
+#The totals for the whole run so far, for printing or for other scripts to look at
+
+def get_totals():
+    """Gets the totals of every stage recorded so far
+    Returns:
+        dict: Count, seconds, bytes and outcomes of each stage, by stage name
+    """
+    with metrics_lock:
+        return {name: {'count': totals['count'], 'seconds': totals['seconds'], 'bytes': totals['bytes'],
+                       'outcomes': dict(totals['outcomes'])}
+                for name, totals in stage_totals.items()}
+
+
+#This function writes the totals in the Prometheus text format. It is written to a temporary file first and then
+#renamed, so the collector never reads a half written file
+
+def write_prometheus(path=None):
+    """Writes the totals of every stage as a Prometheus textfile.
+    Args:
+        path (str, optional): Full path of the textfile. Defaults to prometheus_path.
+    """
+    if path is None:
+        path = prometheus_path
+    if path is None:
+        return
+
+    lines = [
+        '# HELP apod_stage_duration_seconds Time spent in each stage of adding APODs to the cache.',
+        '# TYPE apod_stage_duration_seconds histogram',
+    ]
+    with metrics_lock:
+        for name, totals in sorted(stage_totals.items()):
+            for upper_bound, count in zip(duration_buckets, totals['buckets']):
+                lines.append(f'apod_stage_duration_seconds_bucket{{stage="{name}",le="{upper_bound}"}} {count}')
+            lines.append(f'apod_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {totals["count"]}')
+            lines.append(f'apod_stage_duration_seconds_sum{{stage="{name}"}} {totals["seconds"]:.6f}')
+            lines.append(f'apod_stage_duration_seconds_count{{stage="{name}"}} {totals["count"]}')
+
+        lines.append('# HELP apod_stage_outcomes_total Number of times each stage finished with each outcome.')
+        lines.append('# TYPE apod_stage_outcomes_total counter')
+        for name, totals in sorted(stage_totals.items()):
+            for outcome, count in sorted(totals['outcomes'].items()):
+                lines.append(f'apod_stage_outcomes_total{{stage="{name}",outcome="{outcome}"}} {count}')
+
+        lines.append('# HELP apod_stage_bytes_total Bytes handled by each stage.')
+        lines.append('# TYPE apod_stage_bytes_total counter')
+        for name, totals in sorted(stage_totals.items()):
+            lines.append(f'apod_stage_bytes_total{{stage="{name}"}} {totals["bytes"]}')
+
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temp_path, path)
+    return
+
+
+#When the program ends, the textfile gets the final totals
+
+def write_prometheus_at_exit():
+    if enabled and prometheus_path is not None:
+        write_prometheus()
+
+
+atexit.register(write_prometheus_at_exit)
+
+if os.environ.get('APOD_METRICS_LOG') or os.environ.get('APOD_METRICS_PROM'):
+    configure(os.environ.get('APOD_METRICS_LOG') or None, os.environ.get('APOD_METRICS_PROM') or None)
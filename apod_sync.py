@@ -0,0 +1,375 @@
+'''
+Copies APODs between image caches, so only one computer has to download them from NASA.
+'''
+#Every computer that runs apod_desktop keeps its own image cache, and would download every image from NASA by
+#itself. Instead, one computer can download them and the rest copy them from it, in one of two ways:
+#  - Directly from its cache folder, when it is shared (a network share, or a folder synced some other way)
+#  - Through a bundle: a zip file the cache is exported to, that can be carried to a computer that can't see it
+#Either way, only the APODs whose SHA-256 isn't in this cache yet are copied (and not the ones for dates this cache
+#already has), so syncing again only copies what is new since the last time. Each image is hashed as it is copied and
+#only kept if it is what the other cache says it is.
+#
+#A bundle holds, for each APOD:
+#  apods/<sha256>.json      - Its row (the columns that mean the same thing on every computer), and the name of its image
+#  images/<sha256>.<ext>    - Its image, as it is in the cache
+#Exporting to a bundle that already exists only adds the APODs it doesn't have yet. The images are stored without
+#compressing them again, since they already are.
+#
+#Usage:
+#  python apod_desktop.py export bundle_path
+#  python apod_desktop.py import bundle_path [--workers count] [--limit count]
+#  python apod_desktop.py sync source_path [--workers count] [--limit count]
+#  source_path is the folder of another image cache (or the folder it is in), or a bundle
+
+import argparse     #argparse reads the command line options
+import json         #The rows of the APODs in a bundle are saved as JSON
+import os
+import re           #For taking the path of an image apart, whatever computer it came from
+import sqlite3      #The DB of another cache may not be readable
+import sys
+import threading    #Images being copied at the same time must not be given the same name
+import zipfile      #A bundle is a zip file
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor, as_completed    #The images are copied a few at a time
+import apod_cache
+import apod_desktop
+import image_lib
+
+copy_workers = 8        #Images copied at the same time (a network share is slow to answer, not to send)
+sync_batch_size = 100   #APODs written to the DB in each transaction
+image_path_lock = threading.Lock()     #Held while an image is given its name and moved into place
+image_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')     #The only kinds of file that are copied
+
+#The columns that are copied with each APOD. The path is worked out again for this cache, and how often and how
+#recently the APOD was used belongs to the computer it was used on
+sync_columns = ('title', 'explanation', 'sha256', 'apod_date', 'image_url', 'etag', 'last_modified', 'size', 'phash',
+                'compact_format', 'original_size', 'file_sha256')
+
+
+def export_main():
+    parser = argparse.ArgumentParser(prog='apod_desktop.py export', description='Export the cached APODs to a bundle.')
+    parser.add_argument('bundle', help='bundle file to write (APODs it already has are not added again)')
+    args = parser.parse_args(sys.argv[2:])
+
+    apod_desktop.init_apod_cache(apod_desktop.get_script_dir())
+    if export_apod_cache(args.bundle) is None:
+        sys.exit(1)
+    return
+
+
+def import_main():
+    parser = argparse.ArgumentParser(prog='apod_desktop.py import', description='Add the APODs in a bundle to the cache.')
+    parser.add_argument('bundle', help='bundle file made by the export command')
+    parser.add_argument('--workers', type=int, default=copy_workers, help=f'images copied at the same time (default: {copy_workers})')
+    parser.add_argument('--limit', type=int, help='most APODs to copy in this run')
+    args = parser.parse_args(sys.argv[2:])
+
+    if not zipfile.is_zipfile(args.bundle):
+        print("Error: Not a bundle: " + args.bundle)
+        sys.exit(1)
+    apod_desktop.init_apod_cache(apod_desktop.get_script_dir())
+    if sync_apod_cache(args.bundle, args.workers, args.limit) is None:
+        sys.exit(1)
+    return
+
+
+def sync_main():
+    parser = argparse.ArgumentParser(prog='apod_desktop.py sync', description='Copy the APODs this cache is missing from another cache.')
+    parser.add_argument('source', help='folder of another image cache (or the folder it is in), or a bundle')
+    parser.add_argument('--workers', type=int, default=copy_workers, help=f'images copied at the same time (default: {copy_workers})')
+    parser.add_argument('--limit', type=int, help='most APODs to copy in this run')
+    args = parser.parse_args(sys.argv[2:])
+
+    apod_desktop.init_apod_cache(apod_desktop.get_script_dir())
+    if sync_apod_cache(args.source, args.workers, args.limit) is None:
+        sys.exit(1)
+    return
+
+
+#This function writes every cached APOD the bundle doesn't have yet into it. The image goes in before the row, so
+#a bundle that was only half written (the disk filled up, say) only has images without rows, which are ignored
+
+def export_apod_cache(bundle_path):
+    """Adds the cached APODs to a bundle, unless it has them already.
+    Args:
+        bundle_path (str): Path of the bundle. It is created if it doesn't exist.
+    Returns:
+        int: Number of APODs added to the bundle. None, if the bundle could not be written.
+    """
+    if os.path.exists(bundle_path) and not zipfile.is_zipfile(bundle_path):
+        print("Error: Not a bundle: " + bundle_path)
+        return None
+
+    alias_dates = {}
+    for apod_date, apod_id in apod_desktop.cache_store.get_date_aliases():
+        alias_dates.setdefault(apod_id, []).append(apod_date)
+
+    added = 0
+    try:
+        with zipfile.ZipFile(bundle_path, 'a', zipfile.ZIP_STORED) as bundle:
+            bundle_sha256s = {get_bundle_sha256(name) for name in bundle.namelist()} - {None}
+            for values in apod_desktop.cache_store.get_all_records(('id', 'path') + sync_columns):
+                apod_id, image_path, record = values[0], values[1], dict(zip(sync_columns, values[2:]))
+                if record['sha256'] in bundle_sha256s:
+                    continue
+                record['phash'] = apod_cache.phash_from_db(record['phash'])
+                record['alias_dates'] = alias_dates.get(apod_id, [])
+                record['file'] = 'images/' + record['sha256'] + os.path.splitext(image_path)[1]
+                try:
+                    bundle.write(image_path, record['file'])
+                except FileNotFoundError:
+                    print("Image missing, not exported: " + image_path)
+                    continue
+                bundle.writestr(f"apods/{record['sha256']}.json", json.dumps(record))
+                added += 1
+            bundle_count = len(bundle_sha256s) + added
+    except OSError as error:
+        print(f"Error: Could not write {bundle_path}: {error}")
+        return None
+
+    print(f"Exported {added} APODs to {bundle_path} ({bundle_count} in the bundle)")
+    return added
+
+
+def get_bundle_sha256(member_name):
+    """Gets the SHA-256 of the APOD a file in a bundle is the row of
+    Args:
+        member_name (str): Name of the file in the bundle
+    Returns:
+        str: SHA-256 hash. None, if the file isn't the row of an APOD.
+    """
+    match = re.fullmatch(r'apods/([0-9a-f]{64})\.json', member_name)
+    return match.group(1) if match else None
+
+
+#The places APODs can be copied from. Each one has the rows of its APODs in records (with the path of each image in
+#'file'), and opens their images with open_image
+
+class BundleSource:
+    """The APODs in a bundle"""
+
+    def __init__(self, bundle_path):
+        self.bundle = zipfile.ZipFile(bundle_path)
+        self.records = [json.loads(self.bundle.read(name)) for name in self.bundle.namelist() if get_bundle_sha256(name)]
+
+    def open_image(self, record):
+        """Opens the image of an APOD for reading
+        Args:
+            record (dict): Row of the APOD
+        Returns:
+            file object: The image, in binary mode
+        """
+        return self.bundle.open(record['file'])
+
+    def close(self):
+        """Closes the bundle"""
+        self.bundle.close()
+
+
+class CacheSource:
+    """The APODs in the image cache of another computer"""
+
+    def __init__(self, cache_dir):
+        self.records = apod_cache.read_cache_records(os.path.join(cache_dir, 'image_cache.db'))
+        for record in self.records:
+            record['file'] = os.path.join(cache_dir, *get_cache_relative_path(record['path']))
+
+    def open_image(self, record):
+        """Opens the image of an APOD for reading
+        Args:
+            record (dict): Row of the APOD
+        Returns:
+            file object: The image, in binary mode
+        """
+        return open(record['file'], 'rb')
+
+    def close(self):
+        """Nothing is kept open"""
+        pass
+
+
+def open_source(source_path):
+    """Opens the place to copy APODs from
+    Args:
+        source_path (str): A bundle, the folder of an image cache, or the folder the image cache is in
+    Returns:
+        BundleSource or CacheSource: The source. None, if there is no bundle or cache there.
+    """
+    if os.path.isfile(source_path):
+        return BundleSource(source_path) if zipfile.is_zipfile(source_path) else None
+    for cache_dir in (source_path, os.path.join(source_path, 'imgcache\\'), os.path.join(source_path, 'imgcache')):
+        if os.path.isfile(os.path.join(cache_dir, 'image_cache.db')):
+            return CacheSource(cache_dir)
+    return None
+
+
+#The paths in the DB of another cache are full paths on the computer that made it, which may not even be the same
+#kind of computer as this one. Whatever comes after the imgcache folder is the same wherever the cache is
+
+def get_cache_relative_path(image_path):
+    """Gets the path of an image inside its image cache folder
+    Args:
+        image_path (str): Full path of the image, from the DB of its cache
+    Returns:
+        list: Names of the folders (if any) and the file, from the image cache folder down
+    """
+    parts = [part for part in re.split(r'[\\/]', image_path) if part not in ('', '.', '..')]     #Never outside the cache folder
+    if 'imgcache' in parts:
+        return parts[len(parts) - parts[::-1].index('imgcache'):]
+    return parts[-1:]
+
+
+#This function copies the APODs this cache doesn't have from another cache or a bundle. The images are copied a few
+#at a time, and the APODs are added to the DB a batch at a time as they come in. An image is moved into place before
+#its row is added, so if the sync is stopped the worst that is left behind is an image without a row, which the fsck
+#command finds (and the next sync copies it again)
+
+def sync_apod_cache(source_path, workers=None, limit=None):
+    """Copies the APODs that aren't in the cache from another cache or a bundle.
+    Args:
+        source_path (str): A bundle, the folder of an image cache, or the folder the image cache is in
+        workers (int, optional): Images copied at the same time. Defaults to copy_workers.
+        limit (int, optional): Most APODs to copy. Defaults to all of them.
+    Returns:
+        int: Number of APODs copied. None, if there is nothing to copy from at source_path.
+    """
+    try:
+        source = open_source(source_path)
+    except (OSError, ValueError, zipfile.BadZipFile, sqlite3.Error) as error:
+        print(f"Error: Could not read {source_path}: {error}")
+        return None
+    if source is None:
+        print("Error: No image cache or bundle at " + source_path)
+        return None
+
+    try:
+        cached_sha256s = {image_sha256 for (image_sha256,) in apod_desktop.cache_store.get_all_records(('sha256',))}
+        valid_records = [record for record in source.records if is_valid_record(record)]
+        if len(valid_records) < len(source.records):
+            print(f"{len(source.records) - len(valid_records)} APODs in {source_path} are not valid, they won't be copied")
+        missing_records = [record for record in valid_records if record['sha256'] not in cached_sha256s
+                           and (record['apod_date'] is None or apod_desktop.get_apod_id_from_date(record['apod_date']) == 0)]
+        print(f"{len(source.records)} APODs in {source_path}, {len(missing_records)} of them aren't in the cache")
+        missing_records = missing_records[:limit]
+
+        copied_ids = []
+        pending_apods = []
+        with ThreadPoolExecutor(max_workers=workers or copy_workers) as pool:
+            futures = {pool.submit(copy_apod_image, source, record): record for record in missing_records}
+            for future in as_completed(futures):
+                apod = future.result()
+                if apod is not None:
+                    pending_apods.append(apod)
+                if len(pending_apods) >= sync_batch_size:
+                    copied_ids += add_synced_apods(pending_apods)
+                    pending_apods = []
+        copied_ids += add_synced_apods(pending_apods)
+    finally:
+        source.close()
+
+    print(f"Copied {len(copied_ids)} APODs from {source_path}")
+    apod_desktop.phash_index = None         #Loaded again with the new hashes the next time it's needed
+    apod_desktop.evict_apod_cache(keep_ids=copied_ids)
+    return len(copied_ids)
+
+
+def copy_apod_image(source, record):
+    """Copies the image of an APOD from a source into the cache, and checks it is the image it should be.
+    Args:
+        source (BundleSource or CacheSource): Where the APOD is
+        record (dict): Its row from the source
+    Returns:
+        dict: Values of its columns for the cache DB, with the path the image was moved to. None, if unsuccessful.
+    """
+    try:
+        with source.open_image(record) as image_file:
+            image_copy = image_lib.copy_image_to_file(image_file, apod_desktop.image_cache_dir)
+    except (OSError, KeyError, zipfile.BadZipFile):     #Not there (KeyError, in a bundle), or damaged
+        image_copy = None
+    if image_copy is None:
+        print("Could not copy " + record['file'])
+        return None
+    if image_copy['sha256'] != (record.get('file_sha256') or record['sha256']):
+        print("Image is not the one it should be, not copied: " + record['file'])
+        os.remove(image_copy['path'])
+        return None
+
+    #The image gets the name it would have got if it had been downloaded here. In the title layout, two APODs can
+    #have the same title, so if the name is taken it goes under its hash instead
+
+    extension = get_image_extension(record['file'])
+    with image_path_lock:
+        image_path = apod_desktop.determine_apod_file_path(record['title'], None, record['sha256'], extension)
+        if os.path.exists(image_path):
+            image_path = apod_desktop.determine_sharded_file_path(record['sha256'], extension)
+        if not image_lib.move_image_file(image_copy['path'], image_path):
+            os.remove(image_copy['path'])
+            return None
+
+    apod = {column: record.get(column) for column in sync_columns}
+    apod.update({'path': image_path, 'size': image_copy['size'], 'alias_dates': record.get('alias_dates', [])})
+    return apod
+
+
+#The rows come from another computer, and a bundle could have been made by anyone. The hashes end up in the names of
+#files (and folders) in the cache, so a row is only copied if they really are hashes and the image is a kind of file
+#we know. Otherwise a made-up hash like '../../x' could put a file anywhere
+
+def is_valid_record(record):
+    """Checks that a row from a source can be copied safely
+    Args:
+        record (dict): Row of the APOD from the source
+    Returns:
+        bool: True, if it can be copied
+    """
+    if not isinstance(record, dict) or not is_sha256(record.get('sha256')):
+        return False
+    if record.get('file_sha256') is not None and not is_sha256(record['file_sha256']):
+        return False
+    if not isinstance(record.get('title'), str) or not isinstance(record.get('explanation'), str):
+        return False
+    if not isinstance(record.get('file'), str) or get_image_extension(record['file']) is None:
+        return False
+    dates = record.get('alias_dates', [])
+    if not isinstance(dates, list):
+        return False
+    try:
+        for apod_date in dates + ([record['apod_date']] if record.get('apod_date') is not None else []):
+            date.fromisoformat(apod_date)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def is_sha256(value):
+    """Checks that a value is a SHA-256 hash, as 64 lowercase hex digits"""
+    return isinstance(value, str) and re.fullmatch(r'[0-9a-f]{64}', value) is not None
+
+
+def get_image_extension(file_name):
+    """Gets the extension of an image file, if it is one of image_extensions
+    Args:
+        file_name (str): Name or path of the file
+    Returns:
+        str: The extension, in lowercase with the dot. None, if it isn't an image we copy.
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    return extension if extension in image_extensions else None
+
+
+def add_synced_apods(apods):
+    """Adds the APODs that were copied to the DB, in one transaction
+    Args:
+        apods (list): What copy_apod_image gave back for each APOD
+    Returns:
+        list: IDs of the APODs
+    """
+    if not apods:
+        return []
+    with apod_desktop.cache_store.transaction():
+        apod_ids = apod_desktop.cache_store.add_apods(apods)
+        for apod, apod_id in zip(apods, apod_ids):
+            for apod_date in apod['alias_dates']:
+                if apod_desktop.get_apod_id_from_date(apod_date) == 0:
+                    apod_desktop.cache_store.add_date_alias(apod_date, apod_id)
+    return apod_ids
@@ -1,3 +1,5 @@
+import time                     #Time is taken first, so the startup check can say how long the window took to appear
+startup_time = time.perf_counter()
 from tkinter import *           #We need EVERYTHING from tkinter
 from tkinter import ttk         #For shorter terms, just use ttk
 import inspect                  #Inspect is used for getting the path of the script and the directory
@@ -5,14 +7,34 @@ import os
 import apod_desktop                         #We need APOD desktop for its functions
 import image_lib            #Image library for downloading new APODs
 import ctypes                       #Ctypes is used to make our window a process
-from PIL import ImageTk, Image          #Pillow is only used for two functions to create specific label frames and such
-from tkcalendar import DateEntry            #DateEntry is the calender used when selecting dates
-from datetime import date                           #And with this in mind, we also need datetime
+import sys                          #For the --startup-check option
+from datetime import date, timedelta                #And with this in mind, we also need datetime
+from job_queue import JobQueue                      #Downloads run on background threads so the window never freezes
+from collections import OrderedDict                 #The photo cache keeps its images in least-recently-used order
 
 script_path = os.path.abspath(inspect.getframeinfo(inspect.currentframe()).filename)        #Get the full path of the script
 script_dir = os.path.dirname(script_path)                       #Get the full directory of script
 
-apod_desktop.init_apod_cache(script_dir)        #And initalize the cache in case it does not already exist
+#Pillow and tkcalendar are only imported when they are first needed, and the cache is opened once the window is on
+#the screen (see finish_startup), so the window appears as soon as possible
+
+download_jobs = JobQueue(workers=2)     #The background workers that download APODs for us
+download_counts = {'submitted': 0, 'finished': 0}      #How far through the current set of downloads we are
+
+prefetch_jobs = JobQueue(workers=1)     #A separate worker opens the neighbouring images, so a long download doesn't hold it up
+prefetching = set()                     #APOD IDs being prefetched right now
+
+page_size = 100                         #How many APODs are loaded into the list at a time
+listed_apod_ids = []                    #DB ID of each row of the list
+all_pages_loaded = False                #True once the last page has been loaded
+
+search_delay = 250                      #How many ms typing has to pause for before the search runs
+search_limit = 200                      #Most search results shown in the list
+search_after_id = None                  #The search waiting to run, so it can be cancelled if typing carries on
+searching = False                       #True while the list shows search results instead of every APOD
+
+cache_ready = False                     #True once finish_startup has opened the cache
+date_entry_dateselect = None            #The calendar, made by finish_startup
 
 
 #This is a neat lil function I put together to clear the cache
@@ -23,55 +45,358 @@ def flush():
     return
 
 
-#This function activates whenever an APOD has been selected
-def apod_selection(event):
-    select_apod = box_image_selection.current() + 1     #Increase choice by 1 (change it)
+#The photo cache keeps the images that are ready to display (already decoded and resized into a Tk PhotoImage), so
+#going back to an APOD we have already looked at shows it straight away. It is limited by how much memory the
+#images take up rather than how many there are, and when it is full the least recently shown image is dropped
+
+class PhotoCache:
+    """Ready-to-display PhotoImages by APOD ID, limited to a number of bytes, least recently used first.
+    Only use it from the Tk main thread."""
+
+    def __init__(self, budget):
+        self.budget = budget            #Most bytes the images can use
+        self.photos = OrderedDict()     #APOD ID -> (PhotoImage, bytes used)
+        self.total_size = 0
+
+    def get(self, apod_id):
+        if apod_id not in self.photos:
+            return None
+        self.photos.move_to_end(apod_id)       #Now the most recently used
+        return self.photos[apod_id][0]
+
+    def put(self, apod_id, photo):
+        size = photo.width() * photo.height() * 4      #Tk keeps 4 bytes for every pixel
+        if apod_id in self.photos:
+            self.total_size -= self.photos.pop(apod_id)[1]
+        self.photos[apod_id] = (photo, size)
+        self.total_size += size
+        while self.total_size > self.budget and len(self.photos) > 1:     #Never drop the image we just added
+            self.total_size -= self.photos.popitem(last=False)[1][1]
+
+    def __contains__(self, apod_id):
+        return apod_id in self.photos
 
-    info = apod_desktop.get_apod_info(select_apod)      #Get APOD info
-    imagepath = info['file_path']               #Get the file path from the info received
 
+#This function opens and resizes the image of an APOD so it is ready to go into a PhotoImage. It is safe to run on a
+#worker thread (it doesn't touch Tk), which is how the neighbours of the selected APOD are prefetched. Prefetching
+#isn't the user looking at an APOD, so nothing here counts as a use of it for the cache's LRU/LFU eviction.
+#It gives back None if the APOD was evicted (or its image can't be opened)
 
+def load_display_image(apod_id):
+    #The viewer shows the small preview that was made when the APOD was downloaded, which is much quicker to open than
+    #the full size image. If there is no preview (the image can't be read), fall back to the original
+    imagepath = apod_desktop.get_apod_preview_path(apod_id) or apod_desktop.get_apod_file_path(apod_id)
+    if imagepath is None:
+        return None
+
+    from PIL import Image
     #For image scaling, we scale the provided image to its width and height dimensions before any changes are made.
     #This will create a resized image
-    unsized_image = Image.open(imagepath)           #Get the given picture from the image path                
+    try:
+        unsized_image = Image.open(imagepath)           #Get the given picture from the image path
+    except OSError:         #Evicted since we got the path
+        return None
     size = image_lib.scale_image(image_size=(unsized_image.width, unsized_image.height))      #The size is the the image scaled down
-    global resize
-    resize = unsized_image.resize(size)
+    return unsized_image.resize(size)
+
+
+#This function activates whenever an APOD has been selected
+def apod_selection(event):
+    select_apod = get_selected_apod_id()     #The real ID of the APOD in the DB
+    if select_apod is None:
+        return
+
+    info = apod_desktop.get_apod_info(select_apod)      #Get APOD info
+    if info is None:        #Evicted from the cache since the list was loaded
+        return
+
+    #If the image is in the photo cache (we've shown it before, or prefetched it) it can go straight on the screen.
+    #Otherwise open it now and keep it for next time
+    photo = photo_cache.get(select_apod)
+    if photo is None:
+        display_image = load_display_image(select_apod)
+        if display_image is None:
+            return
+        from PIL import ImageTk
+        photo = ImageTk.PhotoImage(display_image)
+        photo_cache.put(select_apod, photo)
 
     #To be modified by other functions, make the apod image global
     global image_apod
-    image_apod = ImageTk.PhotoImage(resize)     #The image apod will be the resized photo in question
+    image_apod = photo     #The image apod will be the resized photo in question
     label_image.configure(image=image_apod)         #Configure the current image (default.png) to become the image
     label_description.configure(text=info['explanation'], wraplength=root.winfo_width(), justify="left")    #Display the explanation with a wraplength to match the window length of the screen. It will stick to the left so it does not trail off
+
+    prefetch_neighbours(list_image_selection.curselection()[0])
+    return
+
+
+#While the user looks at an APOD, the ones just before and after it in the list are opened in the background, so
+#stepping through the list shows each image straight away
+
+def prefetch_neighbours(index):
+    for neighbour_index in (index + 1, index - 1):
+        if 0 <= neighbour_index < len(listed_apod_ids):
+            apod_id = listed_apod_ids[neighbour_index]
+            if apod_id not in photo_cache and apod_id not in prefetching:
+                prefetching.add(apod_id)
+                prefetch_jobs.submit(lambda job, apod_id: load_display_image(apod_id), apod_id, description=str(apod_id))
+    return
+
+
+#The prefetch jobs hand back PIL images, and only the main thread can turn them into PhotoImages, so this function
+#picks up the finished ones every 100ms and puts them in the photo cache
+
+def poll_prefetch_jobs():
+    for job, event in prefetch_jobs.get_events():
+        if event in ('done', 'failed', 'cancelled'):
+            apod_id = job.args[0]
+            prefetching.discard(apod_id)
+            if event == 'done' and job.result is not None and apod_id not in photo_cache:
+                from PIL import ImageTk
+                photo_cache.put(apod_id, ImageTk.PhotoImage(job.result))
+
+    root.after(100, poll_prefetch_jobs)
+    return
+
+
+#The list of APODs is filled in a page at a time as it is scrolled, instead of loading every title in the cache at
+#startup. listed_apod_ids holds the real DB ID of each row in the list, so a selection always maps to the right APOD
+#even when there are gaps in the IDs
+
+def load_next_page():
+    global all_pages_loaded
+    after_id = listed_apod_ids[-1] if listed_apod_ids else 0
+    page = apod_desktop.get_apod_page(after_id, page_size)
+    for apod_id, apod_date, title in page:
+        listed_apod_ids.append(apod_id)
+        list_image_selection.insert(END, f"{apod_date or '':<12}{title}")     #Older cache entries may not have a date
+    all_pages_loaded = len(page) < page_size
+    return
+
+
+#The list calls this whenever it scrolls (or changes), with the fractions of the list that are showing. When the
+#bottom of what is loaded comes into view, the next page is loaded. Loading a page scrolls the list again, so this
+#keeps going until the loaded rows fill past the bottom of the list, and then stops
+
+def list_scrolled(first, last):
+    scroll_image_selection.set(first, last)
+    if cache_ready and float(last) > 0.9 and not all_pages_loaded:
+        load_next_page()
+    return
+
+
+#This function runs every time the search box changes. Searching on every key press would run a query for each
+#letter typed, so it waits until typing has paused for search_delay ms and only searches for the text then
+
+def search_changed(*args):
+    global search_after_id
+    if search_after_id is not None:
+        root.after_cancel(search_after_id)      #Still typing, so the search that was waiting is no longer needed
+    search_after_id = root.after(search_delay, run_search)
+    return
+
+
+#Shows the APODs that match the search box in the list, best match first. An empty search box goes back to the
+#full list, paged in as before
+
+def run_search():
+    global search_after_id, all_pages_loaded, searching
+    search_after_id = None
+    if not cache_ready:         #finish_startup shows the list once the cache is open
+        return
+    search_text = entry_search_var.get().strip()
+
+    list_image_selection.delete(0, END)
+    listed_apod_ids.clear()
+    searching = search_text != ''
+    if not searching:
+        load_next_page()
+        return
+
+    all_pages_loaded = True         #The search results all come at once, there are no more pages to load
+    for apod_id, apod_date, title in apod_desktop.search_apods(search_text, search_limit):
+        listed_apod_ids.append(apod_id)
+        list_image_selection.insert(END, f"{apod_date or '':<12}{title}")
+    return
+
+
+#Gets the real DB ID of the APOD selected in the list
+
+def get_selected_apod_id():
+    selection = list_image_selection.curselection()
+    if not selection:
+        return None
+    return listed_apod_ids[selection[0]]
+
+
+#This function runs when View Original is pressed. It is the only place the full size image gets opened, and it is
+#shown in its own window, scaled down to fit on the screen. If the APOD was evicted since the list was loaded, or its
+#file is gone, the status line says so instead
+
+def view_original():
+    select_apod = get_selected_apod_id()
+    if select_apod is None:         #Nothing selected yet
+        return
+
+    info = apod_desktop.get_apod_info(select_apod)
+    if info is None:
+        label_downloadstatus.configure(text="That APOD is no longer in the cache")
+        return
+
+    from PIL import Image, ImageTk
+    try:
+        original_image = Image.open(info['file_path'])
+    except OSError:
+        label_downloadstatus.configure(text="The image of that APOD is missing or damaged (apod_desktop.py fsck --repair fixes it)")
+        return
+    screen_size = (root.winfo_screenwidth() - 100, root.winfo_screenheight() - 100)    #Leave a bit of room for the title bar and taskbar
+    if original_image.width > screen_size[0] or original_image.height > screen_size[1]:
+        original_image = original_image.resize(image_lib.scale_image((original_image.width, original_image.height), screen_size))
+
+    window_original = Toplevel(root)
+    window_original.title(info['title'])
+    window_original.image = ImageTk.PhotoImage(original_image)     #Keep a reference on the window so the image isn't thrown away
+    ttk.Label(window_original, image=window_original.image).grid(padx=0, pady=0)
     return
 
 
 #This function is what happens when Set as Desktop is pressed
 
 def setdesktop():
-    select_apod = box_image_selection.current() + 1
+    select_apod = get_selected_apod_id()
+    if select_apod is None:
+        return
 
-    info = apod_desktop.get_apod_info(select_apod)      #Get the APOD info
-    imagepath = info['file_path']                           #Grab the file path
-    image_lib.set_desktop_background_image(imagepath)       #And set as background using it
+    apod_desktop.set_apod_as_desktop_background(select_apod)       #Set it as the background, and keep it in the cache while it is
 
 
-#This function runs when a date is grabbed that responds with an APOD date, it will download
-#the image requested and add it to the cache
+#This function runs when a date is grabbed that responds with an APOD date, it will queue up
+#the images requested so they are downloaded and added to the cache in the background.
+#The Days box says how many days in a row (starting at the selected date) to download
 
 def download_image():
-    date = date_entry_dateselect.get_date()     #We get the current date by using the date_entry get_date function
+    if date_entry_dateselect is None:       #The calendar isn't there yet
+        return
+    start_date = date_entry_dateselect.get_date()     #We get the current date by using the date_entry get_date function
 
-    if date < date.fromisoformat("1995-06-16"):     #If it is too far back, print an error
+    if start_date < date.fromisoformat("1995-06-16"):     #If it is too far back, print an error
         print("Error! Date is too far back!")
         return
-    elif date > date.today():           #If the date exceeds today, print error and cease
+    elif start_date > date.today():           #If the date exceeds today, print error and cease
         print("Error! Date exceeds the current date")
         return
-    apod_desktop.add_apod_to_cache(date)                        #Add the APOD to the cache
-    box_image_selection.configure(values=apod_desktop.get_all_apod_titles())      #Change the selection box to match recently downloaded images
+
+    try:
+        day_count = max(int(spin_daycount.get()), 1)
+    except ValueError:
+        day_count = 1
+
+    if not download_jobs.get_active_jobs():     #Nothing is running, so this is a new set of downloads
+        download_counts['submitted'] = 0
+        download_counts['finished'] = 0
+
+    for day in range(day_count):
+        apod_date = start_date + timedelta(days=day)
+        if apod_date > date.today():        #Don't go past today
+            break
+        download_jobs.submit(download_job, apod_date, description=apod_date.isoformat())
+        download_counts['submitted'] += 1
+
+    label_downloadstatus.configure(text=f"Queued {download_counts['submitted'] - download_counts['finished']} downloads")
+    return
+
+
+#This is what a download job does on its worker thread. It must NOT touch the window, it only reports back through the job
+
+def download_job(job, apod_date):
+    last_reported = [0.0]
+
+    def report_progress(bytes_done, bytes_total):
+        if bytes_total and bytes_done / bytes_total - last_reported[0] >= 0.01:       #Every 1% is plenty for a progress label
+            last_reported[0] = bytes_done / bytes_total
+            job.report_progress(last_reported[0])
+
+    return apod_desktop.add_apod_to_cache(apod_date, progress=report_progress, cancel_event=job.cancel_event)
+
+
+#This function runs when Cancel is pressed. Downloads that haven't started are dropped and the running ones stop.
+#Partly downloaded images are kept, so they resume if they are downloaded again
+
+def cancel_downloads():
+    download_jobs.cancel_all()
+    label_downloadstatus.configure(text="Cancelling...")
     return
 
+
+#Tk can only be used from the main thread, so instead of the download jobs updating the window, this function checks
+#on them every 100ms (using after) and updates the window for them. The selection box is refreshed every time a
+#download finishes, so new images show up one by one
+
+def poll_download_jobs():
+    refresh_titles = False
+    for job, event in download_jobs.get_events():
+        if event == 'started':
+            label_downloadstatus.configure(text=f"Downloading {job.description}...")
+        elif event == 'progress':
+            label_downloadstatus.configure(text=f"Downloading {job.description} ({job.progress:.0%})")
+        elif event in ('done', 'failed', 'cancelled'):
+            download_counts['finished'] += 1
+            if event == 'done' and job.result:
+                refresh_titles = True
+            elif event == 'failed':
+                print(f"Error! Download of {job.description} failed: {job.error}")
+
+            if download_jobs.get_active_jobs():
+                label_downloadstatus.configure(text=f"{download_counts['finished']} of {download_counts['submitted']} done")
+            elif event == 'cancelled':
+                label_downloadstatus.configure(text="Downloads cancelled")
+            else:
+                label_downloadstatus.configure(text=f"Downloaded {download_counts['finished']} of {download_counts['submitted']}")
+
+    if refresh_titles and all_pages_loaded and not searching:     #New APODs always get the highest IDs, so they go on the end of the list
+        load_next_page()
+
+    root.after(100, poll_download_jobs)      #And check again in 100ms
+    return
+
+
+#This function finishes starting up once the window is on the screen: it opens the cache, loads the first page of the
+#list (or the search results, if something was typed already), makes the calendar and starts checking on the jobs.
+#With --startup-check, it prints how long the window took to appear and how long until it was ready, and closes
+#the viewer
+
+def finish_startup():
+    global cache_ready, date_entry_dateselect
+    paint_time = time.perf_counter()
+
+    apod_desktop.init_apod_cache(script_dir)        #And initalize the cache in case it does not already exist
+    cache_ready = True
+    run_search()
+
+    #Create a calendar widget using DateEntry. It is on the right frame and hosts in the format of YYYY-MM-DD. The calendar cannot be edited
+    from tkcalendar import DateEntry
+    date_entry_dateselect = DateEntry(frame_bot_right, date_pattern="YYYY-MM-DD", state="readonly")
+    date_entry_dateselect.grid(row=0, column=1, padx=5, pady=5)
+
+    root.after(100, poll_download_jobs)     #Start checking on the download jobs
+    root.after(100, poll_prefetch_jobs)     #And on the prefetched images
+
+    if '--startup-check' in sys.argv:
+        print(f"first_paint {paint_time - startup_time:.3f}")
+        print(f"ready {time.perf_counter() - startup_time:.3f}")
+        root.after(0, root.destroy)
+    return
+
+
+#The window is drawn when Tk is next idle after it is mapped, so finish_startup waits for the first <Map> and then for
+#the idle after that
+def window_mapped(event):
+    root.unbind("<Map>")
+    root.after_idle(finish_startup)
+    return
+
+
 #This function resizes the image
 #it goes unused since I didn't figure it out in time
 def resize(event):
@@ -89,6 +414,8 @@ root.rowconfigure(2, weight=1)
 root.columnconfigure(0, weight=1)               #And column 0 will have a weight of 1
 root.bind("<Configure>", resize)            #Configure the image and resize it (doesn't resize it)
 
+photo_cache = PhotoCache(64 * 1024 * 1024)  #Keep up to 64MB of images ready to show (about 35 full size previews)
+
 app_id = "APOD"     #Give the app an ID name
 ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(app_id)   #Set it as a process
 root.iconbitmap(os.path.join(script_dir, "poke.ico"))           #Include our icon
@@ -116,8 +443,9 @@ frame_bot_right.grid(row=2, column=2, padx=5, pady=5, sticky=W) #Set up our para
 frame_bot_right.columnconfigure(0, weight=1)
 frame_bot_right.rowconfigure(0, weight=1)
 
-#Setup the default image which will replace the image with whatever APOD is selected. By default it uses the NASA logo
-image_apod = ImageTk.PhotoImage(file=os.path.join(script_dir, "default.png"))
+#Setup the default image which will replace the image with whatever APOD is selected. By default it uses the NASA logo.
+#Tk can open PNGs itself, so Pillow isn't needed for it
+image_apod = PhotoImage(file=os.path.join(script_dir, "default.png"))
 label_image = ttk.Label(frame_top, image=image_apod)    #The label for the image is on the top of the frame and consists of the image
 label_image.grid(padx=0, pady=0)
 
@@ -129,26 +457,54 @@ label_description.grid(padx=20, pady=0, sticky=NSEW)
 label_imageselect = ttk.Label(frame_bot_left, text="Select an Image: ", width=12)
 label_imageselect.grid(row=0, column=0, padx=5, pady=5, sticky=W)
 
-#And right beside it, create a combobox that is read only on the left frame, which holds the value of all the apod_titles
-box_image_selection = ttk.Combobox(frame_bot_left, width=40, state="readonly", values=apod_desktop.get_all_apod_titles())
-box_image_selection.grid(row=0, column=1, padx=5, pady=5, stick=W)
-box_image_selection.set("Select an Image")
-box_image_selection.bind("<<ComboboxSelected>>", apod_selection)
+#And right beside it, create a list with a scrollbar on the left frame, which holds the dates and titles of the apods.
+#Only the rows that have been scrolled to are loaded from the DB
+list_image_selection = Listbox(frame_bot_left, width=50, height=6, exportselection=False)
+list_image_selection.grid(row=0, column=1, padx=(5, 0), pady=5, sticky=W)
+scroll_image_selection = ttk.Scrollbar(frame_bot_left, orient=VERTICAL, command=list_image_selection.yview)
+scroll_image_selection.grid(row=0, column=2, padx=(0, 5), pady=5, sticky=NS)
+list_image_selection.configure(yscrollcommand=list_scrolled)
+list_image_selection.bind("<<ListboxSelect>>", apod_selection)
+
+#Create a search box under the list. The list only shows the APODs whose title or explanation match what is typed
+label_search = ttk.Label(frame_bot_left, text="Search: ")
+label_search.grid(row=1, column=0, padx=5, pady=5, sticky=E)
+entry_search_var = StringVar()
+entry_search_var.trace_add('write', search_changed)
+entry_search = ttk.Entry(frame_bot_left, width=50, textvariable=entry_search_var)
+entry_search.grid(row=1, column=1, padx=5, pady=5, sticky=W)
 
 #Create a button to set an image as the desktop
 btn_imageselect = ttk.Button(frame_bot_left, text="Set as Desktop", command=setdesktop) #The command will run the desktop function
 btn_imageselect.grid(row=0, column=0, padx=5, pady=5, sticky=W)
 
+#Create a button to open the full size image of the selected APOD in its own window
+btn_vieworiginal = ttk.Button(frame_bot_left, text="View Original", command=view_original)
+btn_vieworiginal.grid(row=2, column=0, padx=5, pady=5, sticky=W)
+
 #Create a label that is near the calender
 label_dateselect = ttk.Label(frame_bot_right, text= "Select Date: ")
 label_dateselect.grid(row=0, column=0, padx=5, pady=5)
 
-#Create a calendar widget using DateEntry. It is on the right frame and hosts in the format of YYYY-MM-DD. The calendar cannot be edited
-date_entry_dateselect = DateEntry(frame_bot_right, date_pattern="YYYY-MM-DD", state="readonly")
-date_entry_dateselect.grid(row=0, column=1, padx=5, pady=5)
+#The calendar goes in column 1 here, once finish_startup has made it
+
+#Create a box for how many days in a row to download, starting at the selected date
+label_daycount = ttk.Label(frame_bot_right, text="Days: ")
+label_daycount.grid(row=0, column=2, padx=5, pady=5)
+spin_daycount = ttk.Spinbox(frame_bot_right, from_=1, to=31, width=4)
+spin_daycount.set(1)
+spin_daycount.grid(row=0, column=3, padx=5, pady=5)
 
 #Create a button to download a selected image. The command will run the download image function
 btn_imagedownload = ttk.Button(frame_bot_right, text="Download Image", command=download_image)
-btn_imagedownload.grid(row=0, column=2, padx=5, pady=5)
+btn_imagedownload.grid(row=0, column=4, padx=5, pady=5)
+
+#Create a button to cancel the downloads, and a label underneath that shows how they are going
+btn_canceldownload = ttk.Button(frame_bot_right, text="Cancel", command=cancel_downloads)
+btn_canceldownload.grid(row=0, column=5, padx=5, pady=5)
+label_downloadstatus = ttk.Label(frame_bot_right, text="")
+label_downloadstatus.grid(row=1, column=0, columnspan=6, padx=5, pady=0, sticky=W)
+
+root.bind("<Map>", window_mapped)       #Open the cache and finish starting up once the window is on the screen
 
 root.mainloop()     #loop until the window is closed
\ No newline at end of file
@@ -0,0 +1,267 @@
+'''
+A local stand-in for the NASA APOD API and image server, for benchmarks and for trying things out offline.
+'''
+#The server answers the same queries as api.nasa.gov/planetary/apod (a single date, or a start_date/end_date range)
+#with made up APODs, and serves a synthetic JPEG for each one. Every date gets its own image, so every download has a
+#different SHA-256 just like the real thing. The size of the images and how slow the server is can be set, so
+#benchmarks can run against something that behaves like the real server without touching the network.
+#Like the real server, the images have an ETag and a Last-Modified, answer conditional requests with 304 Not Modified,
+#and send just the bytes asked for with a Range header (unless If-Range says the client's copy is out of date). For
+#trying out resumed downloads, the server can drop the connection part way through the first download of each image.
+#
+#Usage:
+#  python fake_apod_server.py [--port port] [--image-size size] [--latency seconds] [--drop-after bytes]
+#To use it from the other scripts, point apod_api.api_url at the URL it prints
+
+import argparse     #argparse reads the command line options
+import hashlib      #The ETag of each image is its hash
+import io           #The images are made in memory
+import json         #The API answers in JSON
+import random       #The noise in the images comes from a random generator seeded by the date
+import threading    #The server runs on its own thread when started from another script
+import time         #Time is used for the fake latency
+import re           #For reading the Range header
+from datetime import date, datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime     #Last-Modified and If-Modified-Since are HTTP dates
+from functools import lru_cache     #Images are kept after they are made, since making them is slow
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from PIL import Image   #Pillow makes the synthetic images
+
+image_size = 512 * 1024         #Size of each image in bytes
+image_dimensions = (1920, 1080) #Width and height of each image
+latency = 0.0                   #Seconds the server waits before answering each request
+drop_after = None               #Bytes of each image sent before the connection is dropped, the first time it is asked for. None never drops
+dropped_images = set()          #Dates of the images whose connection was already dropped
+api_path = '/planetary/apod'
+image_path_prefix = '/image/'
+
+
+#The main function runs the server until Ctrl+C is pressed
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a local stand-in for the NASA APOD API.')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: 8000)')
+    parser.add_argument('--image-size', type=int, default=image_size, help='size of each image in bytes')
+    parser.add_argument('--latency', type=float, default=latency, help='seconds to wait before answering each request')
+    parser.add_argument('--drop-after', type=int, help='drop the connection after this many bytes of the first download of each image')
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.image_size, args.latency, background=False, drop=args.drop_after)
+    print(f"Fake APOD API at {get_api_url(server)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+    return
+
+
+#This function starts the server. Other scripts (like the benchmarks) start it in the background and stop it with
+#server.shutdown() when they are done
+
+def start_server(port=0, size=None, delay=None, background=True, drop=None):
+    """Starts the fake APOD server.
+    Args:
+        port (int, optional): Port to listen on. Defaults to 0 (any free port).
+        size (int, optional): Size of each image in bytes. Unchanged if not provided.
+        delay (float, optional): Seconds to wait before answering each request. Unchanged if not provided.
+        background (bool, optional): Serve on a background thread. Defaults to True.
+        drop (int, optional): Bytes of each image to send before dropping the connection, the first time it is
+        asked for. Unchanged if not provided.
+    Returns:
+        ThreadingHTTPServer: The server
+    """
+    global image_size, latency, drop_after
+    if size is not None:
+        image_size = size
+    if delay is not None:
+        latency = delay
+    if drop is not None:
+        drop_after = drop
+        dropped_images.clear()
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeApodHandler)
+    server.daemon_threads = True
+    if background:
+        threading.Thread(target=server.serve_forever, name='fake-apod-server', daemon=True).start()
+    return server
+
+
+def get_api_url(server):
+    """Gets the URL of the API of a running fake server, for apod_api.api_url
+    Args:
+        server (ThreadingHTTPServer): The server
+    Returns:
+        str: URL of the APOD endpoint
+    """
+    return f"http://127.0.0.1:{server.server_address[1]}{api_path}"
+
+
+#This function makes up the APOD info for a date, in the same format the real API uses
+
+def make_apod_info(apod_date, base_url):
+    """Makes the APOD info for a date
+    Args:
+        apod_date (date): APOD date
+        base_url (str): URL of the server, for the image URL
+    Returns:
+        dict: Dictionary of APOD info
+    """
+    return {
+        'date': apod_date.isoformat(),
+        'title': f"Synthetic Sky {apod_date.isoformat()}",
+        'explanation': f"A made up picture of the sky on {apod_date.strftime('%B %d, %Y')}, showing a nebula, a galaxy and a few stars.",
+        'media_type': 'image',
+        'service_version': 'v1',
+        'url': f"{base_url}{image_path_prefix}{apod_date.isoformat()}.jpg",
+        'hdurl': f"{base_url}{image_path_prefix}{apod_date.isoformat()}.jpg",
+    }
+
+
+#This function makes the image for a date. A small noise image is blown up to full size so the JPEG is quick to make
+#but still has to be properly decoded, and then padded out to exactly image_size bytes. JPEG decoders ignore anything
+#after the end of the image, so the padding doesn't stop the image from opening
+
+@lru_cache(maxsize=64)
+def make_image(apod_date, size, dimensions):
+    """Makes the synthetic JPEG for a date
+    Args:
+        apod_date (str): APOD date as YYYY-MM-DD
+        size (int): Size of the image in bytes. The JPEG is never cut short, so it can come out bigger.
+        dimensions (tuple): Width and height of the image
+    Returns:
+        bytes: The JPEG
+    """
+    generator = random.Random(apod_date)
+    noise = Image.frombytes('RGB', (64, 36), bytes(generator.getrandbits(8) for i in range(64 * 36 * 3)))
+    image_file = io.BytesIO()
+    noise.resize(dimensions, Image.BILINEAR).save(image_file, 'JPEG', quality=90)
+    image_data = image_file.getvalue()
+    return image_data + bytes(max(size - len(image_data), 0))
+
+
+class FakeApodHandler(BaseHTTPRequestHandler):
+    """Answers the requests to the fake server"""
+
+    protocol_version = 'HTTP/1.1'       #Keep connections open, like the real server
+
+    def log_message(self, format, *args):
+        pass        #Printing every request would slow down (and flood) the benchmarks
+
+    def do_GET(self):
+        if latency > 0:
+            time.sleep(latency)
+
+        url = urlparse(self.path)
+        base_url = f"http://{self.headers.get('Host')}"
+        if url.path == api_path:
+            self.send_api_response({name: values[0] for name, values in parse_qs(url.query).items()}, base_url)
+        elif url.path.startswith(image_path_prefix):
+            self.send_image(url.path[len(image_path_prefix):].split('.')[0])
+        else:
+            self.send_body(404, b'Not found', 'text/plain')
+
+    def send_api_response(self, params, base_url):
+        """Answers an API query for a single date, or a start_date/end_date range"""
+        try:
+            if 'start_date' in params:
+                day = date.fromisoformat(params['start_date'])
+                end_date = date.fromisoformat(params.get('end_date', date.today().isoformat()))
+                apod_infos = []
+                while day <= end_date:
+                    apod_infos.append(make_apod_info(day, base_url))
+                    day += timedelta(days=1)
+                body = apod_infos
+            else:
+                body = make_apod_info(date.fromisoformat(params.get('date', date.today().isoformat())), base_url)
+        except ValueError as error:
+            self.send_body(400, json.dumps({'code': 400, 'msg': str(error)}).encode(), 'application/json')
+            return
+        self.send_body(200, json.dumps(body).encode(), 'application/json')
+
+    def send_image(self, apod_date):
+        """Sends the image for a date, the part of it asked for with Range, or 304 Not Modified if the client already has it"""
+        image_data = make_image(apod_date, image_size, image_dimensions)
+        etag = '"' + hashlib.sha1(image_data).hexdigest() + '"'
+        last_modified = get_last_modified(apod_date)
+        validators = {'ETag': etag, 'Last-Modified': format_datetime(last_modified, usegmt=True)}
+
+        #If-None-Match wins over If-Modified-Since when both are sent, like on a real server
+
+        if_none_match = self.headers.get('If-None-Match')
+        if_modified_since = parse_http_date(self.headers.get('If-Modified-Since'))
+        if (if_none_match == etag or
+                if_none_match is None and if_modified_since is not None and last_modified <= if_modified_since):
+            self.send_response(304)
+            for name, value in validators.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        #A Range is only used if If-Range (when sent) still matches the image. Otherwise the whole image is sent
+
+        start, end = 0, len(image_data) - 1
+        byte_range = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if_range = self.headers.get('If-Range')
+        if byte_range and (if_range is None or if_range in validators.values()):
+            start = int(byte_range.group(1))
+            end = min(int(byte_range.group(2) or end), end)
+            if start > end:
+                self.send_body(416, b'', 'image/jpeg', {'Content-Range': f'bytes */{len(image_data)}'})
+                return
+            validators['Content-Range'] = f'bytes {start}-{end}/{len(image_data)}'
+
+        body = image_data[start:end + 1]
+        if drop_after is not None and apod_date not in dropped_images:      #Cut the connection part way through
+            dropped_images.add(apod_date)
+            self.send_body(206 if 'Content-Range' in validators else 200, body, 'image/jpeg', validators, max(drop_after - start, 0))
+            return
+        self.send_body(206 if 'Content-Range' in validators else 200, body, 'image/jpeg', validators)
+
+    def send_body(self, status, body, content_type, headers=None, drop_at=None):
+        """Sends a whole response, or only the first drop_at bytes of the body before closing the connection"""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if drop_at is not None:
+            self.wfile.write(body[:drop_at])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+#Small helpers for the HTTP dates
+
+def get_last_modified(apod_date):
+    """Gets when the image for a date was last changed: midday (UTC) on the day itself
+    Args:
+        apod_date (str): APOD date as YYYY-MM-DD
+    Returns:
+        datetime: Time the image was last changed
+    """
+    try:
+        return datetime.combine(date.fromisoformat(apod_date), datetime.min.time(), timezone.utc) + timedelta(hours=12)
+    except ValueError:
+        return datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+def parse_http_date(text):
+    """Reads an HTTP date, like "Wed, 21 Oct 2015 07:28:00 GMT"
+    Args:
+        text (str): The date (or None)
+    Returns:
+        datetime: The date. None, if there isn't one or it can't be read.
+    """
+    try:
+        return parsedate_to_datetime(text)
+    except (TypeError, ValueError):
+        return None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+'''
+Library for sending HTTP requests through one shared session.
+'''
+#Every request in the project goes through the same requests.Session. The session keeps its connections open
+#(keep-alive) so talking to api.nasa.gov or apod.nasa.gov again reuses the connection instead of paying for a new
+#TCP and TLS handshake each time.
+#requests takes a while to import, so it is only imported when the first request is made. Runs that never touch the
+#network (like setting the wallpaper to an APOD that is already cached) never pay for it.
+
+import threading    #The lock makes sure two threads don't both create the session
+import time         #Time is used to wait between retries
+
+pool_size = 16          #How many connections are kept open to each host. Should be at least the number of download workers
+pool_hosts = 8          #How many different hosts get their own connection pool
+default_timeout = 30    #Seconds to wait for a server if the caller doesn't say otherwise
+accept_encoding = 'gzip, deflate'   #Ask servers to compress their responses (the JSON from the API shrinks a lot)
+
+session = None                      #The shared session, created the first time it is needed
+session_lock = threading.Lock()
+
+
+#The main function is used for testing purposes only. It makes a couple of requests and prints the pool statistics
+
+def main():
+    get('https://api.nasa.gov/planetary/apod', params={'api_key': 'DEMO_KEY'})
+    get('https://api.nasa.gov/planetary/apod', params={'api_key': 'DEMO_KEY'})
+    print(get_pool_stats())
+    return
+
+
+#This function sets up the session. It can be called before any requests are made to change the pool size
+#or the default timeout. Calling it again throws away the old session (and its open connections)
+
+def configure_session(size=None, hosts=None, timeout=None):
+    """Sets the connection pool size and default timeout of the shared session.
+    Any open connections of the previous session are closed.
+    Args:
+        size (int, optional): Connections kept open to each host. Unchanged if not provided.
+        hosts (int, optional): Number of hosts that get a connection pool. Unchanged if not provided.
+        timeout (float, optional): Default timeout in seconds. Unchanged if not provided.
+    """
+    global pool_size, pool_hosts, default_timeout, session
+
+    if size is not None:
+        pool_size = size
+    if hosts is not None:
+        pool_hosts = hosts
+    if timeout is not None:
+        default_timeout = timeout
+
+    with session_lock:
+        if session is not None:
+            session.close()
+        session = None      #The next request builds a new session with the new settings
+    return
+
+
+#This function hands out the shared session, creating it the first time it is needed
+
+def get_session():
+    """Gets the shared HTTP session, creating it if it does not exist yet.
+    Returns:
+        requests.Session: The shared session
+    """
+    global session
+
+    with session_lock:
+        if session is None:
+            import requests     #Requests does the actual HTTP work
+            from requests.adapters import HTTPAdapter   #The adapter is where the size of the connection pools is set
+            new_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)   #Keep up to pool_size connections open per host
+            new_session.mount('https://', adapter)
+            new_session.mount('http://', adapter)
+            new_session.headers['Accept-Encoding'] = accept_encoding
+            session = new_session
+        return session
+
+
+#This function is what the rest of the project uses instead of requests.get. It fills in the default timeout
+#and can retry requests that failed because the server was busy or could not be reached
+
+def get(url, params=None, headers=None, timeout=None, retries=0, backoff=1.0, stream=False):
+    """Sends a GET request through the shared session.
+    Connection errors, timeouts and server errors (429 and 5xx) are retried
+    with an exponential backoff between attempts.
+    Args:
+        url (str): URL to request
+        params (dict, optional): Query string parameters
+        headers (dict, optional): Extra request headers
+        timeout (float, optional): Seconds to wait for the server. Defaults to default_timeout.
+        retries (int, optional): Number of extra attempts. Defaults to 0.
+        backoff (float, optional): Seconds before the first retry, doubled after every attempt. Defaults to 1.0.
+        stream (bool, optional): Don't read the response body straight away. Defaults to False.
+    Returns:
+        requests.Response: Response of the last attempt
+    Raises:
+        requests.RequestException: If the server could not be reached on any attempt
+    """
+    import requests
+    if timeout is None:
+        timeout = default_timeout
+
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))    #Wait 1x, 2x, 4x... the backoff before trying again
+
+        try:
+            response = get_session().get(url, params=params, headers=headers, timeout=timeout, stream=stream)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:      #Out of attempts, let the caller deal with it
+                raise
+            continue
+
+        if response.status_code != 429 and response.status_code < 500:   #Only a busy or broken server is worth asking again
+            return response
+        if attempt < retries:
+            response.close()    #Hand the connection back to the pool before we retry
+
+    return response
+
+
+#This function counts how many connections the session has opened compared to how many requests it has sent.
+#Every request that didn't need a new connection reused one that was already open
+
+def get_pool_stats():
+    """Gets the connection statistics of the shared session.
+    Returns:
+        dict: Number of connections opened, requests sent, requests that reused a
+        connection, and the reuse rate (0 to 1), in total and per host
+    """
+    stats = {'opened': 0, 'requests': 0, 'reused': 0, 'reuse_rate': 0.0, 'hosts': {}}
+    if session is None:
+        return stats
+
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools.get(pool_key)
+            if pool is None:        #The pool was thrown out while we were looking
+                continue
+            host_stats = stats['hosts'].setdefault(pool.host, {'opened': 0, 'requests': 0, 'reused': 0})
+            host_stats['opened'] += pool.num_connections
+            host_stats['requests'] += pool.num_requests
+            host_stats['reused'] += max(pool.num_requests - pool.num_connections, 0)
+
+    for host_stats in stats['hosts'].values():
+        stats['opened'] += host_stats['opened']
+        stats['requests'] += host_stats['requests']
+        stats['reused'] += host_stats['reused']
+
+    if stats['requests'] > 0:
+        stats['reuse_rate'] = stats['reused'] / stats['requests']
+    return stats
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,46 @@
 Library of useful functions for working with images.
 '''
 
-import requests #Requests is used to download the images needed
-import ctypes    #Ctypes is used to use user32.dll to set the background
+#Requests (for downloading) and Pillow (for previews) are slow to import, so they are only imported by the functions
+#that use them. Setting the wallpaper to an image that is already cached needs neither of them
+
+import http_lib  #All downloads go through the shared session in http_lib so connections get reused
+import apod_metrics     #Times the downloads, and the hashing and writing inside them
+import wallpaper_lib    #Sets the background, with the backend for whichever desktop we are on
+import threading    #Threading gives us the locks that limit how many downloads hit one server at once
+import hashlib      #Hashlib hashes the images while they download
+import os           #Os is used to move finished downloads into place and to clean up failed ones
+import json         #Json saves the ETag of a partial download next to it
+import tempfile     #The last wallpaper is remembered in the temporary folder when there is no wallpaper_dir
+import time         #Time is used to wait between attempts at a download
+from concurrent.futures import ThreadPoolExecutor, as_completed    #The thread pool runs many downloads at the same time
+from urllib.parse import urlparse   #We need the host name of each URL for the per-host limits
+from collections import OrderedDict     #The preview cache keeps its previews in least-recently-used order
+
+download_timeout = 30       #Seconds to wait for a server before giving up on a download
+download_retries = 3        #How many extra attempts a failed download gets
+download_backoff = 1.0      #Seconds to wait before the first retry. It doubles after every attempt
+download_workers = 8        #How many downloads the download engine runs at the same time
+download_host_limit = 4     #How many of those downloads can go to the same server at once
+download_chunk_size = 64 * 1024     #How many bytes of an image are read (and written to disk) at a time
+preview_size = (800, 600)           #Previews are made to fit the image area of the APOD viewer
+preview_quality = 85                #JPEG quality of the previews
+wallpaper_dir = None                #Folder the wallpapers are rendered to the size of the screen in. None sets the image as it is
+wallpaper_quality = 92              #JPEG quality of the rendered wallpapers
+compact_extensions = {'webp': '.webp', 'jpeg': '.jpg'}     #Formats the cached images can be compacted to, and their file extension
+
+#The luminance quantization table from the JPEG standard. Encoders scale it by the quality they were given, so
+#comparing an image's own table to it tells us roughly what quality it was saved at
+jpeg_luminance_table = (
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+)
 
 #The main function is used for testing purposes only. The functions are called individually in apod_desktop
 #For testing purposes, I downloaded a jpg I hosted on a web server from a Kali Linux VM
@@ -15,21 +53,473 @@ def main():
 
 #This function downloads whatever image is specified in the parameter. It does not save it to the disk, rather it grabs the request contents of said file, which it can later use to write to a file
 
-def download_image(image_url):
+def download_image(image_url, timeout=None, retries=None, backoff=None):
     """Downloads an image from a specified URL.
     DOES NOT SAVE THE IMAGE FILE TO DISK.
+    Connection errors, timeouts and server errors (429 and 5xx) are retried
+    with an exponential backoff between attempts.
     Args:
         image_url (str): URL of image
+        timeout (float, optional): Seconds to wait for the server. Defaults to download_timeout.
+        retries (int, optional): Number of extra attempts. Defaults to download_retries.
+        backoff (float, optional): Seconds before the first retry. Defaults to download_backoff.
     Returns:
         bytes: Binary image data, if succcessful. None, if unsuccessful.
     """
-    
-    request = requests.get(image_url) #Get the image data with requests.get
-    
+    if timeout is None:
+        timeout = download_timeout
+    if retries is None:
+        retries = download_retries
+    if backoff is None:
+        backoff = download_backoff
+
+    import requests     #Requests is used to download the images needed
+    try:
+        request = http_lib.get(image_url, timeout=timeout, retries=retries, backoff=backoff) #Get the image data through the shared session
+    except requests.RequestException:      #The server never answered, even after retrying
+        return None
+
     if request.ok: #If we recieve the OK signal, then return the contents
         return request.content
     else: #Otherwise, something screwed up
         return None
+
+
+#This is the streaming version of download_image. Instead of holding the whole image in memory, it is written to a
+#temporary file a chunk at a time and hashed as the bytes arrive, so memory use is the same for any size of image.
+#The temporary file ends in .part and only gets its real name later with move_image_file, so a crash part way
+#through never leaves a half-written image at a real path.
+#
+#The .part file is named after the URL, so if the connection drops (in this run or one that crashed) the next
+#attempt picks up where the last one stopped using an HTTP Range request. The ETag/Last-Modified of the response
+#that started the file is kept next to it in a .part.json file and sent as If-Range, so if the image changed on
+#the server in the meantime we get the whole new image instead of the end of the new one glued to the old one.
+#
+#If the ETag or Last-Modified of an image we already have are passed in, the server can answer 304 Not Modified
+#and nothing is downloaded at all. The whole download is timed as the 'download' stage, and the time spent hashing
+#and writing the chunks as 'hash' and 'file_write'
+
+def download_image_to_file(image_url, download_dir, timeout=None, retries=None, backoff=None, etag=None, last_modified=None,
+                           progress=None, cancel_event=None):
+    """Downloads an image from a specified URL into a temporary file,
+    resuming a partial download of the same URL if there is one.
+    Args:
+        image_url (str): URL of image
+        download_dir (str): Directory to create the temporary file in. Should be on the same
+        disk as the final image path so the file can be moved into place instantly.
+        timeout (float, optional): Seconds to wait for the server. Defaults to download_timeout.
+        retries (int, optional): Number of extra attempts. Defaults to download_retries.
+        backoff (float, optional): Seconds before the first retry. Defaults to download_backoff.
+        etag (str, optional): ETag of a copy we already have. Only download if the image has changed.
+        last_modified (str, optional): Last-Modified of a copy we already have. Only download if the image has changed.
+        progress (callable, optional): Called as progress(bytes_done, bytes_total) as the image arrives.
+        bytes_total is None if the server didn't say how big the image is.
+        cancel_event (threading.Event, optional): Stops the download when set. The partial download is
+        kept, so it can be resumed later.
+    Returns:
+        dict: Path of the temporary file ('path'), SHA-256 hash of the image ('sha256'), its size in
+        bytes ('size'), and the 'etag' and 'last_modified' validators the server sent (None if it didn't),
+        if successful. If the server says our copy is still current, 'not_modified' is True and there is
+        no 'path'. None, if unsuccessful.
+    """
+    if timeout is None:
+        timeout = download_timeout
+    if retries is None:
+        retries = download_retries
+    if backoff is None:
+        backoff = download_backoff
+
+    with apod_metrics.stage('download', url=image_url) as download_stage:
+        image_download = download_part_file(image_url, download_dir, timeout, retries, backoff, etag, last_modified,
+                                            progress, cancel_event)
+        if image_download is None:
+            download_stage.outcome = 'cancelled' if cancel_event is not None and cancel_event.is_set() else 'failed'
+        elif image_download.get('not_modified'):
+            download_stage.outcome = 'not_modified'
+        else:
+            download_stage.bytes = image_download['size']
+    return image_download
+
+
+#This function does the work of download_image_to_file, with every argument filled in
+
+#The .part file of a URL is named after the URL, so a download that was stopped can be found and resumed. Only one
+#download at a time may write to it, so it is locked with a .part.lock file that only one download can create. A
+#download of the same URL that starts while it is locked (the viewer and the daemon both fetching the same APOD, say)
+#uses a .part file of its own, which is thrown away if it doesn't finish. A finished .part file is renamed to a name
+#of its own before the lock is let go, so the next download of the URL can't start over on top of it
+
+def download_part_file(image_url, download_dir, timeout, retries, backoff, etag, last_modified, progress, cancel_event):
+    """Downloads an image into a .part file. See download_image_to_file.
+    Returns:
+        dict: The same as download_image_to_file
+    """
+    url_hash = hashlib.sha1(image_url.encode()).hexdigest()
+    shared_path = os.path.join(download_dir, url_hash + '.part')
+    private_path = os.path.join(download_dir, f'{url_hash}-{os.getpid()}-{threading.get_ident()}.part')
+
+    locked = lock_partial_download(shared_path)
+    temp_path = shared_path if locked else private_path
+    try:
+        image_download = download_into_part_file(image_url, temp_path, timeout, retries, backoff, etag, last_modified,
+                                                 progress, cancel_event)
+        if image_download is not None and 'path' in image_download and locked:
+            os.replace(shared_path, private_path)
+            image_download['path'] = private_path
+        elif image_download is None and not locked:     #Nobody would ever resume it
+            remove_partial_download(private_path)
+    finally:
+        if locked:
+            unlock_partial_download(shared_path)
+    return image_download
+
+
+def download_into_part_file(image_url, temp_path, timeout, retries, backoff, etag, last_modified, progress, cancel_event):
+    """Downloads an image into a .part file, resuming it if part of it is already there.
+    Args:
+        image_url (str): URL of image
+        temp_path (str): Path of the .part file. No other download may be using it.
+        The other arguments are the same as download_image_to_file
+    Returns:
+        dict: The same as download_image_to_file
+    """
+    import requests     #Requests is used to download the images needed
+    validators_path = temp_path + '.json'
+    hash_timer = apod_metrics.accumulator('hash')
+    write_timer = apod_metrics.accumulator('file_write')
+
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+        #Byte ranges only make sense on the raw bytes, so ask the server not to compress the image
+
+        headers = {'Accept-Encoding': 'identity'}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+
+        #If part of the image is already on disk, and we know which version of the image it is, only ask for the rest
+
+        partial_size = get_file_size(temp_path)
+        partial_validator = read_partial_validator(validators_path)
+        if partial_size > 0 and partial_validator is not None:
+            headers['Range'] = f'bytes={partial_size}-'
+            headers['If-Range'] = partial_validator
+
+        #This loop does the retrying (so it can resume), so http_lib only gets one attempt each time around
+
+        try:
+            request = http_lib.get(image_url, headers=headers, timeout=timeout, retries=0, stream=True)
+        except requests.RequestException:
+            continue
+
+        with request:       #Always give the connection back to the pool, even if something fails
+            if request.status_code == 304:      #Our copy is still the current one
+                return {'not_modified': True, 'sha256': None, 'size': 0, 'etag': etag, 'last_modified': last_modified}
+
+            if request.status_code == 416:      #The server doesn't like our range (the .part file must be broken), so start again
+                remove_partial_download(temp_path)
+                continue
+
+            if request.status_code == 429 or request.status_code >= 500:      #Busy or broken, so it's worth asking again
+                continue
+
+            if not request.ok:
+                return None
+
+            response_etag = request.headers.get('ETag')
+            response_last_modified = request.headers.get('Last-Modified')
+
+            content_length = request.headers.get('Content-Length')
+            bytes_total = int(content_length) if content_length is not None else None
+
+            hasher = hashlib.sha256()
+            if request.status_code == 206:
+                if not request.headers.get('Content-Range', '').startswith(f'bytes {partial_size}-'):   #Not the piece we asked for, so start again
+                    remove_partial_download(temp_path)
+                    continue
+                mode = 'ab'     #The server sent the rest of the image. The part we have still needs to go through the hash
+                with hash_timer:
+                    hash_file(temp_path, hasher)
+                size = partial_size
+                if bytes_total is not None:
+                    bytes_total += partial_size
+            else:
+                mode = 'wb'     #The server sent the whole image (it may have changed), so start the file over
+                size = 0
+                write_partial_validator(validators_path, response_etag or response_last_modified)
+
+            try:
+                with open(temp_path, mode) as f:
+                    for chunk in request.iter_content(chunk_size=download_chunk_size):
+                        if cancel_event is not None and cancel_event.is_set():     #Stop here, what we have so far can be resumed
+                            return None
+                        with hash_timer:
+                            hasher.update(chunk)        #Hash the bytes as they come in, so we never need to read the file again
+                        with write_timer:
+                            f.write(chunk)
+                        size += len(chunk)
+                        if progress is not None:
+                            progress(size, bytes_total)
+                    with write_timer:
+                        f.flush()
+                        os.fsync(f.fileno())        #Make sure the bytes are really on disk before the file can get its real name
+            except (requests.RequestException, OSError):     #The connection dropped. Keep what we have and try again for the rest
+                continue
+
+        if os.path.exists(validators_path):
+            os.remove(validators_path)      #The download is done, so the .part file is no longer partial
+        hash_timer.record(size=size)
+        write_timer.record(size=size)
+        return {'path': temp_path, 'sha256': hasher.hexdigest(), 'size': size,
+                'etag': response_etag, 'last_modified': response_last_modified}
+
+    return None
+
+
+#Small helpers for download_image_to_file. They look after the .part file of a partial download and the
+#.part.json file next to it that remembers which version of the image the partial download is of
+
+def get_file_size(file_path):
+    """Gets the size of a file
+    Args:
+        file_path (str): Path of file
+    Returns:
+        int: Size of the file in bytes. Zero, if it does not exist.
+    """
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+def read_partial_validator(validators_path):
+    """Reads the ETag (or Last-Modified) saved for a partial download
+    Args:
+        validators_path (str): Path of the .part.json file
+    Returns:
+        str: The validator, if there is one. None, if there isn't.
+    """
+    try:
+        with open(validators_path) as f:
+            return json.load(f).get('validator')
+    except (OSError, ValueError):
+        return None
+
+
+def write_partial_validator(validators_path, validator):
+    """Saves the ETag (or Last-Modified) of a download that is starting, so it can be resumed later
+    Args:
+        validators_path (str): Path of the .part.json file
+        validator (str): ETag or Last-Modified of the response. None if the server sent neither,
+        in which case the download can't be safely resumed.
+    """
+    if validator is None:
+        if os.path.exists(validators_path):
+            os.remove(validators_path)
+        return
+    with open(validators_path, 'w') as f:
+        json.dump({'validator': validator}, f)
+
+
+def lock_partial_download(temp_path):
+    """Locks the .part file of a download, so no other download writes to it at the same time
+    Args:
+        temp_path (str): Path of the .part file
+    Returns:
+        bool: True, if it was locked. False, if another download has it locked.
+    """
+    try:
+        os.close(os.open(temp_path + '.lock', os.O_CREAT | os.O_EXCL | os.O_WRONLY))     #Only one of us can create it
+        return True
+    except OSError:
+        return False
+
+
+def unlock_partial_download(temp_path):
+    """Lets go of the lock from lock_partial_download
+    Args:
+        temp_path (str): Path of the .part file
+    """
+    try:
+        os.remove(temp_path + '.lock')
+    except OSError:
+        pass
+
+
+def remove_partial_download(temp_path):
+    """Deletes a partial download and its saved validator
+    Args:
+        temp_path (str): Path of the .part file
+    """
+    for file_path in (temp_path, temp_path + '.json'):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+#Hashes a file that is already on disk, a chunk at a time
+
+def hash_file(file_path, hasher=None):
+    """Gets the SHA-256 hash of a file on disk, without loading all of it into memory
+    Args:
+        file_path (str): Path of file
+        hasher (hashlib object, optional): Hash to feed the file into. Defaults to a new SHA-256.
+    Returns:
+        str: SHA-256 hash of the file (of everything fed into hasher, if it was given)
+    """
+    if hasher is None:
+        hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(download_chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+#The same, but the file is mapped into memory and handed to the hash in one go. There is no copying into a Python
+#buffer a chunk at a time, and hashlib lets go of the GIL while it hashes a big buffer
+
+def hash_file_mmap(file_path):
+    """Gets the SHA-256 hash of a file on disk by mapping it into memory
+    Args:
+        file_path (str): Path of file
+    Returns:
+        str: SHA-256 hash of the file
+    """
+    import mmap
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:       #An empty file can't be mapped
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            return hashlib.sha256(mapped_file).hexdigest()
+
+
+#This function checks a batch of image files for the fsck command. It runs in a process of its own, and is given a
+#few hundred files at a time so sending the work to the process doesn't cost more than the checking. A file that
+#isn't the size it should be is corrupt without having to hash it
+
+def check_image_files(records, quick=False):
+    """Checks that image files are there and hold the bytes they should
+    Args:
+        records (list): (id, path, sha256, size) of each image. size can be None if it isn't known.
+        quick (bool, optional): Only check that each file is there and the right size, without hashing it. Defaults to False.
+    Returns:
+        list: (id, problem) of each image with a problem, where problem is 'missing' or 'corrupt'
+    """
+    problems = []
+    for image_id, image_path, image_sha256, image_size in records:
+        try:
+            if image_size is not None and os.path.getsize(image_path) != image_size:
+                problems.append((image_id, 'corrupt'))
+            elif not quick and hash_file_mmap(image_path) != image_sha256:
+                problems.append((image_id, 'corrupt'))
+            elif quick and image_size is None and not os.path.isfile(image_path):
+                problems.append((image_id, 'missing'))
+        except FileNotFoundError:
+            problems.append((image_id, 'missing'))
+        except OSError:         #There, but it can't be read
+            problems.append((image_id, 'corrupt'))
+    return problems
+
+
+#Once a download from download_image_to_file has been checked, this function gives it its real name.
+#os.replace is atomic, so the image is either fully at its path or not there at all
+
+def move_image_file(temp_path, image_path):
+    """Moves a downloaded image file from its temporary path to its final path.
+    Args:
+        temp_path (str): Path of the temporary file from download_image_to_file
+        image_path (str): Path to save image file
+    Returns:
+        bool: True, if succcessful. False, if unsuccessful
+    """
+    try:
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)     #The content-addressed layout keeps images in subfolders
+        os.replace(temp_path, image_path)
+        return True
+    except OSError:
+        return False
+
+
+#When an image comes from another cache instead of the server, this function copies it into a temporary .part file
+#the same way download_image_to_file would, hashing it on the way, so it can be checked and moved into place the same
+
+def copy_image_to_file(image_file, download_dir):
+    """Copies an image into a temporary file.
+    Args:
+        image_file (file object): The image, open for reading in binary mode
+        download_dir (str): Directory to create the temporary file in
+    Returns:
+        dict: Path of the temporary file ('path'), SHA-256 hash of the image ('sha256') and its size in bytes ('size'),
+        if successful. None, if unsuccessful.
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        temp_fd, temp_path = tempfile.mkstemp(suffix='.part', dir=download_dir)
+    except OSError:
+        return None
+    try:
+        with os.fdopen(temp_fd, 'wb') as temp_file:
+            for chunk in iter(lambda: image_file.read(download_chunk_size), b''):
+                hasher.update(chunk)
+                temp_file.write(chunk)
+                size += len(chunk)
+    except OSError:
+        os.remove(temp_path)
+        return None
+    return {'path': temp_path, 'sha256': hasher.hexdigest(), 'size': size}
+
+
+#The download engine runs download_image on a pool of threads so many images download at the same time.
+#Each server gets its own lock (a semaphore) so we don't hammer one host with every worker at once.
+#The results come back in the order they finish, not the order they were asked for
+
+def download_images(image_urls, workers=None, host_limit=None, timeout=None, retries=None, backoff=None, download_dir=None):
+    """Downloads many images at the same time.
+    DOES NOT SAVE THE IMAGE FILES TO DISK, unless download_dir is given, in which case
+    each image is streamed to a temporary file by download_image_to_file.
+    Args:
+        image_urls (iterable[str]): URLs of images
+        workers (int, optional): Number of downloads running at once. Defaults to download_workers.
+        host_limit (int, optional): Number of downloads running at once against one host. Defaults to download_host_limit.
+        timeout (float, optional): Seconds to wait for the server. Defaults to download_timeout.
+        retries (int, optional): Number of extra attempts per image. Defaults to download_retries.
+        backoff (float, optional): Seconds before the first retry. Defaults to download_backoff.
+        download_dir (str, optional): Directory to stream the images into. Defaults to keeping them in memory.
+    Yields:
+        tuple[str, bytes]: URL and binary image data (None, if unsuccessful) of each image as it finishes.
+        With download_dir, the dict from download_image_to_file takes the place of the binary data.
+    """
+    if workers is None:
+        workers = download_workers
+    if host_limit is None:
+        host_limit = download_host_limit
+
+    host_locks = {}     #One semaphore per host name, created the first time we see the host
+
+    def download_with_host_limit(image_url):
+        with host_locks[urlparse(image_url).netloc]:
+            if download_dir is not None:
+                return download_image_to_file(image_url, download_dir, timeout, retries, backoff)
+            return download_image(image_url, timeout, retries, backoff)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for image_url in image_urls:
+            host = urlparse(image_url).netloc
+            if host not in host_locks:
+                host_locks[host] = threading.BoundedSemaphore(host_limit)
+            futures[pool.submit(download_with_host_limit, image_url)] = image_url
+
+        for future in as_completed(futures):     #Hand back each image as soon as it is done
+            image_url = futures.pop(future)     #Forget the finished download so its data isn't held until the end
+            try:
+                image_data = future.result()
+            except Exception:      #A download that blew up is just a failed download
+                image_data = None
+            yield image_url, image_data
     
 
 #This function will save the contents of the images downloaded. It will specify a path to save it in and the data sent to it. It is essentially binary data of the image
@@ -54,26 +544,400 @@ def save_image_file(image_data, image_path):
         return True
 
 
-#This function will set the image as the background. Remember that these functions will be frequently called individually by apod_desktop and mainly serves as a library of functions
+#This function will set the image as the background. Remember that these functions will be frequently called individually by apod_desktop and mainly serves as a library of functions.
+#The desktop doesn't get the full size image. Most APODs are far bigger (or smaller) than the screen, and the desktop
+#would decode and scale the whole thing every time it draws the wallpaper, so a copy made exactly the size of the
+#screen is rendered into wallpaper_dir first. If the image is already the wallpaper, nothing is done at all
 
-def set_desktop_background_image(image_path):
+def set_desktop_background_image(image_path, backend=None):
     """Sets the desktop background image to a specific image.
     Args:
         image_path (str): Path of image file
+        backend (wallpaper_lib.WallpaperBackend, optional): Backend to set it with. Defaults to the one for this desktop.
     Returns:
         bytes: True, if succcessful. False, if unsuccessful        
     """
+    if backend is None:
+        backend = wallpaper_lib.get_backend()
+    if backend is None:
+        print("Error: Don't know how to set the wallpaper on this desktop (set APOD_WALLPAPER_BACKEND)")
+        return False
 
-    #The strategy is to use Ctypes to set the background since it allows us to operate Windows drivers, especially user32.dll which manages the Desktop. By specifying the SETDESKWALLPAPER, we can specify the height and width of the image (not relevant since it will be scaled later). User32.dll will set the Desktop background using the image_path. If we recieve any type of error, just return False
-  
+    source_path = os.path.abspath(image_path)
     try:
-        SPI_SETDESKWALLPAPER = 20
-        ctypes.windll.user32.SystemParametersInfoW(SPI_SETDESKWALLPAPER, 0, image_path, 3)   #Set the image as the Desktop Background
+        source_mtime = os.stat(source_path).st_mtime_ns
+    except OSError:
+        return False
+
+    screen_size = backend.get_screen_size() if wallpaper_dir is not None else None
+    wallpaper_path = render_wallpaper(source_path, screen_size) if screen_size else None
+    if wallpaper_path is None:      #Couldn't find out the screen size or render the image, so the desktop can scale it
+        wallpaper_path = source_path
+
+    #We remember what we last set. If it's the same image, it hasn't changed since, and the desktop still shows it (or
+    #can't say what it shows), setting it again would only make the desktop decode it again
+    state = read_wallpaper_state()
+    current_path = backend.get_current()
+    if (state.get('backend') == backend.name and state.get('source') == source_path
+            and state.get('source_mtime') == source_mtime and state.get('wallpaper') == wallpaper_path
+            and (current_path is None or is_same_path(current_path, wallpaper_path))):
         return True
-    except:          #If any error, return False and get outta there!
+
+    if not backend.apply(wallpaper_path):
         return False
-    
-    return
+    write_wallpaper_state({'backend': backend.name, 'source': source_path, 'source_mtime': source_mtime,
+                           'wallpaper': wallpaper_path})
+    remove_old_wallpapers(wallpaper_path)
+    return True
+
+
+#This function asks the desktop which image is on it right now, so the cache never deletes it from under the desktop.
+#If it's a wallpaper we rendered, the image it was rendered from is given instead
+
+def get_desktop_background_image(backend=None):
+    """Gets the path of the current desktop background image.
+    Args:
+        backend (wallpaper_lib.WallpaperBackend, optional): Backend to ask. Defaults to the one for this desktop.
+    Returns:
+        str: Path of the image file. None, if there is no background image or it can't be found out.
+    """
+    if backend is None:
+        backend = wallpaper_lib.get_backend()
+    if backend is None:
+        return None
+
+    current_path = backend.get_current()
+    state = read_wallpaper_state()
+    if state.get('backend') == backend.name and (current_path is None or is_same_path(current_path, state.get('wallpaper'))):
+        return state.get('source')
+    return current_path
+
+
+#This function makes the copy of an image that goes on the desktop. It is scaled to cover the whole screen, keeping
+#its shape, and whatever sticks out past the edges is cropped off evenly (which is what the desktops do with "fill"
+#anyway). Like the previews, JPEGs are only decoded at the size that's needed. The copy is named after the image and
+#the screen size, and is only made again if the image is newer than it
+
+def render_wallpaper(image_path, screen_size):
+    """Renders a copy of an image exactly the size of the screen into wallpaper_dir
+    Args:
+        image_path (str): Full path of the image file
+        screen_size (tuple[int, int]): Width and height of the screen in pixels
+    Returns:
+        str: Full path of the rendered wallpaper. None, if it could not be made.
+    """
+    image_name = os.path.splitext(os.path.basename(image_path))[0]
+    wallpaper_path = os.path.join(wallpaper_dir, f'{image_name}_{screen_size[0]}x{screen_size[1]}.jpg')
+    try:
+        if os.path.getmtime(wallpaper_path) >= os.path.getmtime(image_path):
+            return wallpaper_path       #Already made, from this version of the image
+    except OSError:
+        pass
+
+    from PIL import Image, ImageOps
+    os.makedirs(wallpaper_dir, exist_ok=True)
+    temp_path = f'{wallpaper_path}.{threading.get_ident()}.part'
+    try:
+        with Image.open(image_path) as image:
+            image.draft('RGB', screen_size)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            wallpaper = ImageOps.fit(image, screen_size, Image.LANCZOS)
+            wallpaper.save(temp_path, 'JPEG', quality=wallpaper_quality)
+        os.replace(temp_path, wallpaper_path)
+        return wallpaper_path
+    except (OSError, ValueError, Image.DecompressionBombError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+
+
+#Only the wallpaper on the desktop right now is kept in wallpaper_dir, so the rendered copies never pile up
+
+def remove_old_wallpapers(wallpaper_path):
+    """Deletes every rendered wallpaper except one
+    Args:
+        wallpaper_path (str): Full path of the wallpaper to keep
+    """
+    if wallpaper_dir is None or not os.path.isdir(wallpaper_dir):
+        return
+    for file_name in os.listdir(wallpaper_dir):
+        file_path = os.path.join(wallpaper_dir, file_name)
+        if file_name.endswith('.jpg') and not is_same_path(file_path, wallpaper_path):
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+
+#The last wallpaper we set is remembered in a small JSON file in wallpaper_dir (or in the temporary folder, if we
+#aren't rendering wallpapers)
+
+def get_wallpaper_state_path():
+    """Gets the path of the file the last wallpaper is remembered in"""
+    return os.path.join(wallpaper_dir or tempfile.gettempdir(), 'apod_wallpaper.json')
+
+
+def read_wallpaper_state():
+    """Gets the last wallpaper we set
+    Returns:
+        dict: backend, source, source_mtime and wallpaper. Empty, if nothing was set yet.
+    """
+    try:
+        with open(get_wallpaper_state_path()) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_wallpaper_state(state):
+    """Remembers the wallpaper we set
+    Args:
+        state (dict): backend, source, source_mtime and wallpaper
+    """
+    state_path = get_wallpaper_state_path()
+    try:
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        with open(state_path + '.part', 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(state_path + '.part', state_path)
+    except OSError:
+        pass
+
+
+def is_same_path(first_path, second_path):
+    """Checks if two paths are the same file, ignoring case where the OS does"""
+    if first_path is None or second_path is None:
+        return False
+    return os.path.normcase(os.path.abspath(first_path)) == os.path.normcase(os.path.abspath(second_path))
+
+
+#This function makes a small copy of an image for the viewer. Decoding a multi-megapixel image just to shrink it is
+#slow, so for JPEGs we use draft(), which makes the JPEG decoder itself skip detail and decode the image at 1/2, 1/4
+#or 1/8 of its size. thumbnail() then uses reduce() to cheaply shrink by whole factors before the final resize
+
+def create_preview(image_path, preview_path, max_size=None):
+    """Creates a preview of an image that fits within a maximum size, saved as a JPEG.
+    Args:
+        image_path (str): Path of the full size image file
+        preview_path (str): Path to save the preview file
+        max_size (tuple[int, int], optional): Maximum preview size in pixels (width, height). Defaults to preview_size.
+    Returns:
+        bool: True, if succcessful. False, if unsuccessful
+    """
+    if max_size is None:
+        max_size = preview_size
+
+    from PIL import Image   #Pillow makes the small preview copies of the images
+    temp_path = f'{preview_path}.{threading.get_ident()}.part'      #Like downloads, the preview only gets its real name once it is finished
+    try:
+        with Image.open(image_path) as image:
+            image.draft('RGB', max_size)        #Only does anything for JPEGs, which are most APODs
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')    #JPEG can't hold transparency or palettes
+            image.thumbnail(max_size)           #Shrinks in place, keeping the aspect ratio. Never makes it bigger
+            image.save(temp_path, 'JPEG', quality=preview_quality)
+        os.replace(temp_path, preview_path)
+        return True
+    except (OSError, ValueError, Image.DecompressionBombError):     #Not an image we can read (or write)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+
+#This function re-encodes a cached image into a smaller format, for the compact command. It runs in a separate
+#process (one for every core), so it only takes and gives back plain values. The new file is written next to where
+#it will go with .part on the end, and the caller moves it into place once it has been recorded.
+#Re-encoding a JPEG that was already saved at a low quality only makes it worse, so images are never encoded below
+#quality_floor, or above the quality they were saved at, and JPEGs saved below the floor are left alone. So are
+#images that wouldn't get at least min_saving smaller, and animations (only their first frame would be kept)
+
+def compact_image(image_path, output_path, image_format='webp', quality=80, quality_floor=70, min_saving=0.05):
+    """Re-encodes an image into a smaller file.
+    Args:
+        image_path (str): Full path of the image file
+        output_path (str): Full path the compacted image will have. It is written to output_path + '.part'.
+        image_format (str, optional): 'webp' or 'jpeg'. Defaults to 'webp'.
+        quality (int, optional): Quality to encode at, from 1 to 100. Defaults to 80.
+        quality_floor (int, optional): Lowest quality an image is ever encoded at. Defaults to 70.
+        min_saving (float, optional): Fraction smaller the new file must be to be kept. Defaults to 0.05.
+    Returns:
+        dict: 'temp_path', 'size', 'original_size', 'file_sha256' and 'quality' of the new file. If the image was
+        left alone, 'skipped' with the reason (and 'error', if it couldn't be read).
+    """
+    from PIL import Image
+    temp_path = output_path + '.part'
+    try:
+        original_size = os.path.getsize(image_path)
+        with Image.open(image_path) as image:
+            if getattr(image, 'n_frames', 1) > 1:
+                return {'skipped': 'animated'}
+            source_quality = estimate_jpeg_quality(image) if image.format == 'JPEG' else None
+            if source_quality is not None and source_quality < quality_floor:
+                return {'skipped': f'already at quality {source_quality}'}
+            encode_quality = max(min(quality, source_quality or 100), quality_floor)
+
+            save_options = {'quality': encode_quality}
+            for key in ('icc_profile', 'exif'):         #Keep the colour profile, and the camera details some APODs have
+                if image.info.get(key):
+                    save_options[key] = image.info[key]
+            if image_format == 'webp':
+                if image.mode not in ('RGB', 'RGBA'):
+                    image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+                image.save(temp_path, 'WEBP', method=6, **save_options)     #method 6 is the slowest and smallest
+            elif image_format == 'jpeg':
+                if image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+                image.save(temp_path, 'JPEG', optimize=True, progressive=True, **save_options)
+            else:
+                raise ValueError(f"Unknown image format: {image_format}")
+
+        new_size = os.path.getsize(temp_path)
+        if new_size > original_size * (1 - min_saving):
+            os.remove(temp_path)
+            return {'skipped': 'no smaller'}
+        return {'temp_path': temp_path, 'size': new_size, 'original_size': original_size,
+                'file_sha256': hash_file(temp_path), 'quality': encode_quality}
+    except (OSError, Image.DecompressionBombError) as error:     #Not an image we can read (or write)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return {'skipped': f'unreadable ({error})', 'error': True}
+
+
+def estimate_jpeg_quality(image):
+    """Estimates the quality a JPEG was saved at, from its quantization tables
+    Args:
+        image (PIL.Image.Image): The opened JPEG
+    Returns:
+        int: Quality from 1 to 100. None, if it can't be worked out.
+    """
+    tables = getattr(image, 'quantization', None)
+    if not tables or 0 not in tables:
+        return None
+    scale = sum(tables[0]) * 100 / sum(jpeg_luminance_table)    #How much the encoder scaled the standard table by, in percent
+    quality = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+    return min(max(round(quality), 1), 100)
+
+
+#The preview cache is a folder of previews made by create_preview, with a limit on how many bytes it can use.
+#When it goes over, the previews that were used the longest time ago are deleted. The last time a preview was used
+#is kept as the modified time of its file, so the order survives between runs
+
+class PreviewCache:
+    """A folder of image previews with a size budget and least-recently-used eviction.
+    Every method can be called from any thread.
+    """
+
+    def __init__(self, preview_dir, budget=200 * 1024 * 1024, max_size=None):
+        """Opens the preview cache, creating its folder if needed.
+        Args:
+            preview_dir (str): Folder the previews are kept in
+            budget (int, optional): Maximum total size of the previews in bytes. Defaults to 200 MB.
+            max_size (tuple[int, int], optional): Maximum preview size in pixels (width, height). Defaults to preview_size.
+        """
+        self.preview_dir = preview_dir
+        self.budget = budget
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.previews = None        #Preview key -> size in bytes, least recently used first. Loaded the first time it's needed
+        self.total_size = 0
+
+    def load(self):
+        """Loads the previews that are already in the folder, oldest first, so the first ones evicted are the least
+        recently used. Looking at every file takes a while with a big cache, so it is only done the first time a
+        preview is needed (a run that only sets the wallpaper never needs one). Must be called with the lock held.
+        """
+        if self.previews is not None:
+            return
+        os.makedirs(self.preview_dir, exist_ok=True)
+        entries = []
+        for file_name in os.listdir(self.preview_dir):
+            if file_name.endswith('.jpg'):
+                file_stat = os.stat(os.path.join(self.preview_dir, file_name))
+                entries.append((file_stat.st_mtime, file_name[:-4], file_stat.st_size))
+        self.previews = OrderedDict((key, size) for mtime, key, size in sorted(entries))
+        self.total_size = sum(self.previews.values())
+
+    def get_path(self, key):
+        """Gets the path the preview with a given key is (or would be) saved at
+        Args:
+            key (str): Key of the preview, like the SHA-256 hash of its image
+        Returns:
+            str: Full path of the preview file
+        """
+        return os.path.join(self.preview_dir, key + '.jpg')
+
+    def get(self, key, image_path):
+        """Gets the preview of an image, creating it if it isn't in the cache.
+        Args:
+            key (str): Key of the preview, like the SHA-256 hash of its image
+            image_path (str): Path of the full size image, used if the preview has to be made
+        Returns:
+            str: Full path of the preview file. None, if the preview could not be made.
+        """
+        preview_path = self.get_path(key)
+        with self.lock:
+            self.load()
+            if key in self.previews:
+                self.previews.move_to_end(key)      #Now the most recently used
+                try:
+                    os.utime(preview_path)          #Remember that for next time too
+                    return preview_path
+                except OSError:                     #Somebody deleted it, so make it again
+                    self.total_size -= self.previews.pop(key)
+
+        return self.add(key, image_path)
+
+    def add(self, key, image_path):
+        """Creates the preview of an image and adds it to the cache, evicting old previews if over budget.
+        Args:
+            key (str): Key of the preview, like the SHA-256 hash of its image
+            image_path (str): Path of the full size image
+        Returns:
+            str: Full path of the preview file. None, if the preview could not be made.
+        """
+        preview_path = self.get_path(key)
+        with self.lock:
+            self.load()     #Also makes the folder, before the preview is saved in it
+        if not create_preview(image_path, preview_path, self.max_size):     #Made outside the lock so other previews aren't held up
+            return None
+
+        with self.lock:
+            self.total_size -= self.previews.pop(key, 0)
+            self.previews[key] = os.path.getsize(preview_path)
+            self.total_size += self.previews[key]
+            self.evict()
+        return preview_path
+
+    def remove(self, key):
+        """Deletes the preview with a given key, if there is one
+        Args:
+            key (str): Key of the preview
+        """
+        with self.lock:
+            self.load()
+            if key in self.previews:
+                self.total_size -= self.previews.pop(key)
+                self.delete_file(key)
+
+    def evict(self):
+        """Deletes least recently used previews until the cache is within its budget.
+        The most recently used preview is always kept. Must be called with the lock held.
+        """
+        while self.total_size > self.budget and len(self.previews) > 1:
+            key, size = self.previews.popitem(last=False)
+            self.total_size -= size
+            self.delete_file(key)
+
+    def delete_file(self, key):
+        """Deletes the file of a preview
+        Args:
+            key (str): Key of the preview
+        """
+        try:
+            os.remove(self.get_path(key))
+        except OSError:
+            pass
 
 
 #This function scales the image automatically by calculating the dimensions of said image. I did not write this function
@@ -0,0 +1,146 @@
+'''
+Library for running slow jobs (like downloading APODs) on background threads.
+'''
+#The APOD viewer can't do slow work on the Tk main thread, or the window freezes until it is done. Instead it
+#submits jobs to a JobQueue, which runs them on worker threads. Tk itself can only be touched from the main thread,
+#so the workers never talk to the window. They put events (started, progress, done...) on a queue instead, and the
+#viewer picks them up with get_events() from a root.after() loop.
+
+import queue        #The thread-safe queues that hold the waiting jobs and the events
+import threading    #The workers are threads, and each job gets an Event for cancelling it
+import itertools    #Counts up the job IDs
+
+
+#A job is one call of a function on a worker thread. The function is called with the job as its first argument,
+#so it can report progress with job.report_progress() and check job.cancelled to stop early
+
+class Job:
+    """A function call waiting for (or running on) a JobQueue worker"""
+
+    def __init__(self, job_id, func, args, description, events):
+        self.id = job_id
+        self.func = func
+        self.args = args
+        self.description = description
+        self.status = 'pending'             #pending, running, done, failed or cancelled
+        self.progress = 0.0                 #How far through the job is, from 0 to 1
+        self.result = None                  #What the function returned
+        self.error = None                   #What the function raised, if it failed
+        self.cancel_event = threading.Event()
+        self.events = events
+
+    @property
+    def cancelled(self):
+        """bool: True, if the job has been asked to stop"""
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        """Asks the job to stop. A job that hasn't started yet never runs. A running job stops
+        when its function next checks job.cancelled (or job.cancel_event)."""
+        self.cancel_event.set()
+
+    def report_progress(self, progress):
+        """Reports how far through the job is. Called by the job's function.
+        Args:
+            progress (float): Progress from 0 to 1
+        """
+        self.progress = progress
+        self.events.put((self, 'progress'))
+
+
+class JobQueue:
+    """Runs jobs in the order they were submitted on a pool of worker threads"""
+
+    def __init__(self, workers=2):
+        """Starts the worker threads.
+        Args:
+            workers (int, optional): Number of jobs that run at the same time. Defaults to 2.
+        """
+        self.jobs = queue.Queue()       #Jobs waiting for a worker
+        self.events = queue.Queue()     #(job, event name) for the main thread to pick up
+        self.job_ids = itertools.count(1)
+        self.active_jobs = {}           #Job ID -> job, for every job that hasn't finished
+        self.lock = threading.Lock()
+
+        #The workers are daemon threads, so they don't keep the program running after the window closes
+
+        for worker_number in range(workers):
+            threading.Thread(target=self.run_worker, name=f'job-worker-{worker_number}', daemon=True).start()
+
+    def submit(self, func, *args, description=''):
+        """Adds a job to the queue.
+        Args:
+            func (callable): Function to run. It is called as func(job, *args).
+            *args: The other arguments of the function
+            description (str, optional): Description of the job, for showing to the user
+        Returns:
+            Job: The job
+        """
+        job = Job(next(self.job_ids), func, args, description, self.events)
+        with self.lock:
+            self.active_jobs[job.id] = job
+        self.jobs.put(job)
+        return job
+
+    def cancel_all(self):
+        """Cancels every job that hasn't finished"""
+        with self.lock:
+            jobs = list(self.active_jobs.values())
+        for job in jobs:
+            job.cancel()
+
+    def get_active_jobs(self):
+        """Gets the jobs that haven't finished
+        Returns:
+            list: Pending and running jobs, in the order they were submitted
+        """
+        with self.lock:
+            return sorted(self.active_jobs.values(), key=lambda job: job.id)
+
+    def get_events(self):
+        """Gets every event since the last call, without waiting. Meant to be called from the main thread.
+        The events are 'started', 'progress', 'done', 'failed' and 'cancelled'.
+        Returns:
+            list: (job, event name) for each event, oldest first
+        """
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def run_worker(self):
+        """Runs jobs from the queue, forever. This is what each worker thread does."""
+        while True:
+            job = self.jobs.get()
+
+            if job.cancelled:               #Cancelled while it was waiting, so it never starts
+                self.finish(job, 'cancelled')
+                continue
+
+            job.status = 'running'
+            self.events.put((job, 'started'))
+            try:
+                job.result = job.func(job, *job.args)
+            except Exception as error:      #A job that blows up must not take the worker down with it
+                job.error = error
+                self.finish(job, 'failed')
+                continue
+
+            if job.cancelled:
+                self.finish(job, 'cancelled')
+            else:
+                job.progress = 1.0
+                self.finish(job, 'done')
+
+    def finish(self, job, status):
+        """Marks a job as finished and tells the main thread
+        Args:
+            job (Job): The job
+            status (str): 'done', 'failed' or 'cancelled'
+        """
+        job.status = status
+        with self.lock:
+            self.active_jobs.pop(job.id, None)
+        self.events.put((job, status))
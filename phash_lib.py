@@ -0,0 +1,165 @@
+'''
+Library for finding images that look the same, even when they aren't the same bytes.
+'''
+#The SHA-256 of an image only matches another copy of exactly the same file. NASA sometimes publishes the same
+#picture again at another size or re-saved, and those come out as different hashes. A perceptual hash is worked out
+#from what the picture looks like instead, so copies like that get hashes that differ in only a few bits.
+#
+#The hash used here is dHash: the image is shrunk to 9x8 grey pixels and each bit says whether a pixel is brighter
+#than the one to its right, giving 64 bits. How different two images look is the number of bits their hashes differ
+#in (the Hamming distance).
+#
+#The hashes go in a multi-index hash table, which finds every hash within a distance of another without comparing
+#against all of them. Each hash is split into chunk_count chunks, and each chunk has its own table. If two hashes
+#differ in at most d bits, at least one of their chunks differs in at most d // chunk_count bits (they can't all
+#differ in more). So a search only looks in each table under the chunk of the hash being looked for, and the chunks
+#a few bits away from it, and only has to work out the full distance for the hashes it finds there.
+
+import threading    #The index is shared by the download threads
+from functools import lru_cache     #The bit flips for each distance are only worked out once
+from itertools import combinations
+
+hash_size = 8       #The hash is hash_size x hash_size bits
+chunk_count = 4     #Number of chunks each hash is split into for the index
+chunk_bits = hash_size * hash_size // chunk_count
+
+
+#This function works out the dHash of an image file. JPEGs are decoded at the smallest size the decoder can manage,
+#since only 72 pixels are needed in the end
+
+def get_image_dhash(image_path):
+    """Gets the perceptual hash (dHash) of an image file
+    Args:
+        image_path (str): Path of the image file
+    Returns:
+        int: 64-bit hash. None, if the image can't be read.
+    """
+    from PIL import Image
+    try:
+        with Image.open(image_path) as image:
+            image.draft('L', (hash_size * 8, hash_size * 8))
+            small_image = image.convert('L').resize((hash_size + 1, hash_size), Image.BOX)    #BOX averages every pixel, so noise doesn't matter
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    return get_dhash(small_image)
+
+
+def get_dhash(small_image):
+    """Gets the dHash of an image that was already shrunk to (hash_size + 1) x hash_size grey pixels
+    Args:
+        small_image (PIL.Image.Image): The shrunk image
+    Returns:
+        int: 64-bit hash
+    """
+    try:
+        import numpy
+    except ImportError:         #Without NumPy, compare the pixels one at a time. There are only 72 of them
+        pixels = list(small_image.getdata())
+        width = hash_size + 1
+        bits = [pixels[row * width + column] < pixels[row * width + column + 1]
+                for row in range(hash_size) for column in range(hash_size)]
+        return sum(1 << (len(bits) - 1 - index) for index, bit in enumerate(bits) if bit)
+
+    pixels = numpy.asarray(small_image, dtype=numpy.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]        #Each pixel against its neighbour, all at once
+    return int.from_bytes(numpy.packbits(bits).tobytes(), 'big')
+
+
+def get_distance(first_hash, second_hash):
+    """Gets how many bits two hashes differ in
+    Args:
+        first_hash (int): A hash
+        second_hash (int): Another hash
+    Returns:
+        int: Hamming distance, from 0 (look the same) to 64
+    """
+    return (first_hash ^ second_hash).bit_count()
+
+
+class HashIndex:
+    """Perceptual hashes, searchable by Hamming distance. Every method can be called from any thread."""
+
+    def __init__(self):
+        self.tables = [{} for chunk in range(chunk_count)]     #For each chunk: chunk value -> [(hash, item)]
+        self.hashes = {}        #item -> its hash, so an item can be found again to be removed
+        self.lock = threading.Lock()
+
+    def add(self, image_hash, item):
+        """Adds a hash to the index. If the item is already in it, its old hash is replaced.
+        Args:
+            image_hash (int): The hash
+            item: What the hash belongs to, like an APOD ID
+        """
+        with self.lock:
+            self.remove_item(item)
+            for table, chunk in zip(self.tables, get_chunks(image_hash)):
+                table.setdefault(chunk, []).append((image_hash, item))
+            self.hashes[item] = image_hash
+
+    def remove(self, item):
+        """Takes an item out of the index, if it is in it
+        Args:
+            item: What the hash belongs to, like an APOD ID
+        """
+        with self.lock:
+            self.remove_item(item)
+
+    def remove_item(self, item):
+        """Takes an item out of the tables. The lock must be held."""
+        image_hash = self.hashes.pop(item, None)
+        if image_hash is None:
+            return
+        for table, chunk in zip(self.tables, get_chunks(image_hash)):
+            entries = table[chunk]
+            entries.remove((image_hash, item))
+            if not entries:
+                del table[chunk]
+
+    def find(self, image_hash, max_distance):
+        """Finds the hashes within a distance of a hash
+        Args:
+            image_hash (int): The hash to look for
+            max_distance (int): Most bits a hash can differ in
+        Returns:
+            list: (distance, item) of each match, closest first
+        """
+        chunk_distance = max_distance // chunk_count        #Every match is at least this close in one of the chunks
+        flips = get_chunk_flips(chunk_distance)
+        matches = {}
+        with self.lock:
+            for table, chunk in zip(self.tables, get_chunks(image_hash)):
+                for flip in flips:
+                    for candidate in table.get(chunk ^ flip, ()):
+                        if candidate not in matches:        #The same hash can turn up in more than one table
+                            matches[candidate] = get_distance(image_hash, candidate[0])
+        return sorted(((distance, candidate[1]) for candidate, distance in matches.items() if distance <= max_distance),
+                      key=lambda match: match[0])
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+def get_chunks(image_hash):
+    """Splits a hash into its chunks
+    Args:
+        image_hash (int): The hash
+    Returns:
+        list: Value of each chunk
+    """
+    mask = (1 << chunk_bits) - 1
+    return [(image_hash >> (chunk * chunk_bits)) & mask for chunk in range(chunk_count)]
+
+
+@lru_cache(maxsize=8)
+def get_chunk_flips(max_bits):
+    """Gets every way of flipping up to a number of bits of a chunk
+    Args:
+        max_bits (int): Most bits to flip
+    Returns:
+        list: The values to XOR a chunk with, starting with 0 (no bits flipped)
+    """
+    flips = [0]
+    for bit_count in range(1, min(max_bits, chunk_bits) + 1):
+        for bits in combinations(range(chunk_bits), bit_count):
+            flips.append(sum(1 << bit for bit in bits))
+    return flips
@@ -0,0 +1,188 @@
+'''
+Library for pacing requests to an API that limits how many requests each key can make.
+'''
+#Each API key gets a token bucket. A request takes a token, and tokens come back at the rate the API allows (for the
+#NASA API, 1,000 requests an hour for a normal key). When the bucket is empty, the next request waits for a token
+#instead of being sent and bounced with 429 Too Many Requests.
+#The API says how much of the quota is left in its X-RateLimit-Limit and X-RateLimit-Remaining headers, so after
+#every response the bucket is corrected to match what the server thinks. A 429 pauses the key for as long as the
+#Retry-After header says. With more than one key, each request goes to the key that can send soonest.
+
+import threading    #The buckets are shared by every thread that talks to the API
+import time
+from email.utils import parsedate_to_datetime   #Retry-After can be a date instead of a number of seconds
+
+
+class TokenBucket:
+    """Hands out tokens at a steady rate, with room to save up capacity of them for bursts"""
+
+    def __init__(self, limit, window):
+        """Starts with a full bucket.
+        Args:
+            limit (int): Number of requests allowed in each window
+            window (float): Length of the window in seconds
+        """
+        self.window = window
+        self.capacity = limit
+        self.rate = limit / window          #Tokens that come back each second
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0             #Nothing is sent before this time (after a 429)
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """Adds the tokens that came back since the last refill. Must be called with the lock held."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def get_wait(self):
+        """Gets how long until a token can be taken
+        Returns:
+            float: Seconds to wait (0 if a token can be taken now)
+        """
+        with self.lock:
+            now = self.refill()
+            wait = max(self.paused_until - now, 0.0)
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            return wait
+
+    def try_take(self):
+        """Takes a token, if one can be taken now
+        Returns:
+            bool: True, if a token was taken
+        """
+        with self.lock:
+            now = self.refill()
+            if now < self.paused_until or self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def update_quota(self, limit, remaining):
+        """Matches the bucket to the quota the server reported
+        Args:
+            limit (int): Requests allowed in each window, from X-RateLimit-Limit (None if not sent)
+            remaining (int): Requests left in the current window, from X-RateLimit-Remaining (None if not sent)
+        """
+        with self.lock:
+            self.refill()
+            if limit is not None and limit > 0:
+                self.capacity = limit
+                self.rate = limit / self.window
+            if remaining is not None:
+                self.tokens = min(self.tokens, float(remaining))     #The server knows best, but never hand back tokens we already spent
+
+    def pause(self, seconds):
+        """Stops handing out tokens for a while
+        Args:
+            seconds (float): How long to pause for
+        """
+        with self.lock:
+            self.refill()
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = min(self.tokens, 0.0)     #Whatever we thought was left, the server says there isn't any
+
+
+class KeyPool:
+    """A token bucket for each API key, handing out whichever key can send a request soonest"""
+
+    def __init__(self, keys, limit=1000, window=3600.0):
+        """Creates a bucket for each key.
+        Args:
+            keys (list): The API keys
+            limit (int, optional): Requests allowed for each key in each window, until the server says otherwise. Defaults to 1000.
+            window (float, optional): Length of the window in seconds. Defaults to an hour.
+        """
+        if not keys:
+            raise ValueError("The key pool needs at least one key")
+        self.buckets = {key: TokenBucket(limit, window) for key in keys}
+        self.lock = threading.Lock()
+
+    def acquire(self, max_wait=None, cancel_event=None):
+        """Waits for a key that can send a request, and takes a token from it.
+        Args:
+            max_wait (float, optional): Most seconds to wait. Waits as long as it takes if not provided.
+            cancel_event (threading.Event, optional): Stops waiting when set
+        Returns:
+            str: The key to send the request with. None, if no key was free in time (or waiting was cancelled).
+        """
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            with self.lock:
+                waits = {key: bucket.get_wait() for key, bucket in self.buckets.items()}
+                key = min(waits, key=waits.get)
+                if waits[key] == 0 and self.buckets[key].try_take():
+                    return key
+            wait = max(waits[key], 0.01)
+
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return None
+            if cancel_event is not None:
+                if cancel_event.wait(wait):
+                    return None
+            else:
+                time.sleep(wait)
+
+    def update(self, key, headers):
+        """Matches a key's bucket to the X-RateLimit headers of a response
+        Args:
+            key (str): The key the request was sent with
+            headers (Mapping): Headers of the response
+        """
+        self.buckets[key].update_quota(get_int_header(headers, 'X-RateLimit-Limit'),
+                                       get_int_header(headers, 'X-RateLimit-Remaining'))
+
+    def pause(self, key, seconds):
+        """Stops using a key for a while (after it got a 429)
+        Args:
+            key (str): The key
+            seconds (float): How long to pause it for
+        """
+        self.buckets[key].pause(seconds)
+
+    def get_keys(self):
+        """Gets the keys in the pool
+        Returns:
+            list: The keys
+        """
+        return list(self.buckets)
+
+
+#Small helpers for reading the rate limit headers
+
+def get_int_header(headers, name):
+    """Gets a header as a number
+    Args:
+        headers (Mapping): Headers of a response
+        name (str): Name of the header
+    Returns:
+        int: Value of the header. None, if it isn't there or isn't a number.
+    """
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_retry_after(headers, default):
+    """Gets how long the server asked us to wait with its Retry-After header
+    Args:
+        headers (Mapping): Headers of a response
+        default (float): Seconds to wait if the server didn't say
+    Returns:
+        float: Seconds to wait
+    """
+    retry_after = headers.get('Retry-After')
+    if retry_after is None:
+        return default
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)     #An HTTP date, like "Wed, 21 Oct 2015 07:28:00 GMT"
+    except (TypeError, ValueError):
+        return default
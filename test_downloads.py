@@ -0,0 +1,145 @@
+'''
+Tests for resumed and conditional image downloads, against the local stand-in server in fake_apod_server.
+'''
+#Run with:
+#  python -m pytest test_downloads.py       (or python -m unittest test_downloads)
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date
+import apod_api
+import apod_desktop
+import fake_apod_server
+import image_lib
+
+test_image_size = 1024 * 1024       #Big enough that the connection can be dropped part way through
+test_drop_after = 300 * 1024        #Bytes sent before the first download of each image is cut off
+
+#Module globals that init_apod_cache sets, put back after every test that opens a cache
+cache_globals = ('image_cache_dir', 'image_cache_db', 'cache_store', 'image_cache_layout', 'preview_cache',
+                 'image_cache_budget', 'image_cache_eviction', 'near_duplicate_policy', 'near_duplicate_distance',
+                 'phash_index')
+
+
+class DownloadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.keep_globals(fake_apod_server, ('image_size', 'drop_after'))
+        self.keep_globals(apod_api, ('api_url',))
+        self.keep_globals(image_lib, ('wallpaper_dir',))
+        self.keep_globals(apod_desktop, cache_globals)
+        self.addCleanup(fake_apod_server.dropped_images.clear)
+
+        self.download_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.download_dir, ignore_errors=True)
+
+        self.server = fake_apod_server.start_server(size=test_image_size)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)       #Cleanups run last first, so this runs before server_close
+
+        self.requests = []          #Range and If-Range of every image request the server got
+        send_image = fake_apod_server.FakeApodHandler.send_image
+
+        def record_request(handler, apod_date):
+            self.requests.append((handler.headers.get('Range'), handler.headers.get('If-Range')))
+            return send_image(handler, apod_date)
+
+        fake_apod_server.FakeApodHandler.send_image = record_request
+        self.addCleanup(setattr, fake_apod_server.FakeApodHandler, 'send_image', send_image)
+
+    def keep_globals(self, module, names):
+        """Puts the module globals back the way they are now when the test is done"""
+        for name in names:
+            self.addCleanup(setattr, module, name, getattr(module, name))
+
+    def open_cache(self):
+        """Opens a new image cache in the download folder, with the API pointed at the fake server"""
+        apod_api.api_url = fake_apod_server.get_api_url(self.server)
+        apod_desktop.cache_store = None     #So init_apod_cache doesn't close a store someone else still has open
+        apod_desktop.init_apod_cache(self.download_dir)
+        self.addCleanup(apod_desktop.cache_store.close)
+
+    def get_image_url(self, apod_date):
+        return f"http://127.0.0.1:{self.server.server_address[1]}{fake_apod_server.image_path_prefix}{apod_date}.jpg"
+
+    def get_image_sha256(self, apod_date):
+        image_data = fake_apod_server.make_image(apod_date, test_image_size, fake_apod_server.image_dimensions)
+        return hashlib.sha256(image_data).hexdigest()
+
+    def test_dropped_connection_is_resumed(self):
+        fake_apod_server.drop_after = test_drop_after
+        fake_apod_server.dropped_images.clear()
+        image_download = image_lib.download_image_to_file(self.get_image_url('2020-01-01'), self.download_dir, backoff=0.01)
+
+        self.assertIsNotNone(image_download)
+        self.assertEqual(image_download['sha256'], self.get_image_sha256('2020-01-01'))
+        self.assertEqual(image_download['size'], test_image_size)
+        with open(image_download['path'], 'rb') as image_file:
+            self.assertEqual(hashlib.sha256(image_file.read()).hexdigest(), image_download['sha256'])
+
+        #The first request was cut off, and the second only asked for the rest (from wherever the last whole chunk
+        #that was written ended), if the image hadn't changed
+
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.requests[0], (None, None))
+        byte_range, if_range = self.requests[1]
+        self.assertRegex(byte_range, r'^bytes=\d+-$')
+        self.assertTrue(0 < int(byte_range[len('bytes='):-1]) <= test_drop_after)
+        self.assertEqual(if_range, image_download['etag'])
+
+    def test_not_modified(self):
+        image_url = self.get_image_url('2020-01-02')
+        image_download = image_lib.download_image_to_file(image_url, self.download_dir)
+        self.assertIsNotNone(image_download['etag'])
+        self.assertIsNotNone(image_download['last_modified'])
+
+        for validators in ({'etag': image_download['etag']}, {'last_modified': image_download['last_modified']}):
+            with self.subTest(**validators):
+                self.assertTrue(image_lib.download_image_to_file(image_url, self.download_dir, **validators).get('not_modified'))
+
+        changed_download = image_lib.download_image_to_file(image_url, self.download_dir, etag='"some other version"')
+        self.assertEqual(changed_download['sha256'], image_download['sha256'])
+
+    def test_revalidate_cached_apod(self):
+        self.open_cache()
+        apod_id = apod_desktop.add_apod_to_cache(date(2020, 1, 3))
+        apod_record = apod_desktop.cache_store.get_apod_record(apod_id)
+        request_count = len(self.requests)
+
+        self.assertTrue(apod_desktop.revalidate_apod_image(apod_id))
+        self.assertEqual(len(self.requests), request_count + 1)
+        self.assertEqual(apod_desktop.cache_store.get_apod_record(apod_id), apod_record)   #304, so nothing changed
+        self.assertFalse([file_name for file_name in os.listdir(apod_desktop.image_cache_dir) if '.part' in file_name])
+
+    def test_dates_sharing_an_image_url(self):
+        self.open_cache()
+        base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        apod_infos = [fake_apod_server.make_apod_info(date(2020, 1, day), base_url) for day in (4, 5)]
+        apod_infos[1]['url'] = apod_infos[1]['hdurl'] = apod_infos[0]['url']
+
+        results = list(apod_desktop.add_apods_to_cache(apod_infos))
+        apod_id = results[0][1]
+        self.assertNotEqual(apod_id, 0)
+        self.assertEqual([result_id for apod_info, result_id in results], [apod_id, apod_id])
+        self.assertEqual(len(self.requests), 1)         #Downloaded once for both dates
+        for apod_info in apod_infos:
+            self.assertEqual(apod_desktop.get_apod_id_from_date(apod_info['date']), apod_id)
+        self.assertTrue(os.path.exists(apod_desktop.cache_store.get_apod_record(apod_id)['path']))
+
+    def test_date_with_an_image_already_cached(self):
+        self.open_cache()
+        apod_id = apod_desktop.add_apod_to_cache(date(2020, 1, 6))
+        base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        apod_info = fake_apod_server.make_apod_info(date(2020, 1, 7), base_url)
+        apod_info['url'] = apod_info['hdurl'] = self.get_image_url('2020-01-06')
+
+        self.assertEqual(list(apod_desktop.add_apods_to_cache([apod_info])), [(apod_info, apod_id)])
+        self.assertEqual(apod_desktop.get_apod_id_from_date(date(2020, 1, 7)), apod_id)   #So the next run doesn't download it again
+        self.assertEqual(apod_desktop.cache_store.get_apod_record(apod_id)['apod_date'], '2020-01-06')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,271 @@
+'''
+Library of backends for setting the desktop background on different desktops.
+'''
+#Every desktop has its own way of setting the wallpaper, so each one gets a backend with the same three methods:
+#  apply(image_path)    - Sets the wallpaper
+#  get_current()        - Path of the wallpaper right now (None if the desktop can't say)
+#  get_screen_size()    - Width and height of the screen in pixels, so the image can be made exactly that size
+#The backends are:
+#  windows      - SystemParametersInfoW in user32.dll
+#  gsettings    - GNOME (and desktops built on it), through the gsettings command
+#  feh          - X11 window managers without a desktop of their own, through feh
+#  sway         - Sway (and the other wlroots compositors that use swaybg), through swaymsg
+#  fake         - Only writes the path to a file. For trying things out and for tests, it never touches the desktop
+#get_backend() picks the one for the desktop we are running on, unless the APOD_WALLPAPER_BACKEND environment
+#variable names one.
+
+import ctypes       #The windows backend talks to user32.dll and gdi32.dll
+import json         #swaymsg answers in JSON
+import os
+import re           #For reading the screen size out of xrandr
+import shlex        #For reading ~/.fehbg
+import shutil       #To find out which commands are installed
+import subprocess   #The Linux backends run commands
+import sys
+import tempfile     #The fake backend keeps its file in the temporary folder
+from pathlib import Path
+from urllib.parse import urlparse, unquote      #gsettings keeps the wallpaper as a file:// URI
+
+command_timeout = 10        #Seconds to wait for a wallpaper command before giving up on it
+backend = None              #The backend get_backend picked, so it's only worked out once
+
+
+class WallpaperBackend:
+    """Sets the wallpaper on one kind of desktop. The other backends fill in the methods."""
+
+    name = None
+
+    def apply(self, image_path):
+        """Sets the wallpaper
+        Args:
+            image_path (str): Full path of the image file
+        Returns:
+            bool: True, if successful. False, if unsuccessful.
+        """
+        raise NotImplementedError
+
+    def get_current(self):
+        """Gets the path of the wallpaper right now
+        Returns:
+            str: Full path of the image file. None, if it can't be found out.
+        """
+        return None
+
+    def get_screen_size(self):
+        """Gets the size of the screen the wallpaper is shown on
+        Returns:
+            tuple[int, int]: Width and height in pixels. None, if it can't be found out.
+        """
+        return None
+
+
+class WindowsBackend(WallpaperBackend):
+    """Sets the wallpaper with SystemParametersInfoW"""
+
+    name = 'windows'
+
+    def apply(self, image_path):
+        #The strategy is to use Ctypes to set the background since it allows us to operate Windows drivers, especially user32.dll which manages the Desktop. By specifying the SETDESKWALLPAPER, we can specify the height and width of the image (not relevant since it will be scaled later). User32.dll will set the Desktop background using the image_path. If we recieve any type of error, just return False
+        try:
+            SPI_SETDESKWALLPAPER = 20
+            return bool(ctypes.windll.user32.SystemParametersInfoW(SPI_SETDESKWALLPAPER, 0, image_path, 3))   #Set the image as the Desktop Background
+        except:          #If any error, return False and get outta there!
+            return False
+
+    def get_current(self):
+        try:
+            SPI_GETDESKWALLPAPER = 0x0073
+            image_path = ctypes.create_unicode_buffer(260)       #Room for the longest path Windows allows
+            if not ctypes.windll.user32.SystemParametersInfoW(SPI_GETDESKWALLPAPER, len(image_path), image_path, 0):
+                return None
+            return image_path.value or None
+        except:
+            return None
+
+    def get_screen_size(self):
+        #GetSystemMetrics gives the size scaled for display scaling unless the whole process is made DPI aware, so ask
+        #the screen's device context for its real number of pixels instead
+        try:
+            DESKTOPVERTRES = 117
+            DESKTOPHORZRES = 118
+            screen_dc = ctypes.windll.user32.GetDC(0)
+            try:
+                width = ctypes.windll.gdi32.GetDeviceCaps(screen_dc, DESKTOPHORZRES)
+                height = ctypes.windll.gdi32.GetDeviceCaps(screen_dc, DESKTOPVERTRES)
+            finally:
+                ctypes.windll.user32.ReleaseDC(0, screen_dc)
+            return (width, height) if width > 0 and height > 0 else None
+        except:
+            return None
+
+
+class GsettingsBackend(WallpaperBackend):
+    """Sets the wallpaper of GNOME with gsettings"""
+
+    name = 'gsettings'
+    schema = 'org.gnome.desktop.background'
+
+    def apply(self, image_path):
+        uri = Path(image_path).resolve().as_uri()
+        if run_command(['gsettings', 'set', self.schema, 'picture-uri', uri]) is None:
+            return False
+        run_command(['gsettings', 'set', self.schema, 'picture-uri-dark', uri])     #GNOME 42 and later have a separate one for dark mode
+        return True
+
+    def get_current(self):
+        uri = run_command(['gsettings', 'get', self.schema, 'picture-uri'])
+        if not uri:
+            return None
+        uri = urlparse(uri.strip().strip("'"))
+        return unquote(uri.path) if uri.scheme == 'file' else None
+
+    def get_screen_size(self):
+        return get_xrandr_screen_size()
+
+
+class FehBackend(WallpaperBackend):
+    """Sets the wallpaper of the X11 root window with feh"""
+
+    name = 'feh'
+
+    def apply(self, image_path):
+        return run_command(['feh', '--bg-fill', image_path]) is not None      #feh also saves the command in ~/.fehbg, so it comes back after logging in
+
+    def get_current(self):
+        try:
+            with open(os.path.expanduser('~/.fehbg')) as fehbg_file:
+                for line in fehbg_file:
+                    words = shlex.split(line)
+                    if words and words[0] == 'feh':
+                        return words[-1]
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def get_screen_size(self):
+        return get_xrandr_screen_size()
+
+
+class SwayBackend(WallpaperBackend):
+    """Sets the wallpaper of Sway with swaymsg, which starts swaybg for us.
+    Sway can't say what the wallpaper is, so get_current always gives None.
+    """
+
+    name = 'sway'
+
+    def apply(self, image_path):
+        return run_command(['swaymsg', 'output', '*', 'bg', image_path, 'fill']) is not None
+
+    def get_screen_size(self):
+        outputs = run_command(['swaymsg', '-t', 'get_outputs', '-r'])
+        try:
+            outputs = [output for output in json.loads(outputs) if output.get('active')]
+        except (TypeError, ValueError):
+            return None
+        outputs.sort(key=lambda output: not output.get('focused'))      #The focused output first
+        for output in outputs:
+            mode = output.get('current_mode') or {}
+            if mode.get('width') and mode.get('height'):
+                return (mode['width'], mode['height'])
+        return None
+
+
+class FakeBackend(WallpaperBackend):
+    """Pretends to set the wallpaper by writing its path to a file"""
+
+    name = 'fake'
+
+    def __init__(self, state_path=None, screen_size=(1920, 1080)):
+        """Creates the fake backend.
+        Args:
+            state_path (str, optional): File the path of the wallpaper is written to. Defaults to a file in the temporary folder.
+            screen_size (tuple[int, int], optional): Screen size to pretend to have. Defaults to (1920, 1080).
+        """
+        self.state_path = state_path or os.path.join(tempfile.gettempdir(), 'apod_fake_wallpaper.txt')
+        self.screen_size = screen_size
+        self.apply_count = 0        #How many times the wallpaper was really set
+
+    def apply(self, image_path):
+        try:
+            with open(self.state_path, 'w') as state_file:
+                state_file.write(image_path)
+        except OSError:
+            return False
+        self.apply_count += 1
+        return True
+
+    def get_current(self):
+        try:
+            with open(self.state_path) as state_file:
+                return state_file.read() or None
+        except OSError:
+            return None
+
+    def get_screen_size(self):
+        return self.screen_size
+
+
+backend_classes = {backend_class.name: backend_class
+                   for backend_class in (WindowsBackend, GsettingsBackend, FehBackend, SwayBackend, FakeBackend)}
+
+
+#This function picks the backend for the desktop we are running on. The desktop environments say who they are in
+#environment variables, and feh is the fallback for plain X11 window managers
+
+def get_backend(name=None):
+    """Gets the wallpaper backend for this desktop
+    Args:
+        name (str, optional): Name of the backend to use. Defaults to APOD_WALLPAPER_BACKEND, or the one that suits this desktop.
+    Returns:
+        WallpaperBackend: The backend. None, if there isn't one for this desktop.
+    """
+    global backend
+
+    if name is None:
+        name = os.environ.get('APOD_WALLPAPER_BACKEND') or None
+        if name is None and backend is not None:
+            return backend
+    if name is not None:
+        if name not in backend_classes:
+            print(f"Error: Unknown wallpaper backend {name} (choose from {', '.join(backend_classes)})")
+            return None
+        return backend_classes[name]()
+
+    desktop = os.environ.get('XDG_CURRENT_DESKTOP', '').lower()
+    if sys.platform == 'win32':
+        backend = WindowsBackend()
+    elif os.environ.get('SWAYSOCK') and shutil.which('swaymsg'):
+        backend = SwayBackend()
+    elif any(desktop_name in desktop for desktop_name in ('gnome', 'unity', 'budgie', 'pantheon')) and shutil.which('gsettings'):
+        backend = GsettingsBackend()
+    elif os.environ.get('DISPLAY') and shutil.which('feh'):
+        backend = FehBackend()
+    return backend
+
+
+#Small helpers for the command backends
+
+def run_command(args):
+    """Runs a command and gets what it printed
+    Args:
+        args (list): The command and its arguments
+    Returns:
+        str: What the command printed. None, if it couldn't be run or it failed.
+    """
+    try:
+        return subprocess.run(args, check=True, capture_output=True, text=True, timeout=command_timeout).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def get_xrandr_screen_size():
+    """Gets the size of the primary screen from xrandr (or the first one, if none is primary)
+    Returns:
+        tuple[int, int]: Width and height in pixels. None, if it can't be found out.
+    """
+    outputs = run_command(['xrandr', '--current'])
+    if not outputs:
+        return None
+    sizes = re.findall(r'^\S+ connected( primary)? (\d+)x(\d+)\+', outputs, re.MULTILINE)
+    sizes.sort(key=lambda size: not size[0])
+    return (int(sizes[0][1]), int(sizes[0][2])) if sizes else None